@@ -0,0 +1,228 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rolepermissions.roles import RolesManager
+from rolepermissions.utils import camel_or_snake_to_title
+
+from accounts.models import Role
+
+# CSV role name -> (accounts Role name, rolepermissions role name)
+ROLES = {
+    'rd': ('rd', 'r_and_d'),
+    'r_and_d': ('rd', 'r_and_d'),
+    'qa': ('qa', 'qa'),
+    'manager': ('manager', 'manager'),
+}
+
+LIST_SEPARATOR = ';'
+
+
+class Command(BaseCommand):
+    help = (
+        'Create or update users, groups, roles and permissions from a CSV file. '
+        'Columns: username, email, password, roles, and optionally groups, permissions, '
+        'first_name, last_name (roles, groups and permissions are ";"-separated). '
+        'Safe to re-run: existing users are updated and their roles, groups and '
+        'permissions are replaced with the ones in the file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='Path to the CSV file')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows written per transaction')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Processes used to hash passwords')
+        parser.add_argument('--reset-passwords', action='store_true',
+                            help='Also set the password of users that already exist')
+        parser.add_argument('--staff', action='store_true', help='Mark provisioned users as staff')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.totals = {'created': 0, 'updated': 0, 'skipped': 0}
+        self.prepare_roles()
+
+        try:
+            csv_file = open(options['csv_file'], newline='', encoding='utf-8-sig')
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['csv_file']}: {e}")
+
+        with csv_file, ProcessPoolExecutor(max_workers=max(options['workers'], 1),
+                                           initializer=django.setup) as pool:
+            self.pool = pool
+            reader = csv.DictReader(csv_file)
+            missing = {'username', 'roles'} - set(reader.fieldnames or [])
+            if missing:
+                raise CommandError(f"Missing column(s): {', '.join(sorted(missing))}")
+            # Line 1 is the header
+            rows = enumerate(reader, start=2)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                self.provision(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {self.totals['created']} user(s), updated {self.totals['updated']}, "
+            f"skipped {self.totals['skipped']} invalid row(s)"
+        ))
+
+    def prepare_roles(self):
+        """Fetch or create every group, Role and permission the roles need, in a few queries."""
+        user_ct = ContentType.objects.get_for_model(User)
+        self.role_classes = {name: RolesManager.retrieve_role(name) for _, name in ROLES.values()}
+        if None in self.role_classes.values():
+            raise CommandError('ROLEPERMISSIONS_MODULE does not define the r_and_d, qa and manager roles')
+
+        codenames = {
+            codename
+            for role in self.role_classes.values()
+            for codename in role.permission_names_list()
+        }
+        Permission.objects.bulk_create([
+            Permission(content_type=user_ct, codename=codename, name=camel_or_snake_to_title(codename))
+            for codename in codenames
+        ], ignore_conflicts=True)
+        self.permissions = {
+            p.codename: p.pk
+            for p in Permission.objects.filter(content_type=user_ct, codename__in=codenames)
+        }
+
+        self.groups = self.ensure_groups(self.role_classes)
+        existing = {}
+        for role in Role.objects.filter(name__in=[name for name, _ in ROLES.values()]).order_by('pk'):
+            existing.setdefault(role.name, role.pk)
+        for name in {name for name, _ in ROLES.values()} - set(existing):
+            existing[name] = Role.objects.create(name=name).pk
+        self.account_roles = existing
+
+    def ensure_groups(self, names):
+        Group.objects.bulk_create([Group(name=name) for name in names], ignore_conflicts=True)
+        return dict(Group.objects.filter(name__in=names).values_list('name', 'pk'))
+
+    def parse(self, line, row):
+        """Validate one CSV row; returns (username, fields, password, roles, groups, permissions) or None."""
+        def split(value):
+            return [item.strip() for item in (value or '').split(LIST_SEPARATOR) if item.strip()]
+
+        username = (row.get('username') or '').strip()
+        roles = split(row.get('roles'))
+        unknown = [role for role in roles if role not in ROLES]
+        error = None
+        if not username:
+            error = 'missing username'
+        elif not roles:
+            error = 'no roles'
+        elif unknown:
+            error = f"unknown role(s) {', '.join(unknown)}"
+
+        permissions = split(row.get('permissions'))
+        if error is None:
+            in_scope = {
+                codename
+                for role in roles
+                for codename in self.role_classes[ROLES[role][1]].permission_names_list()
+            }
+            out_of_scope = [p for p in permissions if p not in in_scope]
+            if out_of_scope:
+                error = f"permission(s) {', '.join(out_of_scope)} not in the scope of the user's roles"
+
+        if error:
+            self.stderr.write(f"Line {line}: {error}; skipped")
+            self.totals['skipped'] += 1
+            return None
+
+        fields = {
+            'email': (row.get('email') or '').strip(),
+            'first_name': (row.get('first_name') or '').strip(),
+            'last_name': (row.get('last_name') or '').strip(),
+        }
+        return username, fields, row.get('password') or None, roles, split(row.get('groups')), permissions
+
+    def provision(self, batch):
+        parsed = {}
+        for line, row in batch:
+            result = self.parse(line, row)
+            if result:
+                # A later row for the same username wins
+                parsed[result[0]] = result[1:]
+        if not parsed:
+            return
+
+        with transaction.atomic():
+            existing = {user.username: user for user in User.objects.filter(username__in=parsed)}
+            new_names = [name for name in parsed if name not in existing]
+
+            # Hashing dominates provisioning time; spread it over the pool
+            to_hash = new_names + (
+                [name for name in existing if parsed[name][1]] if self.options['reset_passwords'] else []
+            )
+            hashes = dict(zip(to_hash, self.pool.map(
+                make_password, [parsed[name][1] for name in to_hash], chunksize=16
+            )))
+
+            User.objects.bulk_create([
+                User(username=name, password=hashes[name], is_staff=self.options['staff'], **parsed[name][0])
+                for name in new_names
+            ])
+
+            changed = []
+            for name, user in existing.items():
+                fields, _, _, _, _ = parsed[name]
+                updates = dict(fields, **({'password': hashes[name]} if name in hashes else {}))
+                if self.options['staff']:
+                    updates['is_staff'] = True
+                if any(getattr(user, key) != value for key, value in updates.items()):
+                    for key, value in updates.items():
+                        setattr(user, key, value)
+                    changed.append(user)
+            if changed:
+                User.objects.bulk_update(changed, ['email', 'first_name', 'last_name', 'password', 'is_staff'])
+
+            user_ids = dict(User.objects.filter(username__in=parsed).values_list('username', 'pk'))
+            extra_groups = {group for _, _, _, groups, _ in parsed.values() for group in groups}
+            groups = {**self.ensure_groups(extra_groups), **self.groups}
+
+            memberships, grants, account_roles = set(), set(), set()
+            for name, (_, _, roles, group_names, permissions) in parsed.items():
+                user_id = user_ids[name]
+                for role in roles:
+                    account_role, role_name = ROLES[role]
+                    account_roles.add((user_id, self.account_roles[account_role]))
+                    memberships.add((user_id, groups[role_name]))
+                    # What assign_role grants: the role's default-true permissions
+                    grants.update(
+                        (user_id, self.permissions[codename])
+                        for codename, default in self.role_classes[role_name].available_permissions.items()
+                        if default
+                    )
+                memberships.update((user_id, groups[group]) for group in group_names)
+                grants.update((user_id, self.permissions[codename]) for codename in permissions)
+
+            ids = list(user_ids.values())
+            self.replace(User.groups.through, 'user_id', 'group_id', ids, memberships)
+            self.replace(User.user_permissions.through, 'user_id', 'permission_id', ids, grants)
+            self.replace(Role.users.through, 'user_id', 'role_id', ids, account_roles)
+
+        self.totals['created'] += len(new_names)
+        self.totals['updated'] += len(existing)
+        self.stdout.write(f"Provisioned {len(parsed)} user(s)")
+
+    def replace(self, through, user_field, other_field, user_ids, pairs):
+        """Make `through` hold exactly `pairs` of (user id, other id) for these users."""
+        current = set(through.objects.filter(**{f'{user_field}__in': user_ids}).values_list(user_field, other_field))
+        stale = {}
+        for user_id, other_id in current - pairs:
+            stale.setdefault(user_id, []).append(other_id)
+        for user_id, other_ids in stale.items():
+            through.objects.filter(**{user_field: user_id, f'{other_field}__in': other_ids}).delete()
+        through.objects.bulk_create(
+            [through(**{user_field: user_id, other_field: other_id}) for user_id, other_id in pairs - current],
+            ignore_conflicts=True,
+        )
@@ -1,3 +1,437 @@
-from django.contrib import admin
+"""
+Django admin for the dashboard models, built to stay usable on tables with
+millions of rows:
 
-# Register your models here.
+- Changelists never count the whole table. show_full_result_count is off,
+  and EstimatedCountPaginator uses PostgreSQL's planner estimate for
+  unfiltered lists. Filter facet counts are disabled.
+- Foreign keys are joined with list_select_related and edited through
+  autocomplete widgets. Inline rows label their widgets from the
+  select_related objects instead of one query per row.
+- List filters only use indexed columns.
+- Bulk actions are single UPDATE statements. Because update() skips model
+  signals, each action also updates the derived data those signals would
+  have touched.
+
+Derived tables (BOM closure and explosions, lot allocations, audit events,
+archives) are read-only here. Compositions are edited only on the
+formulation page, which moves stock and re-checks compliance like the
+formulation edit view.
+"""
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.http import HttpResponseRedirect
+from django.db import connections, transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from . import audit, bom, freshness, lots, rule_import
+from .models import (
+    ArchivedComplianceIssue,
+    ArchivedFormulation,
+    ArchivedFormulationIngredient,
+    ArchivedQATestResult,
+    AuditEvent,
+    ComplianceIssue,
+    ComplianceRule,
+    ExplodedIngredient,
+    Formulation,
+    FormulationClosure,
+    FormulationComponent,
+    FormulationIngredient,
+    Ingredient,
+    IngredientLot,
+    LotAllocation,
+    QATestResult,
+)
+from .signals import notify_dashboard_change
+
+# Below this many rows an exact count is cheap and the estimate too coarse
+ESTIMATE_THRESHOLD = 100000
+
+
+class EstimatedCountPaginator(Paginator):
+    """Counts unfiltered PostgreSQL tables from pg_class.reltuples."""
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= ESTIMATE_THRESHOLD:
+                return row[0]
+        return super().count
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    list_per_page = 50
+
+    def get_ordering(self, request):
+        # Unordered tables page by primary key, which is always indexed
+        return super().get_ordering(request) or self.model._meta.ordering or ['-pk']
+
+
+class ReadOnlyAdmin(ScalableAdmin):
+    """Derived or historical rows, maintained by the application."""
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+def _changed(*scopes):
+    """What the skipped post_save handlers would have done after a bulk UPDATE."""
+    freshness.bump(*scopes)
+    notify_dashboard_change()
+
+
+# Inlines
+
+class PrefetchedAutocompleteSelect(AutocompleteSelect):
+    """
+    Autocomplete that labels its current value from an object already
+    loaded, instead of the stock widget's query for every inline row.
+    """
+    prefetched = None
+
+    def optgroups(self, name, value, attr=None):
+        selected = {str(v) for v in value if str(v) not in self.choices.field.empty_values}
+        if self.prefetched is None or {str(self.prefetched.pk)} != selected:
+            return super().optgroups(name, value, attr)
+        options = []
+        if not self.is_required:
+            options.append(self.create_option(name, '', '', False, 0))
+        options.append(self.create_option(name, self.prefetched.pk,
+                                          self.choices.field.label_from_instance(self.prefetched),
+                                          selected, len(options)))
+        return [(None, options, 0)]
+
+
+class PrefetchedInlineForm(forms.ModelForm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is None:
+            return
+        for name, field in self.fields.items():
+            # Autocomplete widgets come wrapped in RelatedFieldWidgetWrapper
+            widget = getattr(field.widget, 'widget', field.widget)
+            model_field = self.instance._meta.get_field(name)
+            if isinstance(widget, PrefetchedAutocompleteSelect) and model_field.is_cached(self.instance):
+                widget.prefetched = model_field.get_cached_value(self.instance)
+
+
+class PrefetchedInline(admin.TabularInline):
+    """Tabular inline whose foreign keys are select_related and labelled without extra queries."""
+    form = PrefetchedInlineForm
+    extra = 0
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(*self.autocomplete_fields)
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name in self.autocomplete_fields:
+            kwargs['widget'] = PrefetchedAutocompleteSelect(db_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+class FormulationIngredientInline(PrefetchedInline):
+    model = FormulationIngredient
+    autocomplete_fields = ['ingredient']
+
+
+class FormulationComponentForm(PrefetchedInlineForm):
+    def clean(self):
+        cleaned_data = super().clean()
+        parent, component = self.instance.parent_id, cleaned_data.get('component')
+        if component is not None and parent is not None and self.instance._state.adding and (
+            component.pk == parent
+            or FormulationClosure.objects.filter(ancestor_id=component.pk, descendant_id=parent).exists()
+        ):
+            raise ValidationError(f"{component} already contains this formulation")
+        return cleaned_data
+
+
+class FormulationComponentInline(PrefetchedInline):
+    model = FormulationComponent
+    form = FormulationComponentForm
+    fk_name = 'parent'
+    autocomplete_fields = ['component']
+    verbose_name = 'accord'
+
+
+class IngredientLotInline(admin.TabularInline):
+    model = IngredientLot
+    fields = ['lot_number', 'quantity', 'received_at', 'expires_at']
+    extra = 0
+    # Spent lots are history; only stock on hand is edited here
+    verbose_name_plural = 'lots in stock'
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(quantity__gt=0)
+
+
+# Formulations
+
+@admin.register(Formulation)
+class FormulationAdmin(ScalableAdmin):
+    list_display = ['name', 'version', 'status', 'compliance_status', 'created_by',
+                    'ingredient_count', 'open_issue_count', 'created_at']
+    list_select_related = ['created_by']
+    list_filter = ['status', 'compliance_status']
+    search_fields = ['^name']
+    autocomplete_fields = ['created_by']
+    readonly_fields = ['ingredient_count', 'total_quantity', 'open_issue_count', 'composition_hash',
+                       'bom_valid', 'compliance_checked_at', 'updated_at']
+    inlines = [FormulationIngredientInline, FormulationComponentInline]
+    actions = ['mark_draft', 'mark_pending_qa', 'mark_rejected']
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except ValidationError as e:
+            # Raised by save_related for a stock shortage; the whole save,
+            # which Django runs in one transaction, has been rolled back
+            self.message_user(request, ' '.join(e.messages), messages.ERROR)
+            return HttpResponseRedirect(request.get_full_path())
+
+    def save_related(self, request, form, formsets, change):
+        """Save the composition and move stock as formulation_edit_view does."""
+        formulation = form.instance
+        with transaction.atomic():
+            # Stock used by the composition being replaced goes back first
+            lots.release(formulation, request.user, expected=bom.usage(formulation.pk))
+            # Inline rows go through the signals, which invalidate the
+            # explosion and summaries; rebuild it so usage and
+            # composition_hash reflect the new rows
+            super().save_related(request, form, formsets, change)
+            bom.ensure_exploded([formulation.pk])
+            lots.allocate(bom.usage(formulation.pk), formulation, request.user)
+        formulation.refresh_from_db()
+        formulation.check_compliance()
+        audit.record('formulation_updated' if change else 'formulation_created', formulation, request.user,
+                     compliance_status=formulation.compliance_status)
+
+    def _set_status(self, request, queryset, status):
+        with transaction.atomic():
+            updated = queryset.exclude(status=status).update(status=status, updated_at=timezone.now())
+            _changed('formulation')
+        audit.record('formulations_status_changed', None, request.user, object_type='formulation',
+                     status=status, count=updated)
+        self.message_user(request, f"{updated} formulation(s) marked {status}.", messages.SUCCESS)
+
+    # Approval stays a QA decision, recorded with its test results
+    @admin.action(description='Mark selected formulations as draft')
+    def mark_draft(self, request, queryset):
+        self._set_status(request, queryset, 'draft')
+
+    @admin.action(description='Send selected formulations to QA')
+    def mark_pending_qa(self, request, queryset):
+        self._set_status(request, queryset, 'pending_qa')
+
+    @admin.action(description='Reject selected formulations')
+    def mark_rejected(self, request, queryset):
+        self._set_status(request, queryset, 'rejected')
+
+
+# Read-only: a composition changed row by row would skip the stock and
+# compliance updates in FormulationAdmin.save_related
+
+@admin.register(FormulationIngredient)
+class FormulationIngredientAdmin(ReadOnlyAdmin):
+    list_display = ['formulation', 'ingredient', 'quantity']
+    list_select_related = ['formulation', 'ingredient']
+
+
+@admin.register(FormulationComponent)
+class FormulationComponentAdmin(ReadOnlyAdmin):
+    list_display = ['parent', 'component', 'quantity']
+    list_select_related = ['parent', 'component']
+
+
+@admin.register(FormulationClosure)
+class FormulationClosureAdmin(ReadOnlyAdmin):
+    list_display = ['ancestor', 'descendant', 'paths']
+    list_select_related = ['ancestor', 'descendant']
+
+
+@admin.register(ExplodedIngredient)
+class ExplodedIngredientAdmin(ReadOnlyAdmin):
+    list_display = ['formulation', 'ingredient', 'quantity']
+    list_select_related = ['formulation', 'ingredient']
+
+
+# Stock
+
+@admin.register(Ingredient)
+class IngredientAdmin(ScalableAdmin):
+    list_display = ['name', 'category', 'current_stock', 'reorder_threshold', 'updated_at']
+    list_filter = ['category']
+    search_fields = ['^name']
+    ordering = ['name']
+    readonly_fields = ['current_stock']
+    inlines = [IngredientLotInline]
+    actions = ['refresh_stock']
+
+    def save_related(self, request, form, formsets, change):
+        with transaction.atomic():
+            lots.track([form.instance.pk])
+            super().save_related(request, form, formsets, change)
+            lots.refresh_stock([form.instance.pk])
+        if change and 'category' in form.changed_data:
+            # Other category rules now apply to formulations using it
+            rule_import.recheck([form.instance.pk])
+
+    @admin.action(description='Recompute stock of selected ingredients from their lots')
+    def refresh_stock(self, request, queryset):
+        with transaction.atomic():
+            lots.refresh_stock(queryset.values('pk'))
+        self.message_user(request, 'Stock recomputed from lots.', messages.SUCCESS)
+
+
+@admin.register(IngredientLot)
+class IngredientLotAdmin(ScalableAdmin):
+    list_display = ['ingredient', 'lot_number', 'quantity', 'received_at', 'expires_at']
+    list_select_related = ['ingredient']
+    search_fields = ['^lot_number', '^ingredient__name']
+    autocomplete_fields = ['ingredient']
+    actions = ['write_off']
+
+    def save_model(self, request, obj, form, change):
+        # A lot moved to another ingredient changes the stock of both
+        ingredient_ids = {obj.ingredient_id, form.initial.get('ingredient')} - {None}
+        with transaction.atomic():
+            lots.track(ingredient_ids)
+            super().save_model(request, obj, form, change)
+            lots.refresh_stock(ingredient_ids)
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            super().delete_model(request, obj)
+            lots.refresh_stock([obj.ingredient_id])
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            ingredient_ids = list(queryset.values_list('ingredient_id', flat=True).distinct())
+            super().delete_queryset(request, queryset)
+            lots.refresh_stock(ingredient_ids)
+
+    @admin.action(description='Write off selected lots (set remaining quantity to 0)')
+    def write_off(self, request, queryset):
+        with transaction.atomic():
+            # Bounded by the ingredient catalog, not the number of lots
+            ingredient_ids = list(queryset.values_list('ingredient_id', flat=True).distinct())
+            updated = queryset.exclude(quantity=0).update(quantity=0)
+            lots.refresh_stock(ingredient_ids)
+        audit.record('stock_written_off', None, request.user, object_type='ingredientlot', count=updated)
+        self.message_user(request, f"{updated} lot(s) written off.", messages.SUCCESS)
+
+
+@admin.register(LotAllocation)
+class LotAllocationAdmin(ReadOnlyAdmin):
+    list_display = ['formulation', 'lot', 'quantity']
+    list_select_related = ['formulation', 'lot__ingredient']
+
+
+# Compliance and QA
+
+@admin.register(ComplianceRule)
+class ComplianceRuleAdmin(ScalableAdmin):
+    list_display = ['__str__', 'max_quantity', 'max_concentration', 'updated_at']
+    list_select_related = ['ingredient']
+    search_fields = ['^ingredient__name', '^category']
+    autocomplete_fields = ['ingredient']
+
+
+@admin.register(ComplianceIssue)
+class ComplianceIssueAdmin(ScalableAdmin):
+    list_display = ['formulation', 'ingredient', 'description', 'status', 'created_at']
+    list_select_related = ['formulation', 'ingredient']
+    list_filter = ['status']
+    autocomplete_fields = ['formulation', 'ingredient']
+    actions = ['mark_in_progress', 'mark_resolved']
+
+    def _set_status(self, request, queryset, status):
+        with transaction.atomic():
+            # Formulation.open_issue_count as it will be after the update,
+            # computed first because the update may take the selected issues
+            # out of the changelist's filter
+            open_issues = (
+                ComplianceIssue.objects.filter(Q(status='open') & ~Q(pk__in=queryset.values('pk')),
+                                               formulation=OuterRef('pk'))
+                .order_by().values('formulation').annotate(n=Count('pk')).values('n')
+            )
+            Formulation.objects.filter(pk__in=queryset.values('formulation_id')).update(
+                open_issue_count=Coalesce(Subquery(open_issues), 0)
+            )
+            updated = queryset.exclude(status=status).update(status=status, updated_at=timezone.now())
+            _changed('complianceissue', 'formulation')
+        audit.record('compliance_issues_status_changed', None, request.user, object_type='complianceissue',
+                     status=status, count=updated)
+        self.message_user(request, f"{updated} issue(s) marked {status.replace('_', ' ')}.", messages.SUCCESS)
+
+    @admin.action(description='Mark selected issues in progress')
+    def mark_in_progress(self, request, queryset):
+        self._set_status(request, queryset, 'in_progress')
+
+    @admin.action(description='Mark selected issues resolved')
+    def mark_resolved(self, request, queryset):
+        self._set_status(request, queryset, 'resolved')
+
+
+@admin.register(QATestResult)
+class QATestResultAdmin(ScalableAdmin):
+    list_display = ['formulation', 'status', 'tested_by', 'tested_at']
+    list_select_related = ['formulation', 'tested_by']
+    list_filter = ['status']
+    autocomplete_fields = ['formulation', 'tested_by']
+
+
+@admin.register(AuditEvent)
+class AuditEventAdmin(ReadOnlyAdmin):
+    list_display = ['created_at', 'action', 'actor', 'object_type', 'object_id', 'object_repr']
+    list_select_related = ['actor']
+    # Exact matches, served by the (action, created_at) and object indexes
+    search_fields = ['=action', '=object_id']
+
+
+# Archive
+
+@admin.register(ArchivedFormulation)
+class ArchivedFormulationAdmin(ReadOnlyAdmin):
+    list_display = ['name', 'version', 'status', 'compliance_status', 'created_by', 'created_at', 'archived_at']
+    list_select_related = ['created_by']
+
+
+@admin.register(ArchivedFormulationIngredient)
+class ArchivedFormulationIngredientAdmin(ReadOnlyAdmin):
+    list_display = ['formulation', 'ingredient', 'quantity']
+    list_select_related = ['formulation', 'ingredient']
+
+
+@admin.register(ArchivedComplianceIssue)
+class ArchivedComplianceIssueAdmin(ReadOnlyAdmin):
+    list_display = ['formulation_id', 'ingredient', 'status', 'created_at', 'archived_at']
+    list_select_related = ['ingredient']
+
+
+@admin.register(ArchivedQATestResult)
+class ArchivedQATestResultAdmin(ReadOnlyAdmin):
+    list_display = ['formulation', 'status', 'tested_by', 'tested_at']
+    list_select_related = ['formulation', 'tested_by']
@@ -0,0 +1,280 @@
+"""
+Read-only JSON API (v1).
+
+Each resource declares the fields it exposes (mapped to ORM paths fetched
+with `values()`), the filters it accepts and any nested collections, which
+are loaded for a whole page in one extra query. Lists use keyset (cursor)
+pagination on the primary key so deep pages cost the same as the first.
+Access to each resource is limited to the roles whose HTML pages show the
+same data.
+"""
+import base64
+import binascii
+from functools import wraps
+
+from django.db.models import F
+from django.http import JsonResponse
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_GET
+
+from .models import ComplianceIssue, Formulation, FormulationIngredient, Ingredient, QATestResult
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _boolean(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def _datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ApiError(f"Invalid datetime: {value}")
+    return parsed
+
+
+def _low_stock(queryset, value):
+    if _boolean(value):
+        return queryset.filter(current_stock__lte=F('reorder_threshold'))
+    return queryset.filter(current_stock__gt=F('reorder_threshold'))
+
+
+def _formulation_ingredients(ids):
+    nested = {}
+    rows = FormulationIngredient.objects.filter(formulation_id__in=ids).values_list(
+        'formulation_id', 'ingredient_id', 'ingredient__name', 'quantity'
+    )
+    for formulation_id, ingredient_id, name, quantity in rows:
+        nested.setdefault(formulation_id, []).append(
+            {'ingredient_id': ingredient_id, 'name': name, 'quantity': quantity}
+        )
+    return nested
+
+
+class Resource:
+    """Declarative description of one API collection."""
+
+    def __init__(self, model, roles, fields, default_fields, filters, nested=None):
+        self.model = model
+        # Role names allowed to read this collection
+        self.roles = roles
+        # public field name -> ORM path for values()
+        self.fields = fields
+        self.default_fields = default_fields
+        # query parameter -> (ORM lookup, value parser), or a callable
+        # taking (queryset, value) for filters that are not a plain lookup
+        self.filters = filters
+        # public field name -> callable(ids) returning {id: [...]}
+        self.nested = nested or {}
+
+    def selected_fields(self, request):
+        requested = request.GET.get('fields')
+        if not requested:
+            return self.default_fields
+        names = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields and name not in self.nested]
+        if unknown:
+            raise ApiError(f"Unknown field(s): {', '.join(unknown)}")
+        return names
+
+    def queryset(self, request):
+        queryset = self.model.objects.order_by('pk')
+        for param, spec in self.filters.items():
+            value = request.GET.get(param)
+            if value in (None, ''):
+                continue
+            if callable(spec):
+                queryset = spec(queryset, value)
+                continue
+            lookup, parse = spec
+            try:
+                queryset = queryset.filter(**{lookup: parse(value)})
+            except (ValueError, TypeError):
+                raise ApiError(f"Invalid value for {param}: {value}")
+        return queryset
+
+    def serialize(self, queryset, names):
+        columns = [name for name in names if name in self.fields]
+        paths = ['pk'] + [self.fields[name] for name in columns]
+        rows = [
+            dict(zip(['id'] + columns, values))
+            for values in queryset.values_list(*paths)
+        ]
+        nested_names = [name for name in names if name in self.nested]
+        if nested_names and rows:
+            ids = [row['id'] for row in rows]
+            for name in nested_names:
+                nested = self.nested[name](ids)
+                for row in rows:
+                    row[name] = nested.get(row['id'], [])
+        return rows
+
+
+RESOURCES = {
+    'formulations': Resource(
+        Formulation,
+        roles=['rd', 'qa', 'manager'],
+        fields={
+            'name': 'name',
+            'version': 'version',
+            'status': 'status',
+            'compliance_status': 'compliance_status',
+            'created_by': 'created_by__username',
+            'created_at': 'created_at',
+            'updated_at': 'updated_at',
+            'ingredient_count': 'ingredient_count',
+            'total_quantity': 'total_quantity',
+            'open_issue_count': 'open_issue_count',
+        },
+        default_fields=['name', 'version', 'status', 'compliance_status', 'created_at'],
+        filters={
+            'status': ('status', str),
+            'compliance_status': ('compliance_status', str),
+            'created_by': ('created_by__username', str),
+            'created_after': ('created_at__gte', _datetime),
+            'created_before': ('created_at__lt', _datetime),
+            'updated_after': ('updated_at__gte', _datetime),
+        },
+        nested={'ingredients': _formulation_ingredients},
+    ),
+    'ingredients': Resource(
+        Ingredient,
+        roles=['rd', 'manager'],
+        fields={
+            'name': 'name',
+            'current_stock': 'current_stock',
+            'reorder_threshold': 'reorder_threshold',
+            'created_at': 'created_at',
+            'updated_at': 'updated_at',
+        },
+        default_fields=['name', 'current_stock', 'reorder_threshold'],
+        filters={
+            'name': ('name', str),
+            'low_stock': _low_stock,
+            'updated_after': ('updated_at__gte', _datetime),
+        },
+    ),
+    'compliance-issues': Resource(
+        ComplianceIssue,
+        roles=['rd', 'qa'],
+        fields={
+            'formulation_id': 'formulation_id',
+            'formulation': 'formulation__name',
+            'ingredient_id': 'ingredient_id',
+            'ingredient': 'ingredient__name',
+            'description': 'description',
+            'status': 'status',
+            'created_at': 'created_at',
+            'updated_at': 'updated_at',
+        },
+        default_fields=['formulation_id', 'ingredient_id', 'description', 'status', 'created_at'],
+        filters={
+            'status': ('status', str),
+            'formulation': ('formulation_id', int),
+            'ingredient': ('ingredient_id', int),
+            'updated_after': ('updated_at__gte', _datetime),
+        },
+    ),
+    'qa-results': Resource(
+        QATestResult,
+        roles=['qa'],
+        fields={
+            'formulation_id': 'formulation_id',
+            'formulation': 'formulation__name',
+            'status': 'status',
+            'stability_test': 'stability_test',
+            'performance_test': 'performance_test',
+            'comments': 'comments',
+            'tested_by': 'tested_by__username',
+            'tested_at': 'tested_at',
+        },
+        default_fields=['formulation_id', 'status', 'tested_by', 'tested_at'],
+        filters={
+            'status': ('status', str),
+            'formulation': ('formulation_id', int),
+            'tested_after': ('tested_at__gte', _datetime),
+        },
+    ),
+}
+
+
+def encode_cursor(pk):
+    return base64.urlsafe_b64encode(str(pk).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise ApiError('Invalid cursor')
+
+
+def _resource(name):
+    if name not in RESOURCES:
+        raise ApiError(f"Unknown resource: {name}", status=404)
+    return RESOURCES[name]
+
+
+def _json(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params={'separators': (',', ':')})
+
+
+def _api_view(view_func):
+    """Authentication, role checks and error handling shared by the API views."""
+    @wraps(view_func)
+    def wrapped(request, resource, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return _json({'error': 'Authentication required'}, status=401)
+        try:
+            spec = _resource(resource)
+            if not request.user.roles.filter(name__in=spec.roles).exists():
+                return _json({'error': 'Permission denied'}, status=403)
+            return view_func(request, resource, *args, **kwargs)
+        except ApiError as e:
+            return _json({'error': str(e)}, status=e.status)
+    return require_GET(wrapped)
+
+
+@_api_view
+def resource_list(request, resource):
+    spec = _resource(resource)
+    names = spec.selected_fields(request)
+    queryset = spec.queryset(request)
+
+    try:
+        limit = min(max(int(request.GET.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except ValueError:
+        raise ApiError('limit must be an integer')
+    cursor = request.GET.get('cursor')
+    if cursor:
+        queryset = queryset.filter(pk__gt=decode_cursor(cursor))
+
+    rows = spec.serialize(queryset[:limit + 1], names)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['id'])
+
+    next_url = None
+    if next_cursor:
+        query = request.GET.copy()
+        query['cursor'] = next_cursor
+        next_url = f"{request.path}?{query.urlencode()}"
+
+    return _json({'results': rows, 'next_cursor': next_cursor, 'next': next_url})
+
+
+@_api_view
+def resource_detail(request, resource, pk):
+    spec = _resource(resource)
+    rows = spec.serialize(spec.model.objects.filter(pk=pk), spec.selected_fields(request))
+    if not rows:
+        return _json({'error': 'Not found'}, status=404)
+    return _json(rows[0])
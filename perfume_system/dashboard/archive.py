@@ -0,0 +1,199 @@
+"""
+Archival of formulation history.
+
+Rejected and superseded formulations (another formulation with the same
+name was created later), together with their ingredients, issues and QA
+results, and resolved compliance issues are moved into the Archived*
+tables once they have been untouched for ARCHIVE_AFTER_DAYS. Each batch is
+copied and deleted in its own transaction, so the hot tables shrink
+without long-held locks and an interrupted run loses nothing.
+
+Reads go through `get_formulation()` for detail pages and the
+`*_counts`/`*_usage` helpers for reports, which merge the archive in when
+asked to.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.utils import timezone
+
+from . import audit, freshness
+from .models import (
+    ArchivedComplianceIssue,
+    ArchivedFormulation,
+    ArchivedFormulationIngredient,
+    ArchivedQATestResult,
+    ComplianceIssue,
+    ExplodedIngredient,
+    Formulation,
+    FormulationComponent,
+    FormulationIngredient,
+    QATestResult,
+)
+from .signals import publish_composition_changes
+
+FORMULATION_FIELDS = [
+    'id', 'name', 'version', 'status', 'compliance_status', 'created_by_id',
+    'created_at', 'updated_at', 'ingredient_count', 'total_quantity', 'open_issue_count',
+]
+INGREDIENT_FIELDS = ['id', 'formulation_id', 'ingredient_id', 'quantity']
+ISSUE_FIELDS = ['id', 'formulation_id', 'ingredient_id', 'description', 'status', 'created_at', 'updated_at']
+QA_FIELDS = [
+    'id', 'formulation_id', 'stability_test', 'performance_test', 'comments',
+    'tested_by_id', 'tested_at', 'status',
+]
+
+
+def cutoff(older_than_days=None):
+    if older_than_days is None:
+        older_than_days = settings.ARCHIVE_AFTER_DAYS
+    return timezone.now() - timedelta(days=older_than_days)
+
+
+def archivable_formulations(before):
+    """Rejected or superseded formulations not updated since `before`."""
+    newer_version = Formulation.objects.filter(name=OuterRef('name'), created_at__gt=OuterRef('created_at'))
+    return (
+        Formulation.objects
+        .filter(updated_at__lt=before)
+        .filter(Q(status='rejected') | Exists(newer_version))
+        .exclude(status='pending_qa')
+        # Accords still used by other formulations stay live
+        .filter(parent_links__isnull=True)
+    )
+
+
+def archivable_issues(before):
+    return ComplianceIssue.objects.filter(status='resolved', updated_at__lt=before)
+
+
+def _copy(queryset, model, fields, **extra):
+    model.objects.bulk_create([model(**row, **extra) for row in queryset.values(*fields)])
+
+
+def archive_formulations(before, batch_size=None):
+    """Move archivable formulations in batches; returns how many were moved."""
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    moved = 0
+    while True:
+        with transaction.atomic():
+            ids = list(archivable_formulations(before).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            now = timezone.now()
+            _copy(Formulation.objects.filter(pk__in=ids), ArchivedFormulation, FORMULATION_FIELDS, archived_at=now)
+            _copy(FormulationIngredient.objects.filter(formulation_id__in=ids),
+                  ArchivedFormulationIngredient, INGREDIENT_FIELDS)
+            _copy(ComplianceIssue.objects.filter(formulation_id__in=ids),
+                  ArchivedComplianceIssue, ISSUE_FIELDS, archived_at=now)
+            _copy(QATestResult.objects.filter(formulation_id__in=ids), ArchivedQATestResult, QA_FIELDS)
+            # The per-row delete signals of these children would invalidate
+            # and recount formulations that are about to go, row by row, so
+            # the children are deleted in bulk without them. Nothing uses
+            # an archivable formulation, so no other explosion or closure
+            # depends on its rows.
+            for children in (
+                FormulationIngredient.objects.filter(formulation_id__in=ids),
+                FormulationComponent.objects.filter(parent_id__in=ids),
+                ComplianceIssue.objects.filter(formulation_id__in=ids),
+                QATestResult.objects.filter(formulation_id__in=ids),
+            ):
+                children._raw_delete(children.db)
+            # Cascades to explosions, closure rows and lot allocations
+            Formulation.objects.filter(pk__in=ids).delete()
+            # One change log entry per formulation, one freshness bump for the batch
+            publish_composition_changes(ids)
+            freshness.bump('formulation', 'complianceissue', 'qatestresult')
+            audit.record('formulations_archived', object_type='formulation',
+                         object_id=f'{ids[0]}-{ids[-1]}', count=len(ids))
+        moved += len(ids)
+    return moved
+
+
+def archive_issues(before, batch_size=None):
+    """Move resolved compliance issues in batches; returns how many were moved."""
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    moved = 0
+    while True:
+        with transaction.atomic():
+            ids = list(archivable_issues(before).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            _copy(ComplianceIssue.objects.filter(pk__in=ids), ArchivedComplianceIssue, ISSUE_FIELDS,
+                  archived_at=timezone.now())
+            ComplianceIssue.objects.filter(pk__in=ids).delete()
+            audit.record('compliance_issues_archived', object_type='complianceissue',
+                         object_id=f'{ids[0]}-{ids[-1]}', count=len(ids))
+        moved += len(ids)
+    return moved
+
+
+def get_formulation(pk):
+    """The live formulation with this id, else its archived copy, else None."""
+    formulation = Formulation.objects.filter(pk=pk).select_related('created_by').first()
+    if formulation is None:
+        formulation = ArchivedFormulation.objects.filter(pk=pk).select_related('created_by').first()
+    return formulation
+
+
+def compliance_issues_for(formulation):
+    """Live and archived issues of a formulation, newest first."""
+    issues = list(ArchivedComplianceIssue.objects.filter(formulation_id=formulation.pk).select_related('ingredient'))
+    if not getattr(formulation, 'archived', False):
+        issues += ComplianceIssue.objects.filter(formulation=formulation).select_related('ingredient')
+    return sorted(issues, key=lambda issue: issue.created_at, reverse=True)
+
+
+# Report helpers. Each returns the live figures, plus the archived ones
+# when include_archived is set.
+
+def status_counts(include_archived=False):
+    counts = _grouped(Formulation.objects, 'status', Count('pk'))
+    if include_archived:
+        _merge(counts, _grouped(ArchivedFormulation.objects, 'status', Count('pk')))
+    return counts
+
+
+def monthly_counts(start, end, include_archived=False):
+    """{(year, month): formulations created} between start and end."""
+    def grouped(model):
+        rows = (
+            model.objects.filter(created_at__range=(start, end))
+            .values_list('created_at__year', 'created_at__month')
+            .annotate(count=Count('pk'))
+            .order_by()
+        )
+        return {(year, month): count for year, month, count in rows}
+
+    counts = grouped(Formulation)
+    if include_archived:
+        _merge(counts, grouped(ArchivedFormulation))
+    return dict(sorted(counts.items()))
+
+
+def ingredient_usage(limit=10, include_archived=False):
+    """
+    Top ingredients by total quantity used, as [(name, total)]. Live
+    formulations count their exploded ingredients, so accords are included.
+    """
+
+    def grouped(model):
+        queryset = model.objects.values_list('ingredient__name').annotate(total=Sum('quantity')).order_by('-total')
+        # Without the archive the database can apply the limit itself
+        return dict(queryset if include_archived else queryset[:limit])
+
+    usage = grouped(ExplodedIngredient)
+    if include_archived:
+        _merge(usage, grouped(ArchivedFormulationIngredient))
+    return sorted(usage.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def _grouped(manager, field, aggregate):
+    return dict(manager.values_list(field).annotate(value=aggregate).order_by())
+
+
+def _merge(into, other):
+    for key, value in other.items():
+        into[key] = into.get(key, 0) + value
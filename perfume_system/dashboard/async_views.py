@@ -0,0 +1,85 @@
+"""
+Async versions of the read-only dashboard and reports views.
+
+urls.py uses them when ASYNC_VIEWS is set, which perfume_system.asgi does.
+The sync views in views.py still serve WSGI. Both build their pages from
+the same dashboard_queries()/report_queries() and *_context() helpers.
+
+The queries behind each page are independent, so they run concurrently on
+a small thread pool, each on that thread's own database connection. A
+page then takes about as long as its slowest query rather than the sum of
+all of them. Django's async ORM methods would not help here: they run every
+query on the same single thread. Chart building and template rendering
+also stay off the event loop.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.db import close_old_connections
+from django.shortcuts import redirect
+
+from .freshness import conditional
+from .profiling import render
+from .views import dashboard_context, dashboard_queries, live_updates, report_queries, reports_context
+
+_executor = None
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.ASYNC_QUERY_WORKERS,
+                                       thread_name_prefix='async-queries')
+    return _executor
+
+
+def _run(query):
+    try:
+        return query()
+    finally:
+        # Pool threads outlive requests; apply CONN_MAX_AGE to their connections
+        close_old_connections()
+
+
+async def run_queries(queries):
+    """Run {name: callable} concurrently on the query pool; returns {name: result}."""
+    loop = asyncio.get_running_loop()
+    # Each query carries the request's context (query metrics, profiling)
+    results = await asyncio.gather(*(
+        loop.run_in_executor(_pool(), contextvars.copy_context().run, _run, query)
+        for query in queries.values()
+    ))
+    return dict(zip(queries, results))
+
+
+async def _has_role(request, name):
+    user = await request.auser()
+    return await user.roles.filter(name=name).aexists()
+
+
+@login_required
+@conditional('formulation', 'ingredient', 'complianceissue')
+async def dashboard_view(request):
+    if not await _has_role(request, 'manager'):
+        return redirect('dashboard:formulations')
+
+    results = await run_queries(dashboard_queries())
+    context = await sync_to_async(dashboard_context, thread_sensitive=False)(results)
+    context['live'] = live_updates(request)
+    return await sync_to_async(render)(request, 'dashboard/dashboard.html', context)
+
+
+@login_required
+@conditional('formulation', 'ingredient')
+async def reports_view(request):
+    if not await _has_role(request, 'manager'):
+        return redirect('dashboard:dashboard')
+
+    include_archived = request.GET.get('include_archived') == '1'
+    results = await run_queries(report_queries(include_archived))
+    context = await sync_to_async(reports_context, thread_sensitive=False)(results, include_archived)
+    return await sync_to_async(render)(request, 'dashboard/reports.html', context)
@@ -0,0 +1,139 @@
+"""
+Buffered audit log.
+
+Views and model methods call `record()`, which only appends to an
+in-process buffer, and only once the surrounding transaction commits, so
+a rolled-back write leaves no event. The buffer is written with a single
+bulk_create when it reaches AUDIT_BUFFER_SIZE events, when
+AUDIT_FLUSH_INTERVAL seconds have passed since the last flush, after each
+request has been sent, and at process exit.
+
+If the database is unavailable, the events are kept for the next flush. If
+it rejects some of them (say, an actor deleted meanwhile), the batch is
+bisected down to the offending events, which are logged and dropped.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import InterfaceError, OperationalError, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Events kept in memory while the database is unavailable
+MAX_PENDING = 10000
+
+_buffer = []
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def record(action, obj=None, actor=None, *, object_type='', object_id='', **details):
+    """
+    Queue an audit event once the current transaction commits. `obj` is the
+    model instance acted on, if any; bulk paths that only have ids pass
+    `object_type`/`object_id` instead.
+    """
+    from .models import AuditEvent
+
+    if actor is not None and not getattr(actor, 'is_authenticated', True):
+        actor = None
+    if obj is not None:
+        object_type = obj._meta.model_name
+        object_id = obj.pk if obj.pk is not None else ''
+    event = AuditEvent(
+        actor=actor,
+        action=action,
+        object_type=object_type,
+        object_id=str(object_id),
+        object_repr=str(obj)[:200] if obj is not None else '',
+        details=_jsonable(details),
+        created_at=timezone.now(),
+    )
+    transaction.on_commit(lambda: _enqueue(event))
+
+
+def _enqueue(event):
+    if event.action.startswith('stock_'):
+        metrics.stock_operations.inc(event.action[len('stock_'):])
+    with _lock:
+        _buffer.append(event)
+        due = (
+            len(_buffer) >= getattr(settings, 'AUDIT_BUFFER_SIZE', 100)
+            or time.monotonic() - _last_flush >= getattr(settings, 'AUDIT_FLUSH_INTERVAL', 5.0)
+        )
+    if due:
+        flush()
+
+
+def flush():
+    """Write all buffered events in one bulk insert."""
+    global _last_flush
+
+    with _lock:
+        if not _buffer:
+            _last_flush = time.monotonic()
+            return 0
+        events = _buffer[:]
+        del _buffer[:]
+        _last_flush = time.monotonic()
+    try:
+        return _write(events)
+    except (OperationalError, InterfaceError):
+        # Never let auditing break the request; while the database is
+        # unavailable, put the events back to retry
+        logger.exception('Failed to write %d audit events', len(events))
+        with _lock:
+            _buffer[:0] = events
+            # Bound memory if the database stays unavailable
+            overflow = len(_buffer) - MAX_PENDING
+            if overflow > 0:
+                logger.error('Dropping %d oldest audit events', overflow)
+                del _buffer[:overflow]
+        return 0
+
+
+def _write(events):
+    """
+    Insert events, bisecting around any the database rejects; returns how
+    many were written. Connection errors propagate.
+    """
+    from .models import AuditEvent
+
+    try:
+        with transaction.atomic():
+            AuditEvent.objects.bulk_create(events, batch_size=500)
+        return len(events)
+    except (OperationalError, InterfaceError):
+        raise
+    except Exception:
+        if len(events) == 1:
+            logger.exception('Dropping audit event rejected by the database: %s', events[0])
+            return 0
+        middle = len(events) // 2
+        return _write(events[:middle]) + _write(events[middle:])
+
+
+def pending():
+    """Number of events waiting to be written."""
+    return len(_buffer)
+
+
+def _jsonable(details):
+    return {key: value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+            for key, value in details.items()}
+
+
+@receiver(request_finished)
+def _flush_after_request(sender, **kwargs):
+    flush()
+
+
+atexit.register(flush)
@@ -0,0 +1,250 @@
+"""
+Bill-of-materials explosion for nested formulations.
+
+A formulation can use other formulations (accords) as components. An accord
+used at quantity q contributes its own exploded ingredients scaled by
+q / the accord's total weight. Explosions are stored in ExplodedIngredient
+and marked current by Formulation.bom_valid. A write to a formulation's
+ingredients or components clears the flag on that formulation and on every
+ancestor, which FormulationClosure finds in one query (see signals.py).
+`ensure_exploded()` then rebuilds only the invalid formulations, bottom-up,
+reusing the stored explosions of valid sub-formulations instead of walking
+the tree again.
+
+Rebuilding happens on the write path: signals.py rebuilds once the write
+commits, and writers that need the new explosion inside their transaction
+(`explode()`, `usage()`) rebuild it themselves. Read paths use
+`explosions()`, which never writes. After a deploy that marks everything
+invalid, run the rebuild_explosions command.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import transaction
+
+from .models import (
+    ExplodedIngredient,
+    Formulation,
+    FormulationClosure,
+    FormulationComponent,
+    FormulationIngredient,
+    composition_fingerprint,
+)
+
+# Precision of stored explosions and of stock movements
+EXPLODED_STEP = Decimal('0.000001')
+STOCK_STEP = Decimal('0.01')
+
+
+def compose(direct, components):
+    """
+    Exploded composition {ingredient_id: quantity} from direct
+    (ingredient_id, quantity) rows plus (component explosion, quantity)
+    pairs.
+    """
+    totals = {}
+    for ingredient_id, quantity in direct:
+        ingredient_id = int(ingredient_id)
+        totals[ingredient_id] = totals.get(ingredient_id, Decimal('0')) + Decimal(str(quantity))
+    for exploded, quantity in components:
+        weight = sum(exploded.values())
+        if not weight:
+            continue
+        scale = Decimal(str(quantity)) / weight
+        for ingredient_id, amount in exploded.items():
+            totals[ingredient_id] = totals.get(ingredient_id, Decimal('0')) + amount * scale
+    return {
+        ingredient_id: quantity.quantize(EXPLODED_STEP)
+        for ingredient_id, quantity in totals.items()
+        if quantity
+    }
+
+
+def explosions(formulation_ids):
+    """
+    Stored explosions {formulation_id: {ingredient_id: quantity}}, as of the
+    last committed composition write. Never rebuilds; for read paths.
+    """
+    return _stored(formulation_ids)
+
+
+def explode(formulation_id):
+    """
+    Raw ingredient quantities {ingredient_id: quantity} of one formulation,
+    rebuilt first if invalid; for write paths.
+    """
+    return explode_many([formulation_id]).get(formulation_id, {})
+
+
+def explode_many(formulation_ids):
+    ensure_exploded(formulation_ids)
+    return _stored(formulation_ids)
+
+
+def usage(formulation_id):
+    """Stock consumed by one batch of a formulation, at stock precision."""
+    return _to_stock(explode(formulation_id))
+
+
+def component_usage(component_id, quantity):
+    """Stock consumed by `quantity` of an accord, at stock precision."""
+    return _to_stock(compose((), [(explode(component_id), quantity)]))
+
+
+def _to_stock(exploded):
+    rounded = {
+        ingredient_id: quantity.quantize(STOCK_STEP, rounding=ROUND_HALF_UP)
+        for ingredient_id, quantity in exploded.items()
+    }
+    return {ingredient_id: quantity for ingredient_id, quantity in rounded.items() if quantity}
+
+
+def posted_fingerprint(direct, components):
+    """composition_fingerprint() of a composition that has not been saved yet."""
+    return composition_fingerprint(compose(
+        direct, [(explode(int(component_id)), quantity) for component_id, quantity in components]
+    ).items())
+
+
+def _stored(formulation_ids):
+    result = {formulation_id: {} for formulation_id in formulation_ids}
+    rows = ExplodedIngredient.objects.filter(formulation_id__in=formulation_ids).values_list(
+        'formulation_id', 'ingredient_id', 'quantity'
+    )
+    for formulation_id, ingredient_id, quantity in rows:
+        result[formulation_id][ingredient_id] = quantity
+    return result
+
+
+def ensure_exploded(formulation_ids=None):
+    """
+    Rebuild the invalid explosions these formulations depend on, or every
+    invalid explosion when no ids are given. Returns how many were rebuilt.
+    """
+    invalid = Formulation.objects.filter(bom_valid=False)
+    if formulation_ids is not None:
+        # Invalidation always reaches ancestors, so a valid formulation
+        # never has an invalid sub-formulation
+        roots = set(invalid.filter(pk__in=formulation_ids).values_list('pk', flat=True))
+        if not roots:
+            return 0
+        below = FormulationClosure.objects.filter(ancestor_id__in=roots).values('descendant_id')
+        roots |= set(invalid.filter(pk__in=below).values_list('pk', flat=True))
+        pending = roots
+    else:
+        pending = set(invalid.values_list('pk', flat=True))
+    if not pending:
+        return 0
+
+    with transaction.atomic():
+        links = {}
+        for parent_id, component_id, quantity in FormulationComponent.objects.filter(
+            parent_id__in=pending
+        ).values_list('parent_id', 'component_id', 'quantity'):
+            links.setdefault(parent_id, []).append((component_id, quantity))
+        direct = {}
+        for formulation_id, ingredient_id, quantity in FormulationIngredient.objects.filter(
+            formulation_id__in=pending
+        ).values_list('formulation_id', 'ingredient_id', 'quantity'):
+            direct.setdefault(formulation_id, []).append((ingredient_id, quantity))
+
+        exploded = _stored({c for parts in links.values() for c, _ in parts} - pending)
+
+        def build(formulation_id):
+            if formulation_id not in exploded:
+                for component_id, _ in links.get(formulation_id, ()):
+                    build(component_id)
+                exploded[formulation_id] = compose(
+                    direct.get(formulation_id, ()),
+                    [(exploded[c], quantity) for c, quantity in links.get(formulation_id, ())],
+                )
+
+        for formulation_id in pending:
+            build(formulation_id)
+
+        ExplodedIngredient.objects.filter(formulation_id__in=pending).delete()
+        ExplodedIngredient.objects.bulk_create([
+            ExplodedIngredient(formulation_id=formulation_id, ingredient_id=ingredient_id, quantity=quantity)
+            for formulation_id in pending
+            for ingredient_id, quantity in exploded[formulation_id].items()
+        ], batch_size=1000)
+        # The stored hash always describes the exploded composition
+        Formulation.objects.bulk_update([
+            Formulation(pk=formulation_id, bom_valid=True,
+                        composition_hash=composition_fingerprint(exploded[formulation_id].items()))
+            for formulation_id in pending
+        ], ['bom_valid', 'composition_hash'], batch_size=500)
+    return len(pending)
+
+
+# Closure table maintenance, called from signals.py as links change
+
+def link(parent_id, component_id):
+    _adjust_closure(parent_id, component_id, 1)
+
+
+def unlink(parent_id, component_id):
+    _adjust_closure(parent_id, component_id, -1)
+
+
+def _adjust_closure(parent_id, component_id, sign):
+    """
+    Add or remove the paths through one parent -> component link: every
+    ancestor of the parent (and the parent) gains or loses
+    paths(ancestor, parent) * paths(component, descendant) paths to every
+    descendant of the component (and the component).
+    """
+    ancestors = {parent_id: 1}
+    ancestors.update(FormulationClosure.objects.filter(descendant_id=parent_id).values_list('ancestor_id', 'paths'))
+    descendants = {component_id: 1}
+    descendants.update(FormulationClosure.objects.filter(ancestor_id=component_id).values_list('descendant_id', 'paths'))
+
+    existing = {
+        (row.ancestor_id, row.descendant_id): row
+        for row in FormulationClosure.objects.filter(ancestor_id__in=ancestors, descendant_id__in=descendants)
+    }
+    created, updated, emptied = [], [], []
+    for ancestor_id, up in ancestors.items():
+        for descendant_id, down in descendants.items():
+            delta = sign * up * down
+            row = existing.get((ancestor_id, descendant_id))
+            if row is None:
+                if delta > 0:
+                    created.append(FormulationClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, paths=delta))
+            elif row.paths + delta > 0:
+                row.paths += delta
+                updated.append(row)
+            else:
+                emptied.append(row.pk)
+
+    FormulationClosure.objects.bulk_create(created)
+    FormulationClosure.objects.bulk_update(updated, ['paths'])
+    FormulationClosure.objects.filter(pk__in=emptied).delete()
+
+
+def rebuild_closure():
+    """Recompute the whole closure table from FormulationComponent."""
+    children = {}
+    for parent_id, component_id in FormulationComponent.objects.values_list('parent_id', 'component_id'):
+        children.setdefault(parent_id, []).append(component_id)
+
+    paths = {}
+
+    def reach(formulation_id):
+        # {descendant: number of paths} below one formulation
+        if formulation_id not in paths:
+            counts = {}
+            for child_id in children.get(formulation_id, ()):
+                counts[child_id] = counts.get(child_id, 0) + 1
+                for descendant_id, n in reach(child_id).items():
+                    counts[descendant_id] = counts.get(descendant_id, 0) + n
+            paths[formulation_id] = counts
+        return paths[formulation_id]
+
+    with transaction.atomic():
+        FormulationClosure.objects.all().delete()
+        FormulationClosure.objects.bulk_create([
+            FormulationClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, paths=n)
+            for ancestor_id in children
+            for descendant_id, n in reach(ancestor_id).items()
+        ], batch_size=1000)
+        return FormulationClosure.objects.count()
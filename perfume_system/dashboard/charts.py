@@ -0,0 +1,133 @@
+"""
+Plotly chart builders for the dashboard and reports pages.
+
+Kept out of views.py so Plotly is only imported the first time a chart is
+rendered, not at worker start-up or by every management command.
+"""
+import plotly.graph_objects as go
+
+
+def dashboard_charts(compliance_counts, stock_data):
+    """Build the compliance pie and stock bar charts as embeddable HTML."""
+    compliance_fig = go.Figure(data=[
+        go.Pie(
+            labels=['Compliant', 'Non-Compliant', 'Pending'],
+            values=compliance_counts,
+            hole=.3,
+            marker_colors=['#22c55e', '#ef4444', '#f59e0b'],  # Green, Red, Yellow
+            textinfo='percent+label'
+        )
+    ])
+    
+    compliance_fig.update_layout(
+        showlegend=True,
+        margin=dict(t=0, b=0, l=0, r=0),
+        height=300,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+    )
+
+    return (
+        compliance_fig.to_html(
+            full_html=False,
+            config={'displayModeBar': False}
+        ),
+        stock_chart(stock_data),
+    )
+
+
+def stock_chart(stock_data, height=300):
+    """
+    Stock vs. reorder threshold for one page of ranked ingredients (see
+    stock_levels.stock_chart_data); the rest of the catalog is summarised
+    in a single annotation rather than plotted.
+    """
+    ingredients = stock_data['ingredients']
+    names = [ing['name'] for ing in ingredients]
+
+    stock_fig = go.Figure()
+    
+    # Add current stock bars
+    stock_fig.add_trace(go.Bar(
+        name='Current Stock',
+        x=names,
+        y=[ing['current_stock'] for ing in ingredients],
+        marker_color=['#ef4444' if ing['low_stock'] else '#3b82f6' for ing in ingredients]
+    ))
+
+    # Add threshold markers
+    stock_fig.add_trace(go.Scatter(
+        name='Reorder Threshold',
+        x=names,
+        y=[ing['reorder_threshold'] for ing in ingredients],
+        mode='markers',
+        marker=dict(color='#111827', symbol='line-ew-open', size=18, line=dict(width=2))
+    ))
+
+    others = stock_data['others']
+    if others['count']:
+        stock_fig.add_annotation(
+            text=f"+ {others['count']} other ingredients ({others['below_threshold']} below threshold)",
+            xref='paper', yref='paper', x=1, y=1, showarrow=False,
+            font=dict(size=11, color='#6b7280'), xanchor='right', yanchor='bottom'
+        )
+
+    stock_fig.update_layout(
+        barmode='group',
+        margin=dict(t=20, b=0, l=0, r=0),
+        height=height,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        yaxis=dict(
+            gridcolor='rgba(0,0,0,0.1)',
+            zerolinecolor='rgba(0,0,0,0.2)'
+        ),
+        showlegend=True
+    )
+
+    return stock_fig.to_html(full_html=False, config={'displayModeBar': False})
+
+
+def reports_charts(months, counts, top_ingredients):
+    """Build the formulation trend and ingredient usage charts as embeddable HTML."""
+    # Create Trend Chart
+    trend_fig = go.Figure()
+    trend_fig.add_trace(go.Scatter(
+        x=months,
+        y=counts,
+        mode='lines+markers',
+        name='Formulations',
+        line=dict(color='#8b5cf6', width=3),
+        marker=dict(size=8)
+    ))
+    
+    trend_fig.update_layout(
+        margin=dict(t=0, b=0, l=0, r=0),
+        height=250,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        yaxis=dict(gridcolor='rgba(0,0,0,0.1)'),
+        showlegend=False
+    )
+
+    # Ingredient Usage Chart
+    usage_fig = go.Figure()
+    usage_fig.add_trace(go.Bar(
+        x=[i['ingredient__name'] for i in top_ingredients],
+        y=[float(i['total_usage']) for i in top_ingredients],
+        marker_color='#3b82f6'
+    ))
+    
+    usage_fig.update_layout(
+        margin=dict(t=0, b=0, l=0, r=0),
+        height=250,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        yaxis=dict(gridcolor='rgba(0,0,0,0.1)'),
+        showlegend=False
+    )
+
+    return (
+        trend_fig.to_html(full_html=False, config={'displayModeBar': False}),
+        usage_fig.to_html(full_html=False, config={'displayModeBar': False}),
+    )
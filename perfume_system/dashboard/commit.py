@@ -0,0 +1,33 @@
+"""
+Work deferred until the current transaction commits, once per transaction.
+
+Signal handlers run per row, so a transaction writing many rows would
+otherwise register the same commit callback once for each of them.
+`deferred(run, keys)` instead merges the keys of every call with the same
+`run` into one pending callback, which calls `run(keys)` a single time on
+commit. Outside a transaction it runs straight away, like on_commit().
+"""
+from django.db import transaction
+
+
+class _Batch:
+    def __init__(self, run, keys):
+        self.run = run
+        self.keys = set(keys)
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        self.run(self.keys)
+
+
+def deferred(run, keys):
+    """Call run(keys) on commit, together with the keys of the transaction's other calls for `run`."""
+    for _, callback, *_ in transaction.get_connection().run_on_commit:
+        # A batch that already ran (captureOnCommitCallbacks() runs them in
+        # tests without clearing them) cannot take more keys
+        if isinstance(callback, _Batch) and callback.run is run and not callback.done:
+            callback.keys.update(keys)
+            return
+    # Registered after the keys are in place: outside a transaction it runs now
+    transaction.on_commit(_Batch(run, keys))
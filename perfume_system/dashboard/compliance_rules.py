@@ -0,0 +1,95 @@
+"""
+Evaluation of compliance rules against exploded compositions.
+
+A rule limits one ingredient, or a whole category of ingredients, by
+absolute quantity and/or by concentration (percent of the formulation
+total). Concentrations need each formulation's total, and category limits
+need the total per (formulation, category). One query over
+ExplodedIngredient computes both with window functions, joins in each
+row's ingredient and category rule, and returns only the rows that break
+a limit. The same query checks a single formulation or a whole batch.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Window
+from django.db.models.functions import NullIf
+
+from .models import ComplianceRule, ExplodedIngredient
+
+Violation = namedtuple('Violation', 'formulation_id ingredient_id description')
+
+SHARE_FIELD = DecimalField(max_digits=12, decimal_places=6)
+
+
+def _share(part, whole):
+    return ExpressionWrapper(F(part) * Decimal('100') / NullIf(F(whole), Decimal('0')), output_field=SHARE_FIELD)
+
+
+def _rows(formulation_ids):
+    category_rules = ComplianceRule.objects.filter(ingredient__isnull=True,
+                                                   category=OuterRef('ingredient__category'))
+    return (
+        ExplodedIngredient.objects
+        .filter(formulation_id__in=formulation_ids)
+        .annotate(
+            total=Window(Sum('quantity'), partition_by=[F('formulation_id')]),
+            category_total=Window(Sum('quantity'), partition_by=[F('formulation_id'), F('ingredient__category')]),
+            max_quantity=F('ingredient__compliancerule__max_quantity'),
+            max_concentration=F('ingredient__compliancerule__max_concentration'),
+            category_max_quantity=Subquery(category_rules.values('max_quantity')[:1]),
+            category_max_concentration=Subquery(category_rules.values('max_concentration')[:1]),
+        )
+        .annotate(share=_share('quantity', 'total'), category_share=_share('category_total', 'total'))
+        # Applied after the window functions, so totals still cover every row
+        .filter(
+            Q(quantity__gt=F('max_quantity'))
+            | Q(share__gt=F('max_concentration'))
+            | Q(category_total__gt=F('category_max_quantity'))
+            | Q(category_share__gt=F('category_max_concentration'))
+        )
+        .values(
+            'formulation_id', 'ingredient_id', 'ingredient__category', 'quantity', 'share',
+            'category_total', 'category_share', 'max_quantity', 'max_concentration',
+            'category_max_quantity', 'category_max_concentration',
+        )
+    )
+
+
+def violations(formulation_ids):
+    """
+    {formulation_id: [Violation]} for formulations breaking any rule; the
+    others are absent. A category violation is reported once, against the
+    category's largest ingredient in that formulation. Reads the stored
+    explosions; callers rebuild invalid ones first.
+    """
+    found = {}
+    category_rows = {}
+    for row in _rows(formulation_ids):
+        formulation_id, ingredient_id = row['formulation_id'], row['ingredient_id']
+        if row['max_quantity'] is not None and row['quantity'] > row['max_quantity']:
+            found.setdefault(formulation_id, []).append(Violation(
+                formulation_id, ingredient_id, f"Quantity exceeds maximum allowed ({row['max_quantity']})"
+            ))
+        if row['max_concentration'] is not None and row['share'] > row['max_concentration']:
+            found.setdefault(formulation_id, []).append(Violation(
+                formulation_id, ingredient_id,
+                f"Concentration {row['share']:.2f}% exceeds maximum allowed ({row['max_concentration']}%)"
+            ))
+        key = (formulation_id, row['ingredient__category'])
+        if key not in category_rows or row['quantity'] > category_rows[key]['quantity']:
+            category_rows[key] = row
+
+    for (formulation_id, category), row in category_rows.items():
+        if row['category_max_quantity'] is not None and row['category_total'] > row['category_max_quantity']:
+            found.setdefault(formulation_id, []).append(Violation(
+                formulation_id, row['ingredient_id'],
+                f"Category {category} total exceeds maximum allowed ({row['category_max_quantity']})"
+            ))
+        if row['category_max_concentration'] is not None and row['category_share'] > row['category_max_concentration']:
+            found.setdefault(formulation_id, []).append(Violation(
+                formulation_id, row['ingredient_id'],
+                f"Category {category} concentration {row['category_share']:.2f}% exceeds "
+                f"maximum allowed ({row['category_max_concentration']}%)"
+            ))
+    return found
@@ -0,0 +1,113 @@
+"""
+In-memory formulation x ingredient composition matrix.
+
+The matrix is held as sparse COO arrays (formulation id, ingredient id,
+quantity) sorted by formulation id, loaded once per process and refreshed
+incrementally: every write to a formulation's ingredients or accords
+appends the ids of the formulations whose composition changed to the
+CompositionChange log (see signals.py), and the next reader re-fetches
+only those formulations. Quantities are the stored exploded raw-ingredient
+quantities from bom.py, so accords are accounted for; reading them never
+rebuilds anything.
+"""
+import threading
+
+import numpy as np
+from django.db.models import Max
+
+from . import metrics
+from .models import CompositionChange, ExplodedIngredient
+from .signals import CHANGE_LOG_LENGTH
+
+
+def changes_since(seq, latest=None):
+    """
+    (latest sequence number, ids of formulations changed after `seq` up to
+    `latest`, which defaults to the end of the log). The ids are None when
+    they cannot be known, because `seq` is unset, ahead of the log or older
+    than its pruned entries; the caller must reload.
+    """
+    if latest is None:
+        latest = CompositionChange.objects.aggregate(seq=Max('pk'))['seq'] or 0
+    if seq is None or latest < seq or latest - seq > CHANGE_LOG_LENGTH:
+        return latest, None
+    if latest == seq:
+        return latest, set()
+    changes = list(
+        CompositionChange.objects.filter(pk__gt=seq, pk__lte=latest).values_list('formulation_id', flat=True)
+    )
+    if len(changes) < latest - seq:
+        # Part of the range was pruned (or never committed); we cannot
+        # know what was missed
+        return latest, None
+    return latest, set(changes)
+
+
+class CompositionMatrix:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = None
+        self.formulation_ids = np.empty(0, dtype=np.int64)
+        self.ingredient_ids = np.empty(0, dtype=np.int64)
+        self.quantities = np.empty(0, dtype=np.float64)
+
+    def snapshot(self):
+        """
+        Return up-to-date (formulation_ids, ingredient_ids, quantities) arrays.
+        The arrays are replaced, never mutated, so callers may keep them.
+        """
+        return self.versioned_snapshot()[1]
+
+    def versioned_snapshot(self):
+        """
+        (change log sequence number, snapshot()) so that derived structures
+        can apply the same changes (see similarity.py).
+        """
+        with self._lock:
+            seq, changed = changes_since(self._seq)
+            metrics.cache_requests.inc('composition_matrix', 'hit' if seq == self._seq else 'miss')
+            if changed is None:
+                self._load()
+            elif changed:
+                self._refresh(changed)
+            self._seq = seq
+            return seq, (self.formulation_ids, self.ingredient_ids, self.quantities)
+
+    def invalidate(self):
+        """Force a full reload on next access (e.g. after bulk writes)."""
+        with self._lock:
+            self._seq = None
+
+    def _load(self):
+        rows = ExplodedIngredient.objects.order_by('formulation_id').values_list(
+            'formulation_id', 'ingredient_id', 'quantity'
+        )
+        self.formulation_ids, self.ingredient_ids, self.quantities = _to_arrays(rows)
+
+    def _refresh(self, formulation_ids):
+        ids = np.fromiter(formulation_ids, dtype=np.int64)
+        keep = ~np.isin(self.formulation_ids, ids)
+        rows = ExplodedIngredient.objects.filter(formulation_id__in=formulation_ids).values_list(
+            'formulation_id', 'ingredient_id', 'quantity'
+        )
+        new_f, new_i, new_q = _to_arrays(rows)
+        f = np.concatenate([self.formulation_ids[keep], new_f])
+        order = np.argsort(f, kind='stable')
+        self.formulation_ids = f[order]
+        self.ingredient_ids = np.concatenate([self.ingredient_ids[keep], new_i])[order]
+        self.quantities = np.concatenate([self.quantities[keep], new_q])[order]
+
+
+def _to_arrays(rows):
+    rows = list(rows)
+    if not rows:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+    f, i, q = zip(*rows)
+    return (
+        np.fromiter(f, dtype=np.int64, count=len(f)),
+        np.fromiter(i, dtype=np.int64, count=len(i)),
+        np.fromiter((float(v) for v in q), dtype=np.float64, count=len(q)),
+    )
+
+
+matrix = CompositionMatrix()
@@ -0,0 +1,113 @@
+"""
+Ingredient depletion forecasting.
+
+Daily consumption per ingredient is taken from the quantities of
+formulations created over a history window, smoothed with rolling windows,
+and projected against usable stock (expired lots excluded). Results are
+precomputed (see the forecast_depletion command) and stored as
+DepletionForecast rows, so the inventory summary only reads them.
+"""
+import math
+from datetime import timedelta
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .freshness import bump
+from .lots import usable_stock
+from .models import DepletionForecast, FormulationIngredient
+
+FORECAST_FIELDS = ('daily_usage', 'days_to_stockout', 'stockout_date', 'suggested_reorder_point')
+
+
+def compute_forecasts(history_days=90, windows=(7, 30), lead_time_days=7, service_z=1.65, now=None):
+    """
+    Return {ingredient_id: forecast} where a forecast holds the daily usage
+    rate (the highest of the rolling-window means, so fast movers are not
+    averaged away), projected stockout date and a suggested reorder point
+    of lead-time demand plus safety stock.
+    """
+    now = now or timezone.now()
+    today = now.date()
+    start = today - timedelta(days=history_days - 1)
+
+    ingredients = list(usable_stock())
+    if not ingredients:
+        return {}
+    ids = np.array([row[0] for row in ingredients], dtype=np.int64)
+    stock = np.array([float(row[1]) for row in ingredients])
+    index = {pk: i for i, pk in enumerate(ids.tolist())}
+
+    usage = FormulationIngredient.objects.filter(
+        formulation__created_at__date__gte=start,
+    ).values_list('ingredient_id', 'formulation__created_at', 'quantity')
+
+    rows, days, quantities = [], [], []
+    for ingredient_id, created_at, quantity in usage.iterator(chunk_size=5000):
+        day = (timezone.localtime(created_at).date() - start).days
+        if 0 <= day < history_days:
+            rows.append(index[ingredient_id])
+            days.append(day)
+            quantities.append(float(quantity))
+
+    daily = np.zeros((len(ids), history_days))
+    np.add.at(daily, (np.array(rows, dtype=np.int64), np.array(days, dtype=np.int64)), quantities)
+
+    # Rolling-window means over the most recent days of the history
+    cumulative = np.concatenate([np.zeros((len(ids), 1)), np.cumsum(daily, axis=1)], axis=1)
+    rates = []
+    for window in windows:
+        window = min(window, history_days)
+        rates.append((cumulative[:, -1] - cumulative[:, -1 - window]) / window)
+    rate = np.max(rates, axis=0)
+
+    # Day-to-day variability over the longest window drives safety stock
+    longest = min(max(windows), history_days)
+    std = daily[:, -longest:].std(axis=1)
+    reorder_point = rate * lead_time_days + service_z * std * math.sqrt(lead_time_days)
+
+    with np.errstate(divide='ignore'):
+        days_left = np.where(rate > 0, stock / rate, np.inf)
+
+    forecasts = {}
+    for i, pk in enumerate(ids.tolist()):
+        finite = np.isfinite(days_left[i])
+        forecasts[pk] = {
+            'daily_usage': round(float(rate[i]), 2),
+            'days_to_stockout': round(float(days_left[i]), 1) if finite else None,
+            'stockout_date': today + timedelta(days=int(days_left[i])) if finite else None,
+            'suggested_reorder_point': round(float(reorder_point[i]), 2),
+        }
+    return forecasts
+
+
+def refresh_forecasts(**params):
+    """Recompute forecasts and store them for the inventory summary."""
+    data = {
+        'computed_at': timezone.now(),
+        'params': params,
+        'forecasts': compute_forecasts(**params),
+    }
+    with transaction.atomic():
+        DepletionForecast.objects.all().delete()
+        DepletionForecast.objects.bulk_create(
+            (DepletionForecast(ingredient_id=pk, computed_at=data['computed_at'], **forecast)
+             for pk, forecast in data['forecasts'].items()),
+            batch_size=1000,
+        )
+        bump('forecast')
+    return data
+
+
+def get_forecasts():
+    """Return the last precomputed forecasts, or None if never computed."""
+    forecasts, computed_at = {}, None
+    for pk, computed, *values in DepletionForecast.objects.values_list('pk', 'computed_at', *FORECAST_FIELDS):
+        forecasts[pk] = dict(zip(FORECAST_FIELDS, values))
+        computed_at = computed
+    metrics.cache_requests.inc('forecast', 'hit' if forecasts else 'miss')
+    if not forecasts:
+        return None
+    return {'computed_at': computed_at, 'forecasts': forecasts}
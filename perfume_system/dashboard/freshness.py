@@ -0,0 +1,140 @@
+"""
+Conditional GET for the HTML views.
+
+Each data scope ('formulation', 'ingredient', ...) has a version counter
+in the cache, bumped by signals.py after every committed write (and
+explicitly by code paths that bypass signals, such as queryset.update()).
+`conditional()` builds the ETag from the versions of the scopes a view
+reads plus the page and who is asking, so a repeat visit to an unchanged
+page is answered with 304 before the view body runs. There is no
+Last-Modified: a date cannot say who the copy was rendered for.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from . import metrics
+from .commit import deferred
+
+VERSION_KEY = 'freshness:version:{}'
+
+
+def bump(*scopes):
+    """Mark scopes as changed once the current transaction commits."""
+    # Once per scope and transaction, however many rows it writes
+    deferred(_bump, scopes)
+
+
+def _bump(scopes):
+    for scope in scopes:
+        key = VERSION_KEY.format(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            _seed(scope)
+            cache.incr(key)
+
+
+def _seed(scope):
+    # Start from the clock rather than 0 so a cleared cache never reissues
+    # a version (and so an ETag) a client may still hold
+    cache.add(VERSION_KEY.format(scope), time.time_ns(), None)
+
+
+def versions(scopes):
+    """{scope: version} for the given scopes, in one cache round trip."""
+    values = cache.get_many([VERSION_KEY.format(scope) for scope in scopes])
+    result = {}
+    for scope in scopes:
+        key = VERSION_KEY.format(scope)
+        if key not in values:
+            metrics.cache_requests.inc('freshness', 'miss')
+            _seed(scope)
+            values[key] = cache.get(key)
+        else:
+            metrics.cache_requests.inc('freshness', 'hit')
+        result[scope] = values[key]
+    return result
+
+
+def conditional(*scopes, daily=False):
+    """
+    Answer GET/HEAD with 304 when none of `scopes` changed since the
+    client's copy. The ETag also covers the path with its query string, the
+    user, their roles and CSRF cookie, since pages embed all of them.
+    `daily` views also depend on the date (which lots have expired), which
+    no write bumps, so their copies go stale at midnight too. Works on sync
+    and async views.
+    """
+    def decorator(view_func):
+        def prepare(request):
+            """An etag callable when the request can be answered conditionally."""
+            # Pending flash messages would be lost on a 304
+            if (request.method not in ('GET', 'HEAD') or not request.user.is_authenticated
+                    or len(get_messages(request))):
+                return None
+
+            current = versions(scopes)
+            today = timezone.localdate() if daily else None
+            roles = sorted(request.user.roles.values_list('name', flat=True))
+
+            def etag():
+                fingerprint = '|'.join([
+                    view_func.__name__,
+                    request.get_full_path(),
+                    str(request.user.pk),
+                    ','.join(roles),
+                    # Set by CsrfViewMiddleware from the cookie, or by the
+                    # view when it issues a new token
+                    request.META.get('CSRF_COOKIE', ''),
+                    *(f'{scope}:{current[scope]}' for scope in scopes),
+                    today.isoformat() if daily else '',
+                ])
+                return f'"{hashlib.sha1(fingerprint.encode()).hexdigest()}"'
+
+            return etag
+
+        def not_modified(request, etag):
+            # ETag only: If-Modified-Since alone would answer 304 for any
+            # user or page that shares the scopes
+            response = get_conditional_response(request, etag=etag())
+            metrics.cache_requests.inc('conditional_get', 'miss' if response is None else 'hit')
+            return response
+
+        def finish(response, etag, rendered):
+            if rendered:
+                if response.status_code != 200 or response.streaming:
+                    return response
+                response.headers.setdefault('ETag', etag())
+            # Always revalidate; never store in shared caches
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def wrapped(request, *args, **kwargs):
+                etag = await sync_to_async(prepare)(request)
+                if etag is None:
+                    return await view_func(request, *args, **kwargs)
+                response = not_modified(request, etag)
+                if response is None:
+                    return finish(await view_func(request, *args, **kwargs), etag, rendered=True)
+                return finish(response, etag, rendered=False)
+        else:
+            @wraps(view_func)
+            def wrapped(request, *args, **kwargs):
+                etag = prepare(request)
+                if etag is None:
+                    return view_func(request, *args, **kwargs)
+                response = not_modified(request, etag)
+                if response is None:
+                    return finish(view_func(request, *args, **kwargs), etag, rendered=True)
+                return finish(response, etag, rendered=False)
+        return wrapped
+    return decorator
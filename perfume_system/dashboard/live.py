@@ -0,0 +1,126 @@
+"""
+Live dashboard updates over server-sent events.
+
+A per-process hub recomputes the dashboard stats once per change (debounced)
+and fans the resulting delta out to every connected stream, so N open
+dashboards cost one computation. Changes made in other processes are picked
+up by a periodic refresh while anyone is connected.
+"""
+import asyncio
+import json
+import threading
+
+from django.db import connection
+from django.db.models import F
+
+from .models import ComplianceIssue, Formulation, Ingredient
+
+# Coalesce bursts of writes into one recomputation
+DEBOUNCE_SECONDS = 0.5
+# Keep-alive and cross-process refresh interval for open streams
+HEARTBEAT_SECONDS = 15
+LOW_STOCK_LIMIT = 10
+
+
+def dashboard_stats():
+    """The figures shown on the manager dashboard."""
+    low_stock = Ingredient.objects.filter(current_stock__lte=F('reorder_threshold'))
+    return {
+        'total_formulations': Formulation.objects.count(),
+        'compliance_issues_count': ComplianceIssue.objects.filter(status='open').count(),
+        'approved_formulations': Formulation.objects.filter(status='approved').count(),
+        'pending_qa': Formulation.objects.filter(status='pending_qa').count(),
+        'low_stock_count': low_stock.count(),
+        'low_stock': [
+            {'id': pk, 'name': name, 'current_stock': str(stock), 'reorder_threshold': str(threshold)}
+            for pk, name, stock, threshold in low_stock.order_by('current_stock').values_list(
+                'pk', 'name', 'current_stock', 'reorder_threshold'
+            )[:LOW_STOCK_LIMIT]
+        ],
+    }
+
+
+class LiveHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._timer = None
+        self.snapshot = None
+
+    def subscribe(self):
+        """Register a stream; returns (queue, current full snapshot)."""
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.add((loop, queue))
+            snapshot = self.snapshot
+        return queue, snapshot
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._subscribers = {(loop, q) for loop, q in self._subscribers if q is not queue}
+            if not self._subscribers:
+                # Nobody tracks changes any more, so the snapshot would go stale
+                self.snapshot = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def notify(self):
+        """A watched model changed; schedule one recomputation if anyone listens."""
+        with self._lock:
+            if not self._subscribers or self._timer is not None:
+                return
+            self._timer = threading.Timer(DEBOUNCE_SECONDS, self.refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def refresh(self):
+        """Recompute the stats and broadcast whatever changed."""
+        with self._lock:
+            self._timer = None
+        try:
+            stats = dashboard_stats()
+        finally:
+            # Runs in short-lived worker threads; don't leak their connections
+            connection.close()
+
+        with self._lock:
+            previous = self.snapshot or {}
+            self.snapshot = stats
+            delta = {key: value for key, value in stats.items() if previous.get(key) != value}
+            subscribers = list(self._subscribers)
+        if not delta:
+            return
+        message = format_event('stats', delta)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+hub = LiveHub()
+
+
+async def event_stream():
+    """Yield SSE messages for one client until it disconnects."""
+    queue, snapshot = hub.subscribe()
+    try:
+        if snapshot is None:
+            # First subscriber in this process: compute the baseline off the
+            # loop; the refresh broadcasts it to this stream's queue
+            await asyncio.to_thread(hub.refresh)
+        else:
+            yield format_event('stats', snapshot)
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Catch changes made by other processes, then keep the connection open
+                hub.notify()
+                yield ': keep-alive\n\n'
+    finally:
+        hub.unsubscribe(queue)
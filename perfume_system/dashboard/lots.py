@@ -0,0 +1,268 @@
+"""
+Ingredient lots and first-expiry-first-out (FEFO) stock allocation.
+
+Stock is held in IngredientLot rows. Ingredient.current_stock is their sum,
+rewritten by refresh_stock() in one UPDATE whenever lots change. allocate()
+draws a formulation's requirements from the unexpired lots expiring first;
+lots without an expiry go last, and older receipts go first among equals.
+
+The candidate lots of every required ingredient come from one locked query
+on the partial FEFO index. Each ingredient's lots are then ordered with a
+heap: heapify is linear, and only the lots actually drawn are popped. The
+lot quantities, the LotAllocation records and the new aggregates are then
+written with one statement each, however many ingredients and lots are
+involved. release() puts allocated stock back into the lots it came from.
+
+Stock recorded before lots were tracked has no lots behind it. Every
+function here that writes lots first calls track(), which moves such stock
+into an opening lot, so it is neither lost from current_stock nor
+unavailable to allocate().
+"""
+import heapq
+from datetime import date
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, DecimalField, Exists, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import audit, freshness
+from .models import Ingredient, IngredientLot, LotAllocation
+
+# Sorts after every real expiry date
+NO_EXPIRY = date.max
+STOCK_FIELD = DecimalField(max_digits=10, decimal_places=2)
+
+
+def track(ingredient_ids):
+    """
+    Give each of these ingredients that has stock but no lots yet an
+    opening lot (no expiry) holding that stock. Call before writing lots.
+    """
+    with transaction.atomic():
+        # Locked so concurrent first writers cannot both open the same stock
+        locked = list(
+            Ingredient.objects.select_for_update().filter(pk__in=ingredient_ids).values_list('pk', flat=True)
+        )
+        untracked = (
+            Ingredient.objects.filter(pk__in=locked, current_stock__gt=0)
+            .exclude(Exists(IngredientLot.objects.filter(ingredient=OuterRef('pk'))))
+            .values_list('pk', 'current_stock')
+        )
+        IngredientLot.objects.bulk_create(
+            IngredientLot(ingredient_id=ingredient_id, quantity=stock, lot_number='opening')
+            for ingredient_id, stock in untracked
+        )
+
+
+def refresh_stock(ingredient_ids):
+    """Recompute current_stock of these ingredients from their lots."""
+    totals = (
+        IngredientLot.objects.filter(ingredient=OuterRef('pk'))
+        .order_by().values('ingredient').annotate(total=Sum('quantity')).values('total')
+    )
+    Ingredient.objects.filter(pk__in=ingredient_ids).update(
+        current_stock=Coalesce(Subquery(totals), Value(Decimal('0')), output_field=STOCK_FIELD),
+        updated_at=timezone.now(),
+    )
+    # update() sends no post_save, whose handlers would have done this
+    from .signals import notify_dashboard_change
+    freshness.bump('ingredient')
+    notify_dashboard_change()
+
+
+def _unexpired():
+    return Q(expires_at__isnull=True) | Q(expires_at__gte=timezone.localdate())
+
+
+def usable_stock(ingredients=None):
+    """
+    (ingredient_id, quantity) pairs of the stock allocate() can draw on:
+    the unexpired lots, or current_stock for ingredients not yet tracked.
+    """
+    lots = IngredientLot.objects.filter(ingredient=OuterRef('pk'))
+    unexpired = lots.filter(_unexpired()).order_by().values('ingredient').annotate(total=Sum('quantity')).values('total')
+    return (ingredients if ingredients is not None else Ingredient.objects.all()).annotate(
+        usable=Case(
+            When(~Exists(lots), then=F('current_stock')),
+            default=Coalesce(Subquery(unexpired), Value(Decimal('0')), output_field=STOCK_FIELD),
+            output_field=STOCK_FIELD,
+        )
+    ).values_list('pk', 'usable')
+
+
+def _draw(required, include_expired=False):
+    """
+    [(lot, quantity taken)] covering `required` ({ingredient_id: quantity})
+    first-expiry-first-out. The lots are locked until the transaction ends
+    and their quantities reduced in memory only. Raises ValidationError
+    for the first ingredient that falls short.
+    """
+    track(required)
+    lots = IngredientLot.objects.select_for_update().filter(ingredient_id__in=required, quantity__gt=0)
+    if not include_expired:
+        lots = lots.filter(_unexpired())
+    heaps = {}
+    for lot in lots.only('pk', 'ingredient_id', 'quantity', 'expires_at', 'received_at'):
+        # The pk is unique, so lots themselves are never compared
+        heaps.setdefault(lot.ingredient_id, []).append((lot.expires_at or NO_EXPIRY, lot.received_at, lot.pk, lot))
+
+    draws = []
+    for ingredient_id, needed in required.items():
+        heap = heaps.get(ingredient_id, [])
+        available = sum(entry[-1].quantity for entry in heap)
+        if available < needed:
+            name = Ingredient.objects.values_list('name', flat=True).get(pk=ingredient_id)
+            raise ValidationError(f'Not enough stock for {name}. Required: {needed}, Available: {available}')
+        heapq.heapify(heap)
+        while needed > 0:
+            lot = heapq.heappop(heap)[-1]
+            taken = min(lot.quantity, needed)
+            lot.quantity -= taken
+            needed -= taken
+            draws.append((lot, taken))
+    return draws
+
+
+def _record(action, quantities, user, per_ingredient=None, **details):
+    """
+    Audit one stock movement per ingredient; audit.record() holds the events
+    until the transaction commits. `per_ingredient` is {detail: {id: value}}.
+    """
+    for ingredient_id, quantity in quantities.items():
+        extra = {key: values[ingredient_id] for key, values in (per_ingredient or {}).items()}
+        audit.record(action, None, user, object_type='ingredient', object_id=ingredient_id,
+                     quantity=quantity, **extra, **details)
+
+
+def _lots_by_ingredient(draws):
+    lots = {}
+    for lot, taken in draws:
+        lots.setdefault(lot.ingredient_id, []).append([lot.pk, str(taken)])
+    return lots
+
+
+def allocate(required, formulation, user=None, **details):
+    """
+    Deduct `required` ({ingredient_id: quantity}) from stock for a
+    formulation, FEFO across lots; all or nothing. Returns the draws.
+    """
+    required = {ingredient_id: quantity for ingredient_id, quantity in required.items() if quantity > 0}
+    if not required:
+        return []
+    with transaction.atomic():
+        draws = _draw(required)
+        IngredientLot.objects.bulk_update([lot for lot, _ in draws], ['quantity'])
+        LotAllocation.objects.bulk_create(
+            LotAllocation(formulation=formulation, lot=lot, quantity=taken) for lot, taken in draws
+        )
+        refresh_stock(required)
+
+        _record('stock_deducted', required, user, {'lots': _lots_by_ingredient(draws)},
+                formulation_id=formulation.pk, **details)
+    return draws
+
+
+def release(formulation, user=None, expected=None):
+    """
+    Return everything allocated to a formulation to the lots it came from.
+    `expected` ({ingredient_id: quantity}) is what the formulation should
+    give back; any part without an allocation (stock deducted before lots
+    were tracked) goes into a new lot.
+    """
+    allocations = LotAllocation.objects.filter(formulation=formulation)
+    with transaction.atomic():
+        if expected:
+            track(expected)
+        returned = {}
+        for ingredient_id, quantity in (
+            allocations.order_by().values('lot__ingredient_id').annotate(total=Sum('quantity'))
+            .values_list('lot__ingredient_id', 'total')
+        ):
+            returned[ingredient_id] = quantity
+        if returned:
+            per_lot = (
+                allocations.filter(lot=OuterRef('pk'))
+                .order_by().values('lot').annotate(total=Sum('quantity')).values('total')
+            )
+            IngredientLot.objects.filter(pk__in=allocations.values('lot')).update(
+                quantity=F('quantity') + Subquery(per_lot, output_field=STOCK_FIELD)
+            )
+            allocations.delete()
+
+        unallocated = {
+            ingredient_id: quantity - returned.get(ingredient_id, 0)
+            for ingredient_id, quantity in (expected or {}).items()
+            if quantity > returned.get(ingredient_id, 0)
+        }
+        IngredientLot.objects.bulk_create(
+            IngredientLot(ingredient_id=ingredient_id, quantity=quantity, lot_number='returned')
+            for ingredient_id, quantity in unallocated.items()
+        )
+        for ingredient_id, quantity in unallocated.items():
+            returned[ingredient_id] = returned.get(ingredient_id, 0) + quantity
+        if returned:
+            refresh_stock(returned)
+            _record('stock_restored', returned, user, formulation_id=formulation.pk)
+    return returned
+
+
+def receive(ingredient, quantity, expires_at=None, lot_number='', user=None):
+    """Add a received lot and update the ingredient's stock."""
+    if quantity <= 0:
+        raise ValidationError(f'Received quantity must be positive, got {quantity}')
+    with transaction.atomic():
+        track([ingredient.pk])
+        lot = IngredientLot.objects.create(ingredient=ingredient, quantity=quantity,
+                                           expires_at=expires_at, lot_number=lot_number)
+        refresh_stock([ingredient.pk])
+    ingredient.refresh_from_db(fields=['current_stock', 'updated_at'])
+    audit.record('stock_received', ingredient, user, quantity=quantity, lot_id=lot.pk,
+                 lot_number=lot_number, expires_at=expires_at)
+    return lot
+
+
+def adjust(ingredient, new_stock, user=None):
+    """
+    Bring the ingredient's stock to a counted `new_stock`: a surplus is
+    added as a new lot, a shortfall taken from lots first-expiry-first-out,
+    expired lots included.
+    """
+    with transaction.atomic():
+        track([ingredient.pk])
+        old_stock = IngredientLot.objects.filter(ingredient=ingredient).aggregate(
+            total=Coalesce(Sum('quantity'), Value(Decimal('0')), output_field=STOCK_FIELD)
+        )['total']
+        if new_stock > old_stock:
+            IngredientLot.objects.create(ingredient=ingredient, quantity=new_stock - old_stock,
+                                         lot_number='adjustment')
+        elif new_stock < old_stock:
+            draws = _draw({ingredient.pk: old_stock - new_stock}, include_expired=True)
+            IngredientLot.objects.bulk_update([lot for lot, _ in draws], ['quantity'])
+        refresh_stock([ingredient.pk])
+    ingredient.refresh_from_db(fields=['current_stock', 'updated_at'])
+    audit.record('stock_updated', ingredient, user, old_stock=old_stock, new_stock=new_stock)
+
+
+def create_opening_lots():
+    """
+    Give stock recorded before lots were tracked a lot of its own (no
+    expiry), so current_stock equals the lot total. Returns lots created.
+    track() does this per ingredient on its first lot write; this covers
+    the whole catalog at once, including stock above a partial lot total.
+    """
+    untracked = (
+        Ingredient.objects
+        .annotate(tracked=Coalesce(Sum('lots__quantity'), Value(Decimal('0')), output_field=STOCK_FIELD))
+        .filter(current_stock__gt=F('tracked'))
+        .values_list('pk', 'current_stock', 'tracked')
+    )
+    lots = [
+        IngredientLot(ingredient_id=ingredient_id, quantity=stock - tracked, lot_number='opening')
+        for ingredient_id, stock, tracked in untracked
+    ]
+    with transaction.atomic():
+        IngredientLot.objects.bulk_create(lots)
+    return len(lots)
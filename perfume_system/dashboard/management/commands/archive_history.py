@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from dashboard import archive
+
+class Command(BaseCommand):
+    help = 'Move old rejected/superseded formulations and resolved compliance issues into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help='Only archive records untouched for this many days (defaults to ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows moved per transaction (defaults to ARCHIVE_BATCH_SIZE)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many records would be archived')
+
+    def handle(self, *args, **options):
+        before = archive.cutoff(options['older_than_days'])
+
+        if options['dry_run']:
+            self.stdout.write(
+                f"{archive.archivable_formulations(before).count()} formulation(s) and "
+                f"{archive.archivable_issues(before).count()} resolved issue(s) last updated before "
+                f"{before:%Y-%m-%d} would be archived"
+            )
+            return
+
+        formulations = archive.archive_formulations(before, options['batch_size'])
+        issues = archive.archive_issues(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {formulations} formulation(s) and {issues} resolved compliance issue(s)"
+        ))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from dashboard import lots
+
+class Command(BaseCommand):
+    help = (
+        'Put stock recorded before lot tracking into an opening lot per ingredient (no expiry), '
+        'so current_stock matches the lot totals. Safe to re-run.'
+    )
+
+    def handle(self, *args, **options):
+        created = lots.create_opening_lots()
+        self.stdout.write(self.style.SUCCESS(f"Created {created} opening lot(s)"))
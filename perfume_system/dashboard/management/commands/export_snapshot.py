@@ -0,0 +1,46 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from dashboard import snapshot
+from dashboard.bom import ensure_exploded
+
+class Command(BaseCommand):
+    help = (
+        'Export formulations, compositions, stock and compliance issues as columnar files '
+        '(Parquet when pyarrow is installed, otherwise .npz), one per table'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default=None,
+                            help='Directory to write to (defaults to SNAPSHOT_DIR)')
+        parser.add_argument('--format', choices=snapshot.FORMATS, default=None,
+                            help='File format (defaults to parquet if pyarrow is installed, else npz)')
+        parser.add_argument('--table', action='append', choices=list(snapshot.TABLES), dest='tables',
+                            help='Table to export; repeat for several (defaults to all)')
+        parser.add_argument('--chunk-size', type=int, default=snapshot.DEFAULT_CHUNK_SIZE,
+                            help='Rows fetched and written per chunk (a Parquet row group)')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or snapshot.default_format()
+        if fmt == 'parquet' and snapshot.default_format() != 'parquet':
+            raise CommandError('Parquet export needs pyarrow; install it or use --format npz')
+        directory = options['output_dir'] or settings.SNAPSHOT_DIR
+        os.makedirs(directory, exist_ok=True)
+        # The compositions table reads stored explosions
+        ensure_exploded()
+
+        for table in options['tables'] or snapshot.TABLES:
+            path = os.path.join(directory, snapshot.filename(table, fmt))
+            # Written aside and renamed, so readers never see a partial file
+            partial = f'{path}.partial'
+            try:
+                rows = snapshot.export(table, partial, fmt, options['chunk_size'])
+                os.replace(partial, path)
+            finally:
+                # Left behind only when the export failed
+                if os.path.exists(partial):
+                    os.remove(partial)
+            self.stdout.write(f"{table}: {rows} row(s) -> {path}")
+
+        self.stdout.write(self.style.SUCCESS(f"Snapshot written to {directory}"))
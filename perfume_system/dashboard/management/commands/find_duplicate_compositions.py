@@ -0,0 +1,59 @@
+from itertools import groupby
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from dashboard.freshness import bump
+from dashboard.bom import ensure_exploded
+from dashboard.models import Formulation
+
+class Command(BaseCommand):
+    help = 'Report clusters of formulations with identical compositions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rehash', action='store_true',
+                            help='Recompute every composition hash, not only missing ones')
+
+    def handle(self, *args, **options):
+        hashed = self.hash_compositions(options['rehash'])
+        if hashed:
+            self.stdout.write(f"Updated {hashed} composition hash(es)")
+
+        clusters = (
+            Formulation.objects.exclude(composition_hash='')
+            .values('composition_hash')
+            .annotate(size=Count('pk'))
+            .filter(size__gt=1)
+            .order_by('-size')
+        )
+        hashes = [cluster['composition_hash'] for cluster in clusters]
+        members = Formulation.objects.filter(composition_hash__in=hashes).order_by('composition_hash', 'created_at')
+        by_hash = {key: list(group) for key, group in groupby(members, key=lambda f: f.composition_hash)}
+
+        for composition_hash in hashes:
+            formulations = by_hash[composition_hash]
+            self.stdout.write(f"{composition_hash[:12]}  {len(formulations)} formulations")
+            for formulation in formulations:
+                self.stdout.write(f"    #{formulation.pk} {formulation} ({formulation.get_status_display()})")
+
+        duplicates = sum(len(group) - 1 for group in by_hash.values())
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(hashes)} duplicate cluster(s), {duplicates} redundant formulation(s)"
+        ))
+
+    def hash_compositions(self, rehash):
+        """
+        Hashes are written when bom.py materializes exploded compositions,
+        so hashing means rebuilding the explosions that are missing (or,
+        with --rehash, all of them).
+        """
+        if rehash:
+            Formulation.objects.filter(bom_valid=True).update(bom_valid=False)
+        before = dict(Formulation.objects.filter(bom_valid=False).values_list('pk', 'composition_hash'))
+        if not before:
+            return 0
+        ensure_exploded()
+        after = Formulation.objects.filter(pk__in=before).values_list('pk', 'composition_hash')
+        changed = sum(1 for pk, value in after if before[pk] != value)
+        if changed:
+            bump('formulation')
+        return changed
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from dashboard import rule_import
+
+class Command(BaseCommand):
+    help = (
+        'Create or update compliance rules from a regulatory limit list (CSV with columns '
+        'ingredient or category, max_quantity and/or max_concentration[, description], or a '
+        'JSON list of the same keys). '
+        'Safe to re-run: unchanged rules are not written.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to the CSV or JSON file')
+        parser.add_argument('--format', choices=rule_import.FORMATS, default=None,
+                            help='File format (defaults to the file extension)')
+        parser.add_argument('--chunk-size', type=int, default=rule_import.DEFAULT_CHUNK_SIZE,
+                            help='Rules upserted per statement')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+        parser.add_argument('--recheck', action='store_true',
+                            help='Re-check compliance of formulations using ingredients whose limit changed')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or rule_import.format_for(options['path'])
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as stream:
+                result = rule_import.import_rules(rule_import.read_rows(stream, fmt),
+                                                  options['chunk_size'], options['dry_run'])
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['path']}: {e}")
+        except ValueError as e:
+            raise CommandError(f"Cannot parse {options['path']}: {e}")
+
+        for line, name in result.unknown:
+            self.stderr.write(f"Line {line}: unknown ingredient {name!r}; skipped")
+        for line, error in result.invalid:
+            self.stderr.write(f"Line {line}: {error}; skipped")
+        for name, limits in result.created:
+            self.stdout.write(f"+ {name}: {limits}")
+        for name, old, new in result.changed:
+            self.stdout.write(f"~ {name}: {old} -> {new}")
+
+        prefix = 'Would create' if options['dry_run'] else 'Created'
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {len(result.created)} rule(s), changed {len(result.changed)} limit(s) "
+            f"and {result.redescribed} description(s); {result.unchanged} unchanged, "
+            f"{result.skipped} row(s) skipped"
+        ))
+
+        if options['recheck'] and result.ingredient_ids:
+            if options['dry_run']:
+                affected = rule_import.affected_formulations(result.ingredient_ids).count()
+                self.stdout.write(f"{affected} formulation(s) would be re-checked")
+            else:
+                checked, failing = rule_import.recheck(result.ingredient_ids)
+                self.stdout.write(f"Re-checked {checked} formulation(s); {failing} non-compliant")
@@ -0,0 +1,227 @@
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import reverse
+from accounts.models import Role
+from dashboard.models import Formulation
+
+# Weighted GET scenarios per role, by URL name in dashboard/urls.py
+SCENARIOS = {
+    'rd': [
+        ('formulations', 4),
+        ('formulation_detail', 3),
+        ('inventory', 2),
+        ('compliance', 2),
+    ],
+    'qa': [
+        ('formulations', 3),
+        ('formulation_detail', 3),
+        ('qa_dashboard', 4),
+    ],
+    'manager': [
+        ('dashboard', 4),
+        ('reports', 3),
+        ('inventory_summary', 2),
+        ('inventory', 1),
+    ],
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    # Smallest value with at least pct% of the values at or below it;
+    # multiplying first keeps whole-number ranks exact
+    rank = max(math.ceil(pct * len(sorted_values) / 100) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies, statuses, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class Command(BaseCommand):
+    help = 'Drive the WSGI application in-process with concurrent logged-in sessions and report latency percentiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help='Number of concurrent client threads')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run after warmup')
+        parser.add_argument('--warmup', type=float, default=1.0, help='Seconds of unrecorded warmup traffic')
+        parser.add_argument('--roles', default='rd,qa,manager', help='Comma-separated roles to simulate')
+        parser.add_argument('--sessions', type=int, default=1, help='Logged-in sessions per role')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for the scenario mix')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        from perfume_system.wsgi import application
+
+        rng = random.Random(options['seed'])
+        roles = [r.strip() for r in options['roles'].split(',') if r.strip()]
+        unknown = set(roles) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown role(s): {', '.join(sorted(unknown))}")
+
+        paths = self.scenario_paths()
+        sessions = self.create_sessions(roles, options['sessions'])
+        connection.close()
+
+        clients = [
+            (role, session_key, [(name, paths[name]) for name, _ in SCENARIOS[role] if name in paths],
+             [weight for name, weight in SCENARIOS[role] if name in paths])
+            for role, session_key in sessions
+        ]
+
+        results = defaultdict(list)
+        statuses = defaultdict(lambda: defaultdict(int))
+        lock = threading.Lock()
+        start_at = time.perf_counter() + options['warmup']
+        stop_at = start_at + options['duration']
+
+        def worker(index):
+            local_rng = random.Random(rng.random())
+            role, session_key, urls, weights = clients[index % len(clients)]
+            local_results = defaultdict(list)
+            local_statuses = defaultdict(lambda: defaultdict(int))
+            try:
+                while True:
+                    now = time.perf_counter()
+                    if now >= stop_at:
+                        break
+                    name, path = local_rng.choices(urls, weights)[0]
+                    key = f'{role}:{name}'
+                    began = time.perf_counter()
+                    status = self.request(application, path, session_key)
+                    latency = time.perf_counter() - began
+                    if began >= start_at:
+                        local_results[key].append(latency)
+                        local_statuses[key][status] += 1
+            finally:
+                connection.close()
+            with lock:
+                for key, values in local_results.items():
+                    results[key].extend(values)
+                    for status, count in local_statuses[key].items():
+                        statuses[key][status] += count
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['threads'])]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            Session.objects.filter(session_key__in=[key for _, key in sessions]).delete()
+
+        elapsed = options['duration']
+        all_latencies = [latency for values in results.values() for latency in values]
+        all_statuses = defaultdict(int)
+        for per_url in statuses.values():
+            for status, count in per_url.items():
+                all_statuses[status] += count
+
+        report = {
+            'config': {
+                'threads': options['threads'],
+                'duration': options['duration'],
+                'warmup': options['warmup'],
+                'roles': roles,
+                'sessions_per_role': options['sessions'],
+            },
+            'total': summarize(all_latencies, all_statuses, elapsed),
+            'urls': {key: summarize(results[key], statuses[key], elapsed) for key in sorted(results)},
+        }
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def scenario_paths(self):
+        """Resolve every scenario URL name to a concrete path."""
+        names = {name for scenario in SCENARIOS.values() for name, _ in scenario}
+        sample_pks = {
+            'formulation_detail': Formulation.objects.values_list('pk', flat=True).first(),
+        }
+        paths = {}
+        for name in names:
+            if name in sample_pks:
+                if sample_pks[name] is None:
+                    self.stderr.write(self.style.WARNING(f'Skipping {name}: no rows to request'))
+                    continue
+                paths[name] = reverse(f'dashboard:{name}', args=[sample_pks[name]])
+            else:
+                paths[name] = reverse(f'dashboard:{name}')
+        return paths
+
+    def create_sessions(self, roles, per_role):
+        """Create authenticated sessions for users holding each role."""
+        sessions = []
+        for role_name in roles:
+            role = Role.objects.filter(name=role_name).first()
+            users = list(role.users.all()[:per_role]) if role else []
+            if not users:
+                raise CommandError(f"No users with role '{role_name}'")
+            for i in range(per_role):
+                user = users[i % len(users)]
+                session = SessionStore()
+                session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+                session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                session.create()
+                sessions.append((role_name, session.session_key))
+        return sessions
+
+    @staticmethod
+    def request(application, path, session_key):
+        """Issue one GET through the WSGI callable and return the status code."""
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'HTTP_HOST': 'localhost',
+            'HTTP_COOKIE': f'{settings.SESSION_COOKIE_NAME}={session_key}',
+            'wsgi.input': BytesIO(),
+        }
+        setup_testing_defaults(environ)
+        status_holder = []
+
+        def start_response(status, headers, exc_info=None):
+            status_holder.append(int(status.split(' ', 1)[0]))
+
+        body = application(environ, start_response)
+        try:
+            for _ in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return status_holder[0]
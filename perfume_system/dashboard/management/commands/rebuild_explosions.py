@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from dashboard.bom import ensure_exploded
+from dashboard.freshness import bump
+from dashboard.models import Formulation
+from dashboard.signals import publish_composition_changes
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the stored exploded compositions and composition hashes of formulations marked invalid. '
+        'Run after deploying; pages only read the stored explosions and never rebuild them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild every formulation, not only invalid ones')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            Formulation.objects.filter(bom_valid=True).update(bom_valid=False)
+        invalid = list(Formulation.objects.filter(bom_valid=False).values_list('pk', flat=True))
+        rebuilt = ensure_exploded()
+        if rebuilt:
+            # Every process, this one included, picks the new explosions up
+            # from the change log
+            publish_composition_changes(invalid)
+            bump('formulation')
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rebuilt} formulation explosion(s)"))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from dashboard.freshness import bump
+from dashboard.models import Formulation
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized summary columns on Formulation and repair any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many formulations have drifted')
+
+    def handle(self, *args, **options):
+        expressions = Formulation.summary_expressions()
+        drifted = (
+            Formulation.objects
+            .annotate(**{f'actual_{name}': expression for name, expression in expressions.items()})
+            .filter(
+                ~Q(ingredient_count=F('actual_ingredient_count'))
+                | ~Q(total_quantity=F('actual_total_quantity'))
+                | ~Q(open_issue_count=F('actual_open_issue_count'))
+            )
+            .values_list('pk', flat=True)
+        )
+        drifted_ids = list(drifted)
+        self.stdout.write(f"{len(drifted_ids)} formulation(s) with drifted summaries")
+
+        if options['dry_run'] or not drifted_ids:
+            return
+
+        with transaction.atomic():
+            updated = Formulation.objects.filter(pk__in=drifted_ids).update(**expressions)
+            bump('formulation')
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt summaries for {updated} formulation(s)"))
@@ -0,0 +1,59 @@
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a worker does on boot: configure Django and load the WSGI app and URLconf
+BOOT_SCRIPT = (
+    "import django; django.setup(); "
+    "import perfume_system.wsgi; "
+    "from django.urls import get_resolver; get_resolver().url_patterns"
+)
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+class Command(BaseCommand):
+    help = 'Measure cold-start import time in a fresh interpreter and fail if it exceeds the budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget', type=float, default=None,
+                            help='Cold-start budget in seconds (defaults to STARTUP_BUDGET_SECONDS)')
+        parser.add_argument('--top', type=int, default=20, help='Number of slowest modules to list')
+        parser.add_argument('--sort', choices=['cumulative', 'self'], default='cumulative',
+                            help='Rank modules by cumulative or self import time')
+
+    def handle(self, *args, **options):
+        budget = options['budget'] if options['budget'] is not None else settings.STARTUP_BUDGET_SECONDS
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', 'perfume_system.settings'))
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Startup failed:\n{result.stderr[-2000:]}")
+
+        modules = []
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, name = match.groups()
+                modules.append((name, int(self_us), int(cumulative_us), len(indent)))
+
+        # Top-level imports (least indented) add up to the whole boot
+        depth = min(m[3] for m in modules)
+        total = sum(m[2] for m in modules if m[3] == depth) / 1e6
+
+        key = 2 if options['sort'] == 'cumulative' else 1
+        self.stdout.write(f"{'module':<60} {'self ms':>10} {'cumul ms':>10}")
+        for name, self_us, cumulative_us, _ in sorted(modules, key=lambda m: m[key], reverse=True)[:options['top']]:
+            self.stdout.write(f"{name:<60} {self_us / 1000:>10.1f} {cumulative_us / 1000:>10.1f}")
+
+        summary = f"Cold start imported {len(modules)} modules in {total:.2f}s (budget {budget:.2f}s)"
+        if total > budget:
+            raise CommandError(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,383 @@
+"""
+Operational metrics in the Prometheus text format, served at /metrics.
+
+Counters and histograms are aggregated in process memory under one lock.
+The middleware updates them once per request, so the cost is a few dict
+updates. Gauges are read when /metrics is scraped. The module needs no
+client library and runs no extra service.
+
+With METRICS_MULTIPROC_DIR set (for several gunicorn workers), each process
+writes its totals to <dir>/<pid>.json at most every METRICS_FLUSH_INTERVAL
+seconds, when scraped and at exit. A scrape then sums the files of all
+workers. Totals of workers that have exited are kept, as counters should
+be. Per-process gauges count only workers that are still running. Empty the
+directory when the server starts.
+"""
+import atexit
+import glob
+import hmac
+import ipaddress
+import json
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_lock = threading.Lock()
+_registry = []
+_last_write = 0.0
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self, values):
+        for label_values, value in sorted(values.items()):
+            yield self.name, _labels(self.labels, label_values), value
+
+    def dump(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+    @staticmethod
+    def merge(into, dumped):
+        for key, value in dumped:
+            key = tuple(key)
+            into[key] = into.get(key, 0) + value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.buckets = buckets
+        # {label values: [count per bucket..., +Inf count, sum]}
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        with _lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def samples(self, values):
+        for label_values, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(bound)
+                yield f'{self.name}_bucket', _labels((*self.labels, 'le'), (*label_values, le)), cumulative
+            base = _labels(self.labels, label_values)
+            yield f'{self.name}_sum', base, counts[-1]
+            yield f'{self.name}_count', base, cumulative
+
+    def dump(self):
+        return [[list(key), counts] for key, counts in self.values.items()]
+
+    @staticmethod
+    def merge(into, dumped):
+        for key, counts in dumped:
+            key = tuple(key)
+            current = into.get(key)
+            into[key] = counts[:] if current is None else [a + b for a, b in zip(current, counts)]
+
+
+class Gauge:
+    """
+    A value read at scrape time from `read()`, which returns a number or
+    {label values: number}. Per-process gauges are summed across workers;
+    the others (typically database counts) are read once per scrape.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, read, labels=(), per_process=False):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.read, self.per_process = read, per_process
+        _registry.append(self)
+
+    @property
+    def values(self):
+        value = self.read()
+        return value if isinstance(value, dict) else {(): value}
+
+    def samples(self, values):
+        for label_values, value in sorted(values.items()):
+            yield self.name, _labels(self.labels, label_values), value
+
+    def dump(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+    merge = staticmethod(Counter.merge)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+# Metrics
+
+requests_total = Counter('perfume_http_requests_total', 'HTTP requests by URL name, method and status',
+                         ('view', 'method', 'status'))
+request_duration = Histogram('perfume_http_request_duration_seconds', 'Request latency by URL name', ('view',))
+db_queries = Histogram('perfume_db_queries_per_request', 'Database queries per request by URL name', ('view',),
+                       buckets=QUERY_BUCKETS)
+db_duration = Histogram('perfume_db_duration_seconds_per_request', 'Database time per request by URL name',
+                        ('view',))
+cache_requests = Counter('perfume_cache_requests_total', 'Cache lookups by cache and result (hit or miss)',
+                         ('cache', 'result'))
+stock_operations = Counter('perfume_stock_operations_total', 'Stock movements by operation', ('operation',))
+
+
+def _audit_pending():
+    from . import audit
+    return audit.pending()
+
+
+def _stream_subscribers():
+    from .live import hub
+    return hub.subscriber_count
+
+
+def _formulation_queues():
+    from .models import Formulation
+    return {
+        ('pending_qa',): Formulation.objects.filter(status='pending_qa').count(),
+        ('bom_rebuild',): Formulation.objects.filter(bom_valid=False).count(),
+    }
+
+
+Gauge('perfume_audit_events_pending', 'Audit events buffered in memory, not yet written', _audit_pending,
+      per_process=True)
+Gauge('perfume_live_stream_subscribers', 'Open dashboard live-update streams', _stream_subscribers,
+      per_process=True)
+Gauge('perfume_queue_depth', 'Formulations waiting in a work queue', _formulation_queues, ('queue',))
+
+
+def view_label(request):
+    """Metric label for a request: the URL name for dashboard views."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    if match.namespace == 'dashboard' and match.url_name:
+        return match.url_name
+    # Admin, allauth and the home redirect, kept coarse to bound cardinality
+    return match.namespace.split(':')[0] or match.url_name or 'other'
+
+
+# [query count, query seconds] of the current request. Context variables
+# follow sync_to_async() and async_views.run_queries() into worker threads,
+# so queries issued there are counted too.
+_request_db = ContextVar('metrics_request_db', default=None)
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    db = _request_db.get()
+    if db is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            db[0] += 1
+            db[1] += elapsed
+
+
+@receiver(connection_created)
+def _instrument_connection(sender, connection, **kwargs):
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+
+class MetricsMiddleware:
+    """Record latency, status and database use per request. Removed when disabled."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self._acall(request)
+        db = [0, 0.0]
+        token = _request_db.set(db)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_db.reset(token)
+        self.record(request, response, time.perf_counter() - start, db)
+        return response
+
+    async def _acall(self, request):
+        db = [0, 0.0]
+        token = _request_db.set(db)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_db.reset(token)
+        self.record(request, response, time.perf_counter() - start, db)
+        return response
+
+    @staticmethod
+    def record(request, response, elapsed, db):
+        view = view_label(request)
+        requests_total.inc(view, request.method, str(response.status_code))
+        request_duration.observe(elapsed, view)
+        db_queries.observe(db[0], view)
+        db_duration.observe(db[1], view)
+        _maybe_write()
+
+
+# Multi-process aggregation
+
+def _directory():
+    return getattr(settings, 'METRICS_MULTIPROC_DIR', '')
+
+
+def _maybe_write():
+    directory = _directory()
+    if directory and time.monotonic() - _last_write >= getattr(settings, 'METRICS_FLUSH_INTERVAL', 5.0):
+        write_process_file(directory)
+
+
+def write_process_file(directory=None):
+    """Write this process's totals to the shared directory."""
+    global _last_write
+    directory = directory or _directory()
+    if not directory:
+        return
+    with _lock:
+        _last_write = time.monotonic()
+        data = {m.name: m.dump() for m in _registry if m.kind != 'gauge'}
+    data.update({m.name: m.dump() for m in _registry if m.kind == 'gauge' and m.per_process})
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    """{metric: merged values} for this process, or across all workers."""
+    directory = _directory()
+    if not directory:
+        with _lock:
+            merged = {m: dict(m.values) for m in _registry if m.kind != 'gauge'}
+        merged.update({m: m.values for m in _registry if m.kind == 'gauge'})
+        return merged
+
+    write_process_file(directory)
+    merged = {m: {} for m in _registry}
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            pid = int(os.path.basename(path)[:-len('.json')])
+            with open(path) as f:
+                data = json.load(f)
+        except (ValueError, OSError):
+            continue
+        alive = _alive(pid)
+        for metric in _registry:
+            if metric.name in data and (metric.kind != 'gauge' or alive):
+                metric.merge(merged[metric], data[metric.name])
+    for metric in _registry:
+        if metric.kind == 'gauge' and not metric.per_process:
+            merged[metric] = metric.values
+    return merged
+
+
+def render_text():
+    lines = []
+    for metric, values in collect().items():
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in metric.samples(values))
+    return '\n'.join(lines) + '\n'
+
+
+def _allowed(request):
+    """
+    With METRICS_TOKEN set, the scraper must send it as a bearer token.
+    Otherwise the client address must be in METRICS_ALLOWED_NETWORKS, which
+    only holds when /metrics is not behind a proxy on the same host: every
+    proxied request arrives from the proxy's address.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    address = request.META.get('REMOTE_ADDR', '')
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False)
+               for network in getattr(settings, 'METRICS_ALLOWED_NETWORKS', ['127.0.0.1/32', '::1/128']))
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, guarded by METRICS_TOKEN or METRICS_ALLOWED_NETWORKS, no login."""
+    if not _allowed(request):
+        return HttpResponseForbidden('Forbidden')
+    return HttpResponse(render_text(), content_type=CONTENT_TYPE)
+
+
+atexit.register(write_process_file)
@@ -3,6 +3,31 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 from decimal import Decimal
 from django.core.exceptions import ValidationError
+from django.db.models.functions import Coalesce
+import hashlib
+
+QUANTITY_STEP = Decimal('0.01')
+
+def composition_fingerprint(pairs):
+    """
+    Canonical hash of a composition given as (ingredient_id, quantity) pairs:
+    repeated ingredients are summed, quantities rounded to the stored
+    precision, zero quantities dropped and ingredients sorted by id, so any
+    two identical compositions hash alike however they were entered.
+    Returns '' for an empty composition.
+    """
+    totals = {}
+    for ingredient_id, quantity in pairs:
+        totals[int(ingredient_id)] = totals.get(int(ingredient_id), Decimal('0')) + Decimal(str(quantity))
+    canonical = ';'.join(
+        f"{ingredient_id}:{quantity}"
+        for ingredient_id, quantity in sorted(
+            (ingredient_id, total.quantize(QUANTITY_STEP).normalize())
+            for ingredient_id, total in totals.items()
+        )
+        if quantity
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest() if canonical else ''
 
 class Formulation(models.Model):
     STATUS_CHOICES = [
@@ -22,92 +47,152 @@ class Formulation(models.Model):
     version = models.CharField(max_length=50)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='draft')
     compliance_status = models.CharField(max_length=20, choices=COMPLIANCE_STATUS, default='pending')
+    # When compliance_status was last evaluated against the rules; written
+    # only by check_compliance(), unlike updated_at
+    compliance_checked_at = models.DateTimeField(null=True, blank=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
     ingredients = models.ManyToManyField('Ingredient', through='FormulationIngredient')
 
+    # Denormalized summaries, maintained by signals.py and repaired by the
+    # rebuild_formulation_summaries command
+    ingredient_count = models.PositiveIntegerField(default=0)
+    total_quantity = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    open_issue_count = models.PositiveIntegerField(default=0)
+
+    # composition_fingerprint() of the ingredients; set by the create/edit
+    # views and refresh_composition_hash()
+    composition_hash = models.CharField(max_length=64, blank=True, db_index=True)
+
+    # Other formulations (accords) used as components of this one
+    components = models.ManyToManyField('self', through='FormulationComponent',
+                                        through_fields=('parent', 'component'),
+                                        symmetrical=False, related_name='used_by')
+    # False until bom.py has materialized this formulation's exploded
+    # ingredients, and again whenever it or any sub-formulation changes
+    bom_valid = models.BooleanField(default=False, db_index=True)
+
     class Meta:
         ordering = ['-created_at']
+        # Back the admin's default ordering, name search and status filters
+        indexes = [
+            models.Index(fields=['-created_at']),
+            models.Index(fields=['name']),
+            models.Index(fields=['status', '-created_at']),
+            models.Index(fields=['compliance_status', '-created_at']),
+        ]
 
     def __str__(self):
         return f"{self.name} - v{self.version}"
 
-    def check_compliance(self):
-        """Check compliance after all ingredients are added."""
+    def find_duplicate(self, composition_hash=None):
+        """Another formulation with the same composition, if any (an indexed lookup)."""
+        composition_hash = composition_hash if composition_hash is not None else self.composition_hash
+        if not composition_hash:
+            return None
+        return Formulation.objects.filter(composition_hash=composition_hash).exclude(pk=self.pk).first()
+
+    def refresh_composition_hash(self):
+        """Recompute composition_hash from the exploded ingredients."""
+        from .bom import explode
+        self.composition_hash = composition_fingerprint(explode(self.pk).items())
+        Formulation.objects.filter(pk=self.pk).update(composition_hash=self.composition_hash)
+
+    @classmethod
+    def summary_expressions(cls):
+        """Correlated subqueries computing each summary column from source rows."""
+        ingredients = FormulationIngredient.objects.filter(formulation=models.OuterRef('pk')).values('formulation')
+        issues = ComplianceIssue.objects.filter(formulation=models.OuterRef('pk'), status='open').values('formulation')
+        return {
+            'ingredient_count': Coalesce(
+                models.Subquery(ingredients.annotate(n=models.Count('pk')).values('n')), 0
+            ),
+            'total_quantity': Coalesce(
+                models.Subquery(ingredients.annotate(total=models.Sum('quantity')).values('total')),
+                Decimal('0'), output_field=models.DecimalField(max_digits=12, decimal_places=2)
+            ),
+            'open_issue_count': Coalesce(
+                models.Subquery(issues.annotate(n=models.Count('pk')).values('n')), 0
+            ),
+        }
+
+    def refresh_summary(self):
+        """Recompute this formulation's summary columns in one UPDATE."""
+        if not self.pk:
+            return
+        Formulation.objects.filter(pk=self.pk).update(**Formulation.summary_expressions())
+        self.refresh_from_db(fields=['ingredient_count', 'total_quantity', 'open_issue_count'])
+
+    def check_compliance(self, violations=None):
+        """
+        Check compliance after all ingredients are added. Batch callers pass
+        this formulation's entry from compliance_rules.violations().
+        """
         has_issues = False
 
         # Ensure the instance is saved before processing compliance
         if not self.pk:
             raise ValueError("Formulation instance must be saved before checking compliance.")
 
-        for formulation_ingredient in self.formulation_ingredients.all():
-            compliant, message = formulation_ingredient.check_compliance()
-            if not compliant:
-                has_issues = True
-                ComplianceIssue.objects.get_or_create(
-                    formulation=self,
-                    ingredient=formulation_ingredient.ingredient,
-                    description=message,
-                    defaults={'status': 'open'}
+        if violations is None:
+            # Compliance is checked on the write path, so the explosion and
+            # composition_hash are brought up to date first
+            from .bom import ensure_exploded
+            if ensure_exploded([self.pk]):
+                self.refresh_from_db(fields=['composition_hash'])
+
+            # An identical composition found compliant, with no rule added or
+            # changed since it was checked, is still compliant
+            if self.composition_hash:
+                twin = (
+                    Formulation.objects
+                    .filter(composition_hash=self.composition_hash, compliance_status='compliant',
+                            compliance_checked_at__isnull=False)
+                    .exclude(pk=self.pk)
+                    .order_by('-compliance_checked_at')
+                    .first()
                 )
+                if twin and not ComplianceRule.objects.filter(
+                    updated_at__gte=twin.compliance_checked_at
+                ).exists():
+                    self.compliance_status = 'compliant'
+                    # Only as current as the check it was taken from
+                    self.compliance_checked_at = twin.compliance_checked_at
+                    self.save(update_fields=['compliance_status', 'compliance_checked_at'])
+                    return True
+
+            # Checked against the exploded composition, so ingredients brought
+            # in through accords count too
+            from .compliance_rules import violations as find_violations
+            violations = find_violations([self.pk]).get(self.pk, [])
+
+        for violation in violations:
+            has_issues = True
+            ComplianceIssue.objects.get_or_create(
+                formulation=self,
+                ingredient_id=violation.ingredient_id,
+                description=violation.description,
+                defaults={'status': 'open'}
+            )
         
         self.compliance_status = 'non_compliant' if has_issues else 'compliant'
-        self.save(update_fields=['compliance_status'])
+        self.compliance_checked_at = timezone.now()
+        self.save(update_fields=['compliance_status', 'compliance_checked_at'])
         return not has_issues
 
-    def save_and_update_stock(self):
-        """Save the formulation and update ingredient stock."""
-        if not self.pk:
-            raise ValueError("Formulation instance must be saved before updating stock.")
-
-        try:
-            # Check if all ingredients have enough stock
-            for formulation_ingredient in self.formulation_ingredients.all():
-                ingredient = formulation_ingredient.ingredient
-                if ingredient.current_stock < formulation_ingredient.quantity:
-                    raise ValidationError(
-                        f'Not enough stock for {ingredient.name}. '
-                        f'Required: {formulation_ingredient.quantity}, '
-                        f'Available: {ingredient.current_stock}'
-                    )
-
-            # If we have enough stock, update the quantities
-            for formulation_ingredient in self.formulation_ingredients.all():
-                ingredient = formulation_ingredient.ingredient
-                ingredient.current_stock -= formulation_ingredient.quantity
-                ingredient.save()
-
-            # Save the formulation
-            super().save()
-            return True
-
-        except ValidationError as e:
-            raise e
-        except Exception as e:
-            raise ValidationError(f'Error updating stock: {str(e)}')
-
-    def restore_stock(self):
-        """Restore stock when a formulation is deleted or updated."""
-        if not self.pk:
-            raise ValueError("Formulation instance must be saved before restoring stock.")
-
-        try:
-            for formulation_ingredient in self.formulation_ingredients.all():
-                ingredient = formulation_ingredient.ingredient
-                ingredient.current_stock += formulation_ingredient.quantity
-                ingredient.save()
-        except Exception as e:
-            raise ValidationError(f'Error restoring stock: {str(e)}')
-
     def save(self, *args, **kwargs):
         """Ensure the formulation is valid before saving."""
         super().save(*args, **kwargs)  # Save instance to assign primary key
 
 class Ingredient(models.Model):
     name = models.CharField(max_length=200, unique=True)
+    # Sum of the ingredient's lots, maintained by lots.py; change stock
+    # through lots.receive()/allocate()/adjust(), not by assigning this
     current_stock = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     reorder_threshold = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Regulatory group (e.g. "allergen"), limited as a whole by category rules
+    category = models.CharField(max_length=100, blank=True, db_index=True)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -132,22 +217,141 @@ class FormulationIngredient(models.Model):
         return f"{self.ingredient.name} ({self.quantity})"
 
     def check_compliance(self):
+        """Absolute limit only; concentration and category rules need the whole formulation."""
         try:
             rule = ComplianceRule.objects.get(ingredient=self.ingredient)
-            if self.quantity > rule.max_quantity:
+            if rule.max_quantity is not None and self.quantity > rule.max_quantity:
                 return False, f"Quantity exceeds maximum allowed ({rule.max_quantity})"
             return True, "Compliant"
         except ComplianceRule.DoesNotExist:
             return True, "No rules defined"
 
-class ComplianceRule(models.Model):
+class FormulationComponent(models.Model):
+    """A formulation (accord) used as a component of another formulation."""
+    parent = models.ForeignKey(Formulation, related_name='component_links', on_delete=models.CASCADE)
+    # Protected so an accord in use cannot silently vanish from its parents
+    component = models.ForeignKey(Formulation, related_name='parent_links', on_delete=models.PROTECT)
+    quantity = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['parent', 'component'], name='unique_formulation_component'),
+        ]
+
+    def __str__(self):
+        return f"{self.component} ({self.quantity})"
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and (
+            self.component_id == self.parent_id
+            or FormulationClosure.objects.filter(ancestor_id=self.component_id, descendant_id=self.parent_id).exists()
+        ):
+            raise ValidationError(f"{self.component} already contains this formulation")
+        super().save(*args, **kwargs)
+
+class FormulationClosure(models.Model):
+    """
+    Transitive closure of FormulationComponent: one row per (ancestor,
+    descendant) pair, with the number of distinct paths between them so
+    removing one of several links keeps the pair. Maintained by bom.py.
+    """
+    ancestor = models.ForeignKey(Formulation, related_name='+', on_delete=models.CASCADE)
+    descendant = models.ForeignKey(Formulation, related_name='+', on_delete=models.CASCADE)
+    paths = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_formulation_closure'),
+        ]
+        indexes = [models.Index(fields=['descendant'])]
+
+class ExplodedIngredient(models.Model):
+    """Memoized raw-ingredient quantities of a formulation, accords flattened."""
+    formulation = models.ForeignKey(Formulation, related_name='exploded_ingredients', on_delete=models.CASCADE)
     ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE)
-    max_quantity = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    quantity = models.DecimalField(max_digits=18, decimal_places=6)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['formulation', 'ingredient'], name='unique_exploded_ingredient'),
+        ]
+
+class CompositionChange(models.Model):
+    """
+    Log of formulations whose exploded composition changed, replayed by
+    in-memory copies of the composition (see composition.py). The
+    auto-increment id is the log's sequence number.
+    """
+    # Not a foreign key: a deleted formulation's entry must still be replayed
+    formulation_id = models.IntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+class DepletionForecast(models.Model):
+    """Precomputed stock depletion forecast of an ingredient (see forecasting.py)."""
+    ingredient = models.OneToOneField(Ingredient, primary_key=True, related_name='+',
+                                      on_delete=models.CASCADE)
+    daily_usage = models.FloatField()
+    days_to_stockout = models.FloatField(null=True)
+    stockout_date = models.DateField(null=True)
+    suggested_reorder_point = models.FloatField()
+    computed_at = models.DateTimeField()
+
+class IngredientLot(models.Model):
+    """A received batch of an ingredient; `quantity` is what is left of it."""
+    ingredient = models.ForeignKey(Ingredient, related_name='lots', on_delete=models.CASCADE)
+    lot_number = models.CharField(max_length=100, blank=True)
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+    received_at = models.DateTimeField(default=timezone.now)
+    # Lots without an expiry date are used last
+    expires_at = models.DateField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The FEFO allocation lookup: the lots of given ingredients still in stock
+            models.Index(fields=['ingredient', 'expires_at', 'received_at'], condition=models.Q(quantity__gt=0),
+                         name='ingredient_lot_fefo_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.ingredient.name} lot {self.lot_number or self.pk} ({self.quantity})"
+
+class LotAllocation(models.Model):
+    """Stock drawn from a lot for a formulation, so it can be returned to the same lot."""
+    formulation = models.ForeignKey(Formulation, related_name='lot_allocations', on_delete=models.CASCADE)
+    lot = models.ForeignKey(IngredientLot, related_name='allocations', on_delete=models.CASCADE)
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+
+class ComplianceRule(models.Model):
+    """
+    Limits on one ingredient, or on every ingredient of a category taken
+    together: an absolute quantity and/or a concentration, in percent of
+    the formulation's total quantity. Evaluated by compliance_rules.py.
+    """
+    ingredient = models.ForeignKey(Ingredient, null=True, blank=True, on_delete=models.CASCADE)
+    category = models.CharField(max_length=100, blank=True)
+    max_quantity = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    max_concentration = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True,
+                                            help_text='Percent of the formulation total')
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # One rule per ingredient and per category; rule_import.py upserts on them
+        constraints = [
+            models.UniqueConstraint(fields=['ingredient'], name='unique_compliance_rule_ingredient'),
+            models.UniqueConstraint(fields=['category'], condition=~models.Q(category=''),
+                                    name='unique_compliance_rule_category'),
+            models.CheckConstraint(
+                condition=(models.Q(ingredient__isnull=False, category='')
+                           | (models.Q(ingredient__isnull=True) & ~models.Q(category=''))),
+                name='compliance_rule_ingredient_or_category',
+            ),
+        ]
+
     def __str__(self):
+        if self.ingredient_id is None:
+            return f"Rule for category {self.category}"
         return f"Rule for {self.ingredient.name}"
 
 class ComplianceIssue(models.Model):
@@ -164,6 +368,9 @@ class ComplianceIssue(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['status', '-created_at'])]
+
     def __str__(self):
         return f"Compliance Issue: {self.formulation.name} - {self.ingredient.name}"
     
@@ -184,13 +391,102 @@ class QATestResult(models.Model):
 
     class Meta:
         ordering = ['-tested_at']
+        indexes = [models.Index(fields=['-tested_at']), models.Index(fields=['status', '-tested_at'])]
 
     def save(self, *args, **kwargs):
         # Update formulation status when QA result is saved
-        if self.status in ['approved', 'rejected']:
+        if self.status in ['approved', 'rejected'] and self.formulation.status != self.status:
             self.formulation.status = self.status
-            self.formulation.save()
+            self.formulation.save(update_fields=['status', 'updated_at'])
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"QA Result for {self.formulation} - {self.get_status_display()}"
\ No newline at end of file
+        return f"QA Result for {self.formulation} - {self.get_status_display()}"
+
+class AuditEvent(models.Model):
+    actor = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='audit_events')
+    action = models.CharField(max_length=50)
+    object_type = models.CharField(max_length=50, blank=True)
+    object_id = models.CharField(max_length=50, blank=True)
+    object_repr = models.CharField(max_length=200, blank=True)
+    details = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at']),
+            models.Index(fields=['action', '-created_at']),
+            models.Index(fields=['object_type', 'object_id']),
+            models.Index(fields=['actor', '-created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.action} {self.object_type} {self.object_id}"
+
+# Archive tables. Rows keep their original primary keys so links to
+# archived formulations keep resolving; see archive.py.
+
+class ArchivedFormulation(models.Model):
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=200)
+    version = models.CharField(max_length=50)
+    status = models.CharField(max_length=20, choices=Formulation.STATUS_CHOICES)
+    compliance_status = models.CharField(max_length=20, choices=Formulation.COMPLIANCE_STATUS)
+    created_by = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    ingredient_count = models.PositiveIntegerField(default=0)
+    total_quantity = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    open_issue_count = models.PositiveIntegerField(default=0)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    # Lets shared templates tell archived records apart
+    archived = True
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['created_at'])]
+
+    def __str__(self):
+        return f"{self.name} - v{self.version}"
+
+class ArchivedFormulationIngredient(models.Model):
+    id = models.IntegerField(primary_key=True)
+    formulation = models.ForeignKey(ArchivedFormulation, related_name='formulation_ingredients', on_delete=models.CASCADE)
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    quantity = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.ingredient.name} ({self.quantity})"
+
+class ArchivedComplianceIssue(models.Model):
+    id = models.IntegerField(primary_key=True)
+    # Resolved issues can be archived while their formulation stays live,
+    # so this is a plain id rather than a foreign key
+    formulation_id = models.IntegerField(db_index=True)
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    description = models.TextField()
+    status = models.CharField(max_length=20, choices=ComplianceIssue.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Archived Compliance Issue #{self.pk}"
+
+class ArchivedQATestResult(models.Model):
+    id = models.IntegerField(primary_key=True)
+    formulation = models.ForeignKey(ArchivedFormulation, related_name='qa_results', on_delete=models.CASCADE)
+    stability_test = models.TextField(null=True, blank=True)
+    performance_test = models.TextField(null=True, blank=True)
+    comments = models.TextField(null=True, blank=True)
+    tested_by = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    tested_at = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=QATestResult.STATUS_CHOICES)
+
+    class Meta:
+        ordering = ['-tested_at']
+
+    def __str__(self):
+        return f"Archived QA Result #{self.pk}"
@@ -0,0 +1,119 @@
+"""
+Production capacity from usable stock: unexpired lots, which is what
+lots.allocate() will draw on.
+
+Works on the cached composition matrix (see composition.py) and a stock
+vector indexed by ingredient id, so every formulation is evaluated in one
+vectorized pass.
+"""
+import numpy as np
+
+from .composition import matrix
+from .lots import usable_stock
+from .models import Formulation, Ingredient
+
+
+def stock_vector(size):
+    """Usable stock per ingredient id; ids with no ingredient row get 0."""
+    rows = list(usable_stock())
+    size = max([size] + [pk + 1 for pk, _ in rows])
+    stock = np.zeros(size)
+    if rows:
+        ids, values = zip(*rows)
+        stock[list(ids)] = [float(v) for v in values]
+    return stock
+
+
+def max_batches(formulation_ids=None):
+    """
+    For each formulation, the number of whole batches current stock allows
+    and the ingredient that limits it: min over ingredients of
+    floor(stock / quantity). Returns {formulation_id: (batches, ingredient_id)};
+    formulations without ingredients are omitted.
+    """
+    f_ids, i_ids, quantities = matrix.snapshot()
+    used = quantities > 0
+    f_ids, i_ids, quantities = f_ids[used], i_ids[used], quantities[used]
+    if formulation_ids is not None:
+        keep = np.isin(f_ids, np.fromiter(formulation_ids, dtype=np.int64))
+        f_ids, i_ids, quantities = f_ids[keep], i_ids[keep], quantities[keep]
+    if not len(f_ids):
+        return {}
+
+    # Merge repeated (formulation, ingredient) rows into one requirement
+    width = int(i_ids.max()) + 1
+    keys, inverse = np.unique(f_ids * width + i_ids, return_inverse=True)
+    quantities = np.bincount(inverse, weights=quantities)
+    f_ids, i_ids = keys // width, keys % width
+
+    stock = stock_vector(width)
+    ratios = np.floor(np.maximum(stock[i_ids], 0) / quantities)
+
+    # Order each formulation's rows by ratio so the first entry of every
+    # group is its limiting ingredient
+    order = np.lexsort((ratios, f_ids))
+    f_sorted = f_ids[order]
+    starts = np.flatnonzero(np.r_[True, f_sorted[1:] != f_sorted[:-1]])
+    limiting = order[starts]
+
+    return {
+        int(f): (int(batches), int(ingredient))
+        for f, batches, ingredient in zip(f_ids[limiting], ratios[limiting], i_ids[limiting])
+    }
+
+
+def check_plan(plan):
+    """
+    Check a production mix ({formulation_id: batches}) against stock in one
+    pass: total demand per ingredient is the batch-weighted sum of the
+    composition rows. Returns (feasible, shortages) where shortages maps
+    ingredient id to {'required', 'available', 'shortfall'}.
+    """
+    f_ids, i_ids, quantities = matrix.snapshot()
+    plan_ids = np.fromiter(plan.keys(), dtype=np.int64, count=len(plan))
+    plan_batches = np.fromiter(plan.values(), dtype=np.float64, count=len(plan))
+
+    selected = np.isin(f_ids, plan_ids)
+    f_ids, i_ids, quantities = f_ids[selected], i_ids[selected], quantities[selected]
+    order = np.argsort(plan_ids)
+    batches = plan_batches[order][np.searchsorted(plan_ids[order], f_ids)]
+
+    size = int(i_ids.max(initial=-1)) + 1
+    demand = np.bincount(i_ids, weights=quantities * batches, minlength=size)
+    stock = stock_vector(size)[:size]
+    short = np.flatnonzero(demand > stock + 1e-9)
+
+    shortages = {
+        int(i): {
+            'required': round(float(demand[i]), 2),
+            'available': round(float(stock[i]), 2),
+            'shortfall': round(float(demand[i] - stock[i]), 2),
+        }
+        for i in short
+    }
+    return not shortages, shortages
+
+
+def capacity_rows(status='approved'):
+    """Max batches for every formulation with `status`, ready for display."""
+    formulations = list(
+        Formulation.objects.filter(status=status).only('name', 'version').order_by('name')
+    )
+    capacity = max_batches(f.pk for f in formulations)
+    names = dict(
+        Ingredient.objects.filter(pk__in={i for _, i in capacity.values()}).values_list('pk', 'name')
+    )
+    rows = []
+    for formulation in formulations:
+        if formulation.pk not in capacity:
+            continue
+        batches, ingredient_id = capacity[formulation.pk]
+        rows.append({
+            'formulation_id': formulation.pk,
+            'name': formulation.name,
+            'version': formulation.version,
+            'max_batches': batches,
+            'limiting_ingredient_id': ingredient_id,
+            'limiting_ingredient': names.get(ingredient_id),
+        })
+    return rows
@@ -0,0 +1,131 @@
+import cProfile
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.shortcuts import render as django_render
+
+# Per-request timing buckets; None when the profiling middleware is not active
+_timings = ContextVar('profiling_timings', default=None)
+
+
+@contextmanager
+def timer(name):
+    """
+    Add the time spent in the block to the current request's `name` bucket.
+    Queries run inside the block are left in the `db` bucket only.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    db_before = timings.get('db', 0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start - (timings.get('db', 0.0) - db_before)
+        timings[name] = timings.get(name, 0.0) + max(elapsed, 0.0)
+
+
+def render(request, template_name, context=None, *args, **kwargs):
+    """Drop-in for django.shortcuts.render that records template time."""
+    with timer('template'):
+        return django_render(request, template_name, context, *args, **kwargs)
+
+
+class ProfilingMiddleware:
+    """
+    Emit Server-Timing headers (db, chart, template, app, total) and write
+    cProfile dumps for a sampled fraction of requests, or when a staff user
+    sends the trigger header. Removed from the stack when disabled.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+        self.trigger_header = getattr(settings, 'PROFILING_TRIGGER_HEADER', 'X-Profile')
+        self.dump_dir = getattr(settings, 'PROFILING_DUMP_DIR', None)
+
+    def __call__(self, request):
+        timings = {}
+        query_count = [0]
+        token = _timings.set(timings)
+
+        def db_wrapper(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                timings['db'] = timings.get('db', 0.0) + time.perf_counter() - start
+                query_count[0] += 1
+
+        profiler = cProfile.Profile() if self.should_profile(request) else None
+        start = time.perf_counter()
+        try:
+            with _execute_wrappers(db_wrapper):
+                if profiler is not None:
+                    response = profiler.runcall(self.get_response, request)
+                else:
+                    response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        total = time.perf_counter() - start
+
+        if profiler is not None:
+            self.dump(request, profiler)
+
+        response['Server-Timing'] = self.server_timing(timings, query_count[0], total)
+        return response
+
+    def should_profile(self, request):
+        if not self.dump_dir:
+            return False
+        if self.trigger_header and request.headers.get(self.trigger_header):
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_staff:
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def dump(self, request, profiler):
+        os.makedirs(self.dump_dir, exist_ok=True)
+        match = getattr(request, 'resolver_match', None)
+        label = match.view_name if match else request.path
+        label = re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_') or 'root'
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{os.getpid()}-{random.randrange(1 << 16):04x}.prof"
+        profiler.dump_stats(os.path.join(self.dump_dir, filename))
+
+    @staticmethod
+    def server_timing(timings, query_count, total):
+        entries = [f'db;dur={timings.get("db", 0.0) * 1000:.2f};desc="{query_count} queries"']
+        accounted = timings.get('db', 0.0)
+        for name in ('chart', 'template'):
+            if name in timings:
+                entries.append(f'{name};dur={timings[name] * 1000:.2f}')
+                accounted += timings[name]
+        entries.append(f'app;dur={max(total - accounted, 0.0) * 1000:.2f}')
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
+
+
+@contextmanager
+def _execute_wrappers(wrapper):
+    """Install `wrapper` on every configured database connection."""
+    installed = []
+    try:
+        for connection in connections.all():
+            cm = connection.execute_wrapper(wrapper)
+            cm.__enter__()
+            installed.append(cm)
+        yield
+    finally:
+        for cm in reversed(installed):
+            cm.__exit__(None, None, None)
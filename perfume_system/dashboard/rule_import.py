@@ -0,0 +1,290 @@
+"""
+Bulk import of regulatory compliance limit lists.
+
+Lists come as CSV or JSON ([{"ingredient": ..., "max_quantity": ...}, ...]
+or {"rules": [...]}, the shape compliance_simulate_view takes). Each row
+names an ingredient or a category and gives max_quantity, max_concentration
+(percent) or both, plus an optional description. Rows are read as a stream
+and matched to ingredients through one name -> id map built up front.
+Ingredient rules are then upserted in chunks with one INSERT ... ON
+CONFLICT per chunk. Category rules are few and their unique index is
+partial, which ON CONFLICT cannot target, so they are created and updated
+in bulk separately. Only new or changed rules are written, so re-importing
+the same list changes nothing. In particular it leaves updated_at alone,
+which the compliance shortcut in Formulation.check_compliance() relies on.
+"""
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import audit
+from .bom import ensure_exploded
+from .compliance_rules import violations
+from .models import ComplianceRule, ExplodedIngredient, Formulation, Ingredient
+
+DEFAULT_CHUNK_SIZE = 1000
+FORMATS = ('csv', 'json')
+QUANTITY_STEP = Decimal('0.01')
+# ComplianceRule.max_quantity is DecimalField(max_digits=10, decimal_places=2)
+MAX_QUANTITY_LIMIT = Decimal('1e8')
+MAX_CONCENTRATION_LIMIT = Decimal('100')
+LIMIT_COLUMNS = ('max_quantity', 'max_concentration')
+
+
+class RuleImport:
+    """What an import created, changed or could not use."""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.created = []       # [(rule target, limits)]
+        self.changed = []       # [(rule target, old limits, new limits)]
+        self.redescribed = 0    # rules whose description alone changed
+        self.unchanged = 0
+        self.unknown = []       # [(line, ingredient name)]
+        self.invalid = []       # [(line, error)]
+        # Ingredients whose limit is new or different, directly or
+        # through their category
+        self.ingredient_ids = set()
+        self.categories = set()
+
+    @property
+    def written(self):
+        return len(self.created) + len(self.changed) + self.redescribed
+
+    @property
+    def skipped(self):
+        return len(self.unknown) + len(self.invalid)
+
+
+def format_for(filename):
+    return 'json' if filename.lower().endswith('.json') else 'csv'
+
+
+def read_rows(stream, fmt):
+    """
+    Yield (line or position, row dict) from a text stream. CSV is read row
+    by row; JSON has no streaming parser in the standard library, so a JSON
+    list is loaded whole.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        columns = set(reader.fieldnames or [])
+        if not columns & {'ingredient', 'category'}:
+            raise ValueError('Missing column: ingredient or category')
+        if not columns & set(LIMIT_COLUMNS):
+            raise ValueError(f"Missing column: {' or '.join(LIMIT_COLUMNS)}")
+        # Line 1 is the header
+        yield from enumerate(reader, start=2)
+    else:
+        data = json.load(stream)
+        if isinstance(data, dict):
+            data = data.get('rules')
+        if not isinstance(data, list):
+            raise ValueError('Expected a list of rules or {"rules": [...]}')
+        yield from enumerate(data, start=1)
+
+
+def import_rules(rows, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False, user=None):
+    """
+    Upsert ComplianceRule rows from read_rows() output. With dry_run the
+    diff is computed but nothing is written. Returns a RuleImport.
+    """
+    result = RuleImport(dry_run)
+    ingredients = {
+        name.strip().casefold(): (pk, name)
+        for pk, name in Ingredient.objects.values_list('pk', 'name')
+    }
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        parsed = {}
+        for line, row in chunk:
+            rule = _parse(line, row, ingredients, result)
+            if rule:
+                # A later row for the same ingredient or category wins
+                parsed[rule[0]] = rule[1:]
+        by_ingredient = {key[1]: rule for key, rule in parsed.items() if key[0] == 'ingredient'}
+        by_category = {key[1]: rule for key, rule in parsed.items() if key[0] == 'category'}
+        if by_ingredient:
+            _upsert(by_ingredient, result)
+        if by_category:
+            _upsert_categories(by_category, result)
+
+    if result.categories:
+        result.ingredient_ids.update(
+            Ingredient.objects.filter(category__in=result.categories).values_list('pk', flat=True)
+        )
+
+    if result.written and not dry_run:
+        audit.record('compliance_rules_imported', None, user, object_type='compliancerule',
+                     created=len(result.created), changed=len(result.changed),
+                     redescribed=result.redescribed)
+    return result
+
+
+def _parse(line, row, ingredients, result):
+    """
+    (key, name, limits, description) for a usable row, else None. key is
+    ('ingredient', id) or ('category', name); limits is (max_quantity,
+    max_concentration) with None for a limit the row does not set.
+    """
+    if not isinstance(row, dict):
+        result.invalid.append((line, 'not an object'))
+        return None
+    name = str(row.get('ingredient') or '').strip()
+    category = str(row.get('category') or '').strip()
+    if bool(name) == bool(category):
+        result.invalid.append((line, 'needs either an ingredient or a category'))
+        return None
+
+    limits = []
+    for column in LIMIT_COLUMNS:
+        raw = str(row.get(column) or '').strip()
+        if not raw:
+            limits.append(None)
+            continue
+        try:
+            value = Decimal(raw).quantize(QUANTITY_STEP)
+        except InvalidOperation:
+            value = None
+        # quantize() lets NaN through, and NaN cannot be compared
+        if value is None or not value.is_finite():
+            result.invalid.append((line, f"invalid {column} {row.get(column)!r}"))
+            return None
+        if value < 0 or value >= MAX_QUANTITY_LIMIT or (
+            column == 'max_concentration' and value > MAX_CONCENTRATION_LIMIT
+        ):
+            result.invalid.append((line, f'{column} {value} out of range'))
+            return None
+        limits.append(value)
+    if limits == [None, None]:
+        result.invalid.append((line, f"missing {' or '.join(LIMIT_COLUMNS)}"))
+        return None
+
+    description = str(row.get('description') or '').strip()
+    if category:
+        return ('category', category), f'category {category}', tuple(limits), description
+    match = ingredients.get(name.casefold())
+    if match is None:
+        result.unknown.append((line, name))
+        return None
+    return ('ingredient', match[0]), match[1], tuple(limits), description
+
+
+def format_limits(limits):
+    """'5.00', '1.50%' or '5.00 / 1.50%' for a (max_quantity, max_concentration) pair."""
+    max_quantity, max_concentration = limits
+    parts = []
+    if max_quantity is not None:
+        parts.append(str(max_quantity))
+    if max_concentration is not None:
+        parts.append(f'{max_concentration}%')
+    return ' / '.join(parts)
+
+
+def _diff(key, name, limits, description, old, result):
+    """Record one parsed rule against its stored (limits, description); True if it needs writing."""
+    if old == (limits, description):
+        result.unchanged += 1
+        return False
+    if old is None:
+        result.created.append((name, format_limits(limits)))
+    elif old[0] != limits:
+        result.changed.append((name, format_limits(old[0]), format_limits(limits)))
+    else:
+        result.redescribed += 1
+        return True
+    if key[0] == 'ingredient':
+        result.ingredient_ids.add(key[1])
+    else:
+        result.categories.add(key[1])
+    return True
+
+
+def _upsert(parsed, result):
+    existing = {
+        ingredient_id: ((max_quantity, max_concentration), description)
+        for ingredient_id, max_quantity, max_concentration, description in ComplianceRule.objects.filter(
+            ingredient_id__in=parsed
+        ).values_list('ingredient_id', 'max_quantity', 'max_concentration', 'description')
+    }
+    writes = []
+    for ingredient_id, (name, limits, description) in parsed.items():
+        if _diff(('ingredient', ingredient_id), name, limits, description, existing.get(ingredient_id), result):
+            writes.append(ComplianceRule(ingredient_id=ingredient_id, max_quantity=limits[0],
+                                         max_concentration=limits[1], description=description))
+
+    if writes and not result.dry_run:
+        with transaction.atomic():
+            ComplianceRule.objects.bulk_create(
+                writes,
+                update_conflicts=True,
+                unique_fields=['ingredient'],
+                update_fields=['max_quantity', 'max_concentration', 'description', 'updated_at'],
+            )
+
+
+def _upsert_categories(parsed, result):
+    existing = {
+        rule.category: rule
+        for rule in ComplianceRule.objects.filter(ingredient__isnull=True, category__in=parsed)
+    }
+    creates, updates = [], []
+    for category, (name, limits, description) in parsed.items():
+        rule = existing.get(category)
+        old = rule and ((rule.max_quantity, rule.max_concentration), rule.description)
+        if not _diff(('category', category), name, limits, description, old, result):
+            continue
+        if rule is None:
+            creates.append(ComplianceRule(category=category, max_quantity=limits[0],
+                                          max_concentration=limits[1], description=description))
+        else:
+            rule.max_quantity, rule.max_concentration = limits
+            rule.description = description
+            updates.append(rule)
+
+    if (creates or updates) and not result.dry_run:
+        with transaction.atomic():
+            ComplianceRule.objects.bulk_create(creates)
+            # bulk_update() does not apply auto_now
+            now = timezone.now()
+            for rule in updates:
+                rule.updated_at = now
+            ComplianceRule.objects.bulk_update(
+                updates, ['max_quantity', 'max_concentration', 'description', 'updated_at']
+            )
+
+
+def affected_formulations(ingredient_ids):
+    """Live formulations whose exploded composition uses any of these ingredients."""
+    ensure_exploded()
+    return Formulation.objects.filter(
+        pk__in=ExplodedIngredient.objects.filter(ingredient_id__in=ingredient_ids).values('formulation_id')
+    )
+
+
+def recheck(ingredient_ids, chunk_size=500):
+    """
+    Re-run check_compliance() on affected formulations only, evaluating
+    each chunk of them in one query; returns (checked, non-compliant).
+    """
+    checked = failing = 0
+    if not ingredient_ids:
+        return checked, failing
+    formulations = affected_formulations(ingredient_ids).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(formulations, chunk_size))
+        if not chunk:
+            break
+        found = violations([formulation.pk for formulation in chunk])
+        for formulation in chunk:
+            checked += 1
+            if not formulation.check_compliance(found.get(formulation.pk, [])):
+                failing += 1
+    return checked, failing
@@ -0,0 +1,149 @@
+"""Model signal hooks that keep derived data in step with writes."""
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import freshness
+from .commit import deferred
+from .live import hub
+from .models import (
+    ComplianceIssue,
+    CompositionChange,
+    Formulation,
+    FormulationClosure,
+    FormulationComponent,
+    FormulationIngredient,
+    Ingredient,
+    QATestResult,
+)
+
+# Readers further behind than this many composition changes reload
+# everything, so older change log entries are pruned
+CHANGE_LOG_LENGTH = 5000
+
+
+def publish_composition_changes(formulation_ids):
+    """Log that these formulations' compositions changed, once the write commits."""
+    deferred(_log_changes, formulation_ids)
+
+
+def _log_changes(formulation_ids):
+    logged = CompositionChange.objects.bulk_create(
+        CompositionChange(formulation_id=pk) for pk in sorted(formulation_ids)
+    )
+    if logged and logged[-1].pk is not None:
+        CompositionChange.objects.filter(pk__lte=logged[-1].pk - CHANGE_LOG_LENGTH).delete()
+
+
+@receiver(post_save, sender=FormulationIngredient)
+@receiver(post_delete, sender=FormulationIngredient)
+def formulation_ingredient_changed(sender, instance, **kwargs):
+    invalidate_bom(instance.formulation_id)
+    update_ingredient_summary(instance, kwargs.get('signal'), kwargs.get('created', False))
+
+
+@receiver(post_save, sender=FormulationComponent)
+@receiver(post_delete, sender=FormulationComponent)
+def formulation_component_changed(sender, instance, **kwargs):
+    from .bom import link, unlink
+    if kwargs.get('signal') is post_delete:
+        unlink(instance.parent_id, instance.component_id)
+    elif kwargs.get('created'):
+        link(instance.parent_id, instance.component_id)
+    invalidate_bom(instance.parent_id)
+
+
+def invalidate_bom(formulation_id):
+    """
+    A formulation's own composition changed: its exploded ingredients and
+    those of every formulation using it, directly or through other
+    accords, must be rebuilt (see bom.py).
+    """
+    affected = [formulation_id, *FormulationClosure.objects.filter(
+        descendant_id=formulation_id
+    ).values_list('ancestor_id', flat=True)]
+    Formulation.objects.filter(pk__in=affected, bom_valid=True).update(bom_valid=False)
+    # Rebuilt here on the write path, so readers never have to, once per
+    # transaction however many rows it writes
+    deferred(_rebuild, affected)
+
+
+def _rebuild(formulation_ids):
+    from .bom import ensure_exploded
+    ensure_exploded(formulation_ids)
+    # Logged after the rebuild, so replaying readers find it rebuilt
+    _log_changes(formulation_ids)
+
+
+def update_ingredient_summary(instance, signal, created):
+    """
+    Keep Formulation.ingredient_count/total_quantity in step, in the same
+    transaction as the write: adds and deletes adjust the counters in place,
+    anything else recomputes them.
+    """
+    formulations = Formulation.objects.filter(pk=instance.formulation_id)
+    if signal is post_delete:
+        formulations.update(
+            ingredient_count=Greatest(F('ingredient_count') - 1, 0),
+            total_quantity=F('total_quantity') - instance.quantity,
+        )
+    elif created:
+        formulations.update(
+            ingredient_count=F('ingredient_count') + 1,
+            total_quantity=F('total_quantity') + instance.quantity,
+        )
+    else:
+        expressions = Formulation.summary_expressions()
+        formulations.update(
+            ingredient_count=expressions['ingredient_count'],
+            total_quantity=expressions['total_quantity'],
+        )
+
+
+@receiver(post_save, sender=ComplianceIssue)
+@receiver(post_delete, sender=ComplianceIssue)
+def compliance_issue_changed(sender, instance, **kwargs):
+    # Status transitions make in-place counting error-prone; a count over the
+    # indexed foreign key is cheap
+    Formulation.objects.filter(pk=instance.formulation_id).update(
+        open_issue_count=Formulation.summary_expressions()['open_issue_count']
+    )
+
+
+def notify_dashboard_change():
+    """Tell connected live dashboards to refresh once the write commits."""
+    deferred(_notify, ())
+
+
+def _notify(_):
+    hub.notify()
+
+
+@receiver(post_save, sender=Formulation)
+@receiver(post_delete, sender=Formulation)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_save, sender=ComplianceIssue)
+@receiver(post_delete, sender=ComplianceIssue)
+def dashboard_model_changed(sender, instance, **kwargs):
+    notify_dashboard_change()
+
+
+# Freshness scopes each model's writes can change; issues also rewrite
+# their formulation's open_issue_count
+FRESHNESS_SCOPES = {
+    Formulation: ('formulation',),
+    FormulationIngredient: ('formulation',),
+    FormulationComponent: ('formulation',),
+    Ingredient: ('ingredient',),
+    ComplianceIssue: ('complianceissue', 'formulation'),
+    QATestResult: ('qatestresult',),
+}
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_freshness(sender, **kwargs):
+    if sender in FRESHNESS_SCOPES:
+        freshness.bump(*FRESHNESS_SCOPES[sender])
@@ -0,0 +1,165 @@
+"""
+Composition similarity between formulations.
+
+Each formulation is an L2-normalised sparse vector of ingredient quantities
+built from the cached composition matrix (see composition.py). Queries walk
+an inverted index (ingredient -> formulations using it), which means only
+formulations sharing at least one ingredient with the query are ever scored.
+
+The index follows writes through the matrix's change log: only the changed
+formulations are re-normalised, and their old entries are swapped for new
+ones in both the vectors and the inverted index with linear merges, so no
+full sort runs. A full rebuild only happens when the log cannot say what
+changed.
+"""
+import threading
+
+import numpy as np
+
+from .composition import changes_since, matrix
+
+DEFAULT_K = 5
+
+
+def _entries(f_ids, i_ids, quantities):
+    """
+    Normalised (formulation, ingredient, value) entries sorted by
+    formulation, then ingredient; repeated pairs are merged.
+    """
+    used = quantities > 0
+    f_ids, i_ids, quantities = f_ids[used], i_ids[used], quantities[used]
+    if not len(f_ids):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    width = int(i_ids.max()) + 1
+    keys, inverse = np.unique(f_ids * width + i_ids, return_inverse=True)
+    values = np.bincount(inverse, weights=quantities)
+    f_ids, i_ids = keys // width, keys % width
+    _, rows = np.unique(f_ids, return_inverse=True)
+    return f_ids, i_ids, values / np.sqrt(np.bincount(rows, weights=values ** 2))[rows]
+
+
+def _posting_keys(ingredients, formulations, width):
+    return ingredients * width + formulations
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # The matrix snapshot arrays the index was built from, and their
+        # change log sequence number
+        self._source = None
+        self._seq = None
+
+    def _current(self):
+        """Bring the index up to date with the composition matrix."""
+        seq, snapshot = matrix.versioned_snapshot()
+        with self._lock:
+            if self._source is None or any(a is not b for a, b in zip(snapshot, self._source)):
+                changed = None
+                if self._source is not None and self._seq is not None and seq != self._seq:
+                    _, changed = changes_since(self._seq, latest=seq)
+                if changed is None:
+                    self._build(*snapshot)
+                else:
+                    self._apply(changed, *snapshot)
+                self._source, self._seq = snapshot, seq
+            return self.formulations, self.row_starts, self.ingredients, self.values, self.postings
+
+    def _build(self, f_ids, i_ids, quantities):
+        f_ids, i_ids, values = _entries(f_ids, i_ids, quantities)
+        # Inverted index: the same entries ordered by ingredient, then formulation
+        order = np.lexsort((f_ids, i_ids))
+        self._store(f_ids, i_ids, values, (i_ids[order], f_ids[order], values[order]))
+
+    def _apply(self, changed, f_ids, i_ids, quantities):
+        """Replace the entries of the `changed` formulations with their rows in the snapshot."""
+        changed = np.fromiter(changed, dtype=np.int64, count=len(changed))
+        selected = np.isin(f_ids, changed)
+        new_f, new_i, new_v = _entries(f_ids[selected], i_ids[selected], quantities[selected])
+
+        # Vectors: the kept entries stay sorted, and each changed
+        # formulation's new entries go in where its old ones were
+        entry_f = np.repeat(self.formulations, np.diff(self.row_starts))
+        keep = ~np.isin(entry_f, changed)
+        kept_f = entry_f[keep]
+        at = np.searchsorted(kept_f, new_f)
+        entry_f = np.insert(kept_f, at, new_f)
+        ingredients = np.insert(self.ingredients[keep], at, new_i)
+        values = np.insert(self.values[keep], at, new_v)
+
+        # Inverted index, merged the same way on (ingredient, formulation)
+        post_i, post_f, post_v = self.postings
+        keep = ~np.isin(post_f, changed)
+        post_i, post_f, post_v = post_i[keep], post_f[keep], post_v[keep]
+        order = np.lexsort((new_f, new_i))
+        width = int(max(post_f.max(initial=-1), new_f.max(initial=-1))) + 1
+        at = np.searchsorted(_posting_keys(post_i, post_f, width),
+                             _posting_keys(new_i[order], new_f[order], width))
+        postings = (np.insert(post_i, at, new_i[order]), np.insert(post_f, at, new_f[order]),
+                    np.insert(post_v, at, new_v[order]))
+        self._store(entry_f, ingredients, values, postings)
+
+    def _store(self, entry_f, ingredients, values, postings):
+        # entry_f is sorted, so each formulation's rows start where it changes
+        row_starts = np.flatnonzero(np.r_[True, entry_f[1:] != entry_f[:-1]]) if len(entry_f) else \
+            np.empty(0, dtype=np.int64)
+        self.formulations = entry_f[row_starts]
+        self.row_starts = np.append(row_starts, len(entry_f))
+        self.ingredients, self.values = ingredients, values
+        self.postings = postings
+
+    def vector(self, formulation_id):
+        """(ingredient ids, normalised quantities) of an indexed formulation, or None."""
+        formulations, row_starts, ingredients, values, _ = self._current()
+        row = np.searchsorted(formulations, formulation_id)
+        if row == len(formulations) or formulations[row] != formulation_id:
+            return None
+        start, end = row_starts[row], row_starts[row + 1]
+        return ingredients[start:end], values[start:end]
+
+    def query(self, ingredient_ids, quantities, k=DEFAULT_K, exclude=None):
+        """
+        Top-k formulations by cosine similarity to a composition, as
+        [(formulation_id, score)] best first. `exclude` is a formulation id
+        to leave out, normally the one the composition came from.
+        """
+        formulations, _, _, _, (post_ingredients, post_formulations, post_values) = self._current()
+        ingredient_ids = np.asarray(ingredient_ids, dtype=np.int64)
+        quantities = np.asarray(quantities, dtype=np.float64)
+        norm = np.sqrt((quantities ** 2).sum())
+        if not len(formulations) or not norm:
+            return []
+        quantities = quantities / norm
+
+        lefts = np.searchsorted(post_ingredients, ingredient_ids, side='left')
+        rights = np.searchsorted(post_ingredients, ingredient_ids, side='right')
+        lengths = rights - lefts
+        if not lengths.sum():
+            return []
+        # Positions of every posting for the query's ingredients
+        positions = np.repeat(rights - lengths.cumsum(), lengths) + np.arange(lengths.sum())
+        scores = np.bincount(
+            np.searchsorted(formulations, post_formulations[positions]),
+            weights=post_values[positions] * np.repeat(quantities, lengths),
+            minlength=len(formulations),
+        )
+
+        if exclude is not None:
+            row = np.searchsorted(formulations, exclude)
+            if row < len(formulations) and formulations[row] == exclude:
+                scores[row] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(int(formulations[row]), float(min(scores[row], 1.0))) for row in candidates]
+
+    def similar_to(self, formulation_id, k=DEFAULT_K):
+        """Top-k formulations most similar to an indexed formulation."""
+        vector = self.vector(formulation_id)
+        if vector is None:
+            return []
+        return self.query(*vector, k=k, exclude=formulation_id)
+
+
+index = SimilarityIndex()
@@ -0,0 +1,107 @@
+"""
+What-if compliance simulation over the whole catalog.
+
+Proposed `max_quantity` limits are applied as a vector against the cached
+composition matrix, so no formulation is loaded or re-checked one by one
+and nothing is written.
+"""
+import numpy as np
+from django.db.models import Min
+
+from .composition import matrix
+from .models import ComplianceRule, Formulation, Ingredient
+
+
+def limit_vector(limits, size):
+    """Dense per-ingredient-id limit array; ingredients without a limit get +inf."""
+    vector = np.full(size, np.inf)
+    for ingredient_id, max_quantity in limits.items():
+        if 0 <= ingredient_id < size:
+            vector[ingredient_id] = float(max_quantity)
+    return vector
+
+
+def current_limits():
+    """Current max_quantity per ingredient id (the strictest rule wins)."""
+    return dict(
+        # Concentration and category limits are not simulated
+        ComplianceRule.objects.filter(ingredient__isnull=False, max_quantity__isnull=False)
+        .values('ingredient_id')
+        .annotate(max_quantity=Min('max_quantity'))
+        .values_list('ingredient_id', 'max_quantity')
+    )
+
+
+def simulate_rules(proposed, limit=100):
+    """
+    Evaluate proposed limits ({ingredient_id: max_quantity}) on top of the
+    current rules. Returns totals plus, for at most `limit` affected
+    formulations (tightest margin first), the violating ingredients and
+    their margins (max_quantity - quantity, negative when exceeded).
+    """
+    formulation_ids, ingredient_ids, quantities = matrix.snapshot()
+    existing = current_limits()
+    combined = {**existing, **proposed}
+
+    # Limits on ingredients that no formulation uses cannot be violated,
+    # so the vectors only span ids present in the matrix
+    size = int(ingredient_ids.max(initial=-1)) + 1
+    current_vec = limit_vector(existing, size)
+    proposed_vec = limit_vector(combined, size)
+
+    margins = proposed_vec[ingredient_ids] - quantities
+    violating = margins < 0
+    currently_violating = quantities > current_vec[ingredient_ids]
+
+    affected_ids, first = np.unique(formulation_ids[violating], return_index=True)
+    # Tightest (most negative) margin per affected formulation
+    worst = np.full(affected_ids.shape, np.inf)
+    np.minimum.at(worst, np.searchsorted(affected_ids, formulation_ids[violating]), margins[violating])
+    already_failing = np.isin(affected_ids, np.unique(formulation_ids[currently_violating]))
+
+    order = np.argsort(worst, kind='stable')[:limit]
+    shown = affected_ids[order]
+
+    details = {}
+    if len(shown):
+        mask = violating & np.isin(formulation_ids, shown)
+        for f_id, i_id, qty, margin in zip(
+            formulation_ids[mask], ingredient_ids[mask], quantities[mask], margins[mask]
+        ):
+            details.setdefault(int(f_id), []).append({
+                'ingredient_id': int(i_id),
+                'quantity': float(qty),
+                'max_quantity': float(proposed_vec[i_id]),
+                'margin': float(margin),
+            })
+
+    formulations = Formulation.objects.only('name', 'version', 'status').in_bulk(shown.tolist())
+    ingredient_names = dict(
+        Ingredient.objects.filter(
+            pk__in={v['ingredient_id'] for rows in details.values() for v in rows}
+        ).values_list('pk', 'name')
+    )
+
+    results = []
+    for idx in order:
+        f_id = int(affected_ids[idx])
+        formulation = formulations.get(f_id)
+        violations = details.get(f_id, [])
+        for v in violations:
+            v['ingredient'] = ingredient_names.get(v['ingredient_id'])
+        results.append({
+            'formulation_id': f_id,
+            'name': formulation.name if formulation else None,
+            'version': formulation.version if formulation else None,
+            'status': formulation.status if formulation else None,
+            'worst_margin': float(worst[idx]),
+            'newly_failing': not bool(already_failing[idx]),
+            'violations': violations,
+        })
+
+    return {
+        'formulations_checked': int(np.count_nonzero(np.diff(formulation_ids)) + 1) if len(formulation_ids) else 0,
+        'affected_count': int(len(affected_ids)),
+        'newly_failing_count': int((~already_failing).sum()),
+        'results': results,
+    }
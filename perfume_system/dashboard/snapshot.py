@@ -0,0 +1,224 @@
+"""
+Columnar analytics snapshots of formulations, compositions, stock and
+compliance issues, one file per table.
+
+Tables are Parquet when pyarrow is installed and NumPy .npz otherwise.
+Rows are streamed from iterator() querysets and written in chunks: a
+Parquet row group per chunk, or appended to per-column scratch files that
+become .npz members at the end. Loading a file is then a matter of mapping
+columns instead of parsing text:
+
+    pyarrow.parquet.read_table(path, memory_map=True)
+    snapshot.load_npz(path)   # {column: read-only np.memmap}
+
+.npz files are written uncompressed, which is what makes their members
+mappable; np.load() itself cannot memory-map inside a zip. Text columns are
+dictionary-encoded in .npz as int32 codes plus a `<column>.values` array,
+so `data['status.values'][data['status']]` gives the strings. Timestamps
+are UTC; decimals become float64.
+"""
+import importlib.util
+import shutil
+import struct
+import tempfile
+import zipfile
+from datetime import timezone as dt_timezone
+
+import numpy as np
+
+from .models import ComplianceIssue, ExplodedIngredient, Formulation, Ingredient
+
+DEFAULT_CHUNK_SIZE = 50000
+FORMATS = ('parquet', 'npz')
+
+# {table: (queryset factory, [(column, field, kind)])}; kind is one of
+# int, float, str, datetime
+TABLES = {
+    'formulations': (
+        lambda: Formulation.objects.order_by('pk'),
+        [
+            ('id', 'id', 'int'),
+            ('name', 'name', 'str'),
+            ('version', 'version', 'str'),
+            ('status', 'status', 'str'),
+            ('compliance_status', 'compliance_status', 'str'),
+            ('created_by', 'created_by__username', 'str'),
+            ('created_at', 'created_at', 'datetime'),
+            ('updated_at', 'updated_at', 'datetime'),
+            ('ingredient_count', 'ingredient_count', 'int'),
+            ('total_quantity', 'total_quantity', 'float'),
+            ('open_issue_count', 'open_issue_count', 'int'),
+        ],
+    ),
+    # Exploded, so ingredients brought in through accords are included
+    'compositions': (
+        lambda: ExplodedIngredient.objects.order_by('formulation_id', 'ingredient_id'),
+        [
+            ('formulation_id', 'formulation_id', 'int'),
+            ('ingredient_id', 'ingredient_id', 'int'),
+            ('quantity', 'quantity', 'float'),
+        ],
+    ),
+    'stock': (
+        lambda: Ingredient.objects.order_by('pk'),
+        [
+            ('ingredient_id', 'id', 'int'),
+            ('name', 'name', 'str'),
+            ('category', 'category', 'str'),
+            ('current_stock', 'current_stock', 'float'),
+            ('reorder_threshold', 'reorder_threshold', 'float'),
+            ('updated_at', 'updated_at', 'datetime'),
+        ],
+    ),
+    'compliance_issues': (
+        lambda: ComplianceIssue.objects.order_by('pk'),
+        [
+            ('id', 'id', 'int'),
+            ('formulation_id', 'formulation_id', 'int'),
+            ('ingredient_id', 'ingredient_id', 'int'),
+            ('description', 'description', 'str'),
+            ('status', 'status', 'str'),
+            ('created_at', 'created_at', 'datetime'),
+            ('updated_at', 'updated_at', 'datetime'),
+        ],
+    ),
+}
+
+NUMPY_TYPES = {'int': np.dtype('<i8'), 'float': np.dtype('<f8'), 'datetime': np.dtype('<M8[us]')}
+# Missing values: NaN for floats, NaT for timestamps, and -1 codes for text
+MISSING = {'int': 0, 'float': float('nan'), 'datetime': None}
+
+
+def default_format():
+    return 'parquet' if importlib.util.find_spec('pyarrow') else 'npz'
+
+
+def filename(table, fmt):
+    return f'{table}.{fmt}'
+
+
+def _chunks(table, chunk_size):
+    """Yield lists of row tuples for a table, streamed from the database."""
+    queryset, columns = TABLES[table]
+    rows = queryset().values_list(*(field for _, field, _ in columns)).iterator(chunk_size=chunk_size)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _utc(value):
+    return value.astimezone(dt_timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def export(table, destination, fmt=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write one table to `destination` (a path or a binary file object);
+    returns the number of rows written.
+    """
+    fmt = fmt or default_format()
+    if fmt == 'parquet':
+        return _export_parquet(table, destination, chunk_size)
+    return _export_npz(table, destination, chunk_size)
+
+
+def _export_parquet(table, destination, chunk_size):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    _, columns = TABLES[table]
+    types = {'int': pa.int64(), 'float': pa.float64(), 'str': pa.string(), 'datetime': pa.timestamp('us', tz='UTC')}
+    schema = pa.schema([(column, types[kind]) for column, _, kind in columns])
+    rows = 0
+    with pq.ParquetWriter(destination, schema) as writer:
+        for chunk in _chunks(table, chunk_size):
+            arrays = []
+            for i, (_, _, kind) in enumerate(columns):
+                values = [row[i] for row in chunk]
+                if kind == 'float':
+                    values = [None if value is None else float(value) for value in values]
+                arrays.append(pa.array(values, type=schema.field(i).type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema), row_group_size=len(chunk))
+            rows += len(chunk)
+    return rows
+
+
+def _export_npz(table, destination, chunk_size):
+    _, columns = TABLES[table]
+    # Raw column data accumulates in scratch files, as the .npy header needs
+    # the final row count before any data
+    scratch = [tempfile.TemporaryFile() for _ in columns]
+    encodings = [{} if kind == 'str' else None for _, _, kind in columns]
+    rows = 0
+    try:
+        for chunk in _chunks(table, chunk_size):
+            for i, (_, _, kind) in enumerate(columns):
+                values = [row[i] for row in chunk]
+                if kind == 'str':
+                    codes = encodings[i]
+                    array = np.fromiter(
+                        (-1 if value is None else codes.setdefault(value, len(codes)) for value in values),
+                        dtype='<i4', count=len(values),
+                    )
+                elif kind == 'datetime':
+                    array = np.array([None if value is None else _utc(value) for value in values],
+                                     dtype=NUMPY_TYPES[kind])
+                else:
+                    array = np.array([MISSING[kind] if value is None else value for value in values],
+                                     dtype=NUMPY_TYPES[kind])
+                scratch[i].write(array.tobytes())
+            rows += len(chunk)
+
+        with zipfile.ZipFile(destination, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for (column, _, kind), data, codes in zip(columns, scratch, encodings):
+                dtype = np.dtype('<i4') if kind == 'str' else NUMPY_TYPES[kind]
+                with archive.open(f'{column}.npy', 'w', force_zip64=True) as member:
+                    np.lib.format.write_array_header_1_0(
+                        member, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                                 'shape': (rows,)}
+                    )
+                    data.seek(0)
+                    shutil.copyfileobj(data, member)
+                if codes is not None:
+                    # Dict order is code order
+                    values = np.array(list(codes), dtype=str) if codes else np.array([], dtype='<U1')
+                    with archive.open(f'{column}.values.npy', 'w', force_zip64=True) as member:
+                        np.lib.format.write_array(member, values, allow_pickle=False)
+    finally:
+        for data in scratch:
+            data.close()
+    return rows
+
+
+def load_npz(path):
+    """
+    Columns of an .npz snapshot as {name: read-only np.memmap}, mapped
+    straight from the file without reading it.
+    """
+    columns = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'{info.filename} is compressed and cannot be memory-mapped')
+            # Data follows the local file header, whose extra field may
+            # differ from the central directory's
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')]
+            if 0 in shape:
+                # mmap cannot map zero bytes
+                columns[name] = np.empty(shape, dtype=dtype)
+                continue
+            columns[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                      order='F' if fortran_order else 'C')
+    return columns
@@ -0,0 +1,76 @@
+"""
+Stock level aggregation for the dashboard chart and its drill-down pages.
+
+Ingredients are ranked in the database by shortfall below their reorder
+threshold (then by stock/threshold ratio), so a chart only ever receives
+one page of rows plus a single "others" bucket summarising the rest of the
+catalog.
+"""
+from django.conf import settings
+from django.db.models import Count, F, FloatField, Q, Sum, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, NullIf
+
+from .models import Ingredient
+
+
+def ranked_ingredients():
+    """Ingredients annotated with shortfall and stock ratio, worst first."""
+    return Ingredient.objects.annotate(
+        shortfall=Greatest(
+            Cast(F('reorder_threshold') - F('current_stock'), FloatField()), Value(0.0)
+        ),
+        # NULL for ingredients without a threshold
+        stock_ratio=Cast('current_stock', FloatField())
+        / NullIf(Cast('reorder_threshold', FloatField()), Value(0.0)),
+    ).order_by(
+        F('shortfall').desc(), F('stock_ratio').asc(nulls_last=True), 'name'
+    )
+
+
+def stock_chart_data(page=1, per_page=None):
+    """
+    One page of ranked ingredients and an "others" bucket aggregating every
+    ingredient not on the page. Two queries regardless of catalog size.
+    """
+    per_page = per_page or settings.STOCK_CHART_TOP
+    page = max(int(page), 1)
+    offset = (page - 1) * per_page
+
+    rows = [
+        {
+            'id': pk,
+            'name': name,
+            'current_stock': float(stock),
+            'reorder_threshold': float(threshold),
+            'shortfall': shortfall,
+            'stock_ratio': ratio,
+            # At or below the threshold, as in Ingredient.status
+            'low_stock': stock <= threshold,
+        }
+        for pk, name, stock, threshold, shortfall, ratio in ranked_ingredients().values_list(
+            'pk', 'name', 'current_stock', 'reorder_threshold', 'shortfall', 'stock_ratio'
+        )[offset:offset + per_page]
+    ]
+
+    totals = Ingredient.objects.aggregate(
+        count=Count('pk'),
+        below_threshold=Count('pk', filter=Q(current_stock__lte=F('reorder_threshold'))),
+        current_stock=Coalesce(Sum(Cast('current_stock', FloatField())), Value(0.0)),
+        reorder_threshold=Coalesce(Sum(Cast('reorder_threshold', FloatField())), Value(0.0)),
+    )
+    others = {
+        'count': totals['count'] - len(rows),
+        'below_threshold': totals['below_threshold'] - sum(1 for row in rows if row['low_stock']),
+        'current_stock': totals['current_stock'] - sum(row['current_stock'] for row in rows),
+        'reorder_threshold': totals['reorder_threshold'] - sum(row['reorder_threshold'] for row in rows),
+    }
+    pages = max((totals['count'] + per_page - 1) // per_page, 1)
+    return {
+        'ingredients': rows,
+        'others': others,
+        'page': page,
+        'pages': pages,
+        'has_previous': page > 1,
+        'has_next': page < pages,
+    }
+
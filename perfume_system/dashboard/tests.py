@@ -1,3 +1,636 @@
-from django.test import TestCase
+import io
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from accounts.models import Role
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import archive, audit, bom, freshness, lots
+from .compliance_rules import violations
+from .management.commands.loadtest import percentile
+from .models import (
+    ArchivedComplianceIssue,
+    ArchivedFormulationIngredient,
+    AuditEvent,
+    ComplianceIssue,
+    ComplianceRule,
+    CompositionChange,
+    Formulation,
+    FormulationClosure,
+    FormulationComponent,
+    FormulationIngredient,
+    Ingredient,
+    IngredientLot,
+    LotAllocation,
+)
+from .rule_import import import_rules, read_rows
+
+
+def tearDownModule():
+    # Events recorded outside a request are still buffered; write them
+    # while the test database exists rather than at exit
+    audit.flush()
+
+
+def make_user(role):
+    user = User.objects.create_user(f'{role}_user', password='password')
+    Role.objects.get_or_create(name=role)[0].users.add(user)
+    return user
+
+
+def make_formulation(user, name, ingredients=(), components=()):
+    """A formulation with (ingredient, quantity) rows and (accord, quantity) components."""
+    formulation = Formulation.objects.create(name=name, version='1', created_by=user)
+    for ingredient, quantity in ingredients:
+        FormulationIngredient.objects.create(formulation=formulation, ingredient=ingredient,
+                                             quantity=Decimal(quantity))
+    for component, quantity in components:
+        FormulationComponent.objects.create(parent=formulation, component=component, quantity=Decimal(quantity))
+    return formulation
+
+
+class LotAllocationTests(TestCase):
+    def setUp(self):
+        self.user = make_user('rd')
+        self.formulation = Formulation.objects.create(name='Base', version='1', created_by=self.user)
+        self.ingredient = Ingredient.objects.create(name='Linalool')
+        today = timezone.localdate()
+        self.undated = lots.receive(self.ingredient, Decimal('10'))
+        self.later = lots.receive(self.ingredient, Decimal('5'), expires_at=today + timedelta(days=30))
+        self.sooner = lots.receive(self.ingredient, Decimal('5'), expires_at=today + timedelta(days=10))
+        self.expired = lots.receive(self.ingredient, Decimal('100'), expires_at=today - timedelta(days=1))
+
+    def quantities(self):
+        return {lot.pk: lot.quantity for lot in IngredientLot.objects.filter(ingredient=self.ingredient)}
+
+    def test_allocate_draws_first_expiry_first(self):
+        lots.allocate({self.ingredient.pk: Decimal('8')}, self.formulation)
+
+        quantities = self.quantities()
+        self.assertEqual(quantities[self.sooner.pk], Decimal('0'))
+        self.assertEqual(quantities[self.later.pk], Decimal('2'))
+        self.assertEqual(quantities[self.undated.pk], Decimal('10'))
+        self.assertEqual(quantities[self.expired.pk], Decimal('100'))
+        self.ingredient.refresh_from_db()
+        self.assertEqual(self.ingredient.current_stock, Decimal('112'))
+
+    def test_allocate_ignores_expired_lots(self):
+        with self.assertRaises(ValidationError):
+            lots.allocate({self.ingredient.pk: Decimal('21')}, self.formulation)
+
+    def test_allocate_is_all_or_nothing(self):
+        other = Ingredient.objects.create(name='Citral')
+        lots.receive(other, Decimal('3'))
+        before = self.quantities()
+
+        with self.assertRaises(ValidationError):
+            lots.allocate({self.ingredient.pk: Decimal('5'), other.pk: Decimal('4')}, self.formulation)
+
+        self.assertEqual(self.quantities(), before)
+        self.assertFalse(LotAllocation.objects.exists())
+
+    def test_release_returns_stock_to_its_lots(self):
+        before = self.quantities()
+        lots.allocate({self.ingredient.pk: Decimal('8')}, self.formulation)
+
+        returned = lots.release(self.formulation)
+
+        self.assertEqual(returned, {self.ingredient.pk: Decimal('8')})
+        self.assertEqual(self.quantities(), before)
+        self.assertFalse(LotAllocation.objects.exists())
+        self.ingredient.refresh_from_db()
+        self.assertEqual(self.ingredient.current_stock, Decimal('120'))
+
+    def test_release_without_allocations_adds_a_returned_lot(self):
+        lots.release(self.formulation, expected={self.ingredient.pk: Decimal('4')})
+
+        returned = IngredientLot.objects.get(ingredient=self.ingredient, lot_number='returned')
+        self.assertEqual(returned.quantity, Decimal('4'))
+        self.ingredient.refresh_from_db()
+        self.assertEqual(self.ingredient.current_stock, Decimal('124'))
+
+    def test_untracked_stock_is_allocated_from_an_opening_lot(self):
+        untracked = Ingredient.objects.create(name='Vanillin', current_stock=Decimal('20'))
+
+        lots.allocate({untracked.pk: Decimal('5')}, self.formulation)
+
+        opening = IngredientLot.objects.get(ingredient=untracked)
+        self.assertEqual(opening.lot_number, 'opening')
+        self.assertEqual(opening.quantity, Decimal('15'))
+        untracked.refresh_from_db()
+        self.assertEqual(untracked.current_stock, Decimal('15'))
+
+
+class RuleImportTests(TestCase):
+    LIST = (
+        'ingredient,category,max_quantity,max_concentration,description\n'
+        'Linalool,,5,,\n'
+        ',allergen,,2.5,\n'
+        'Unknown thing,,1,,\n'
+        'Citral,,NaN,,\n'
+    )
+
+    def setUp(self):
+        self.linalool = Ingredient.objects.create(name='Linalool')
+        self.citral = Ingredient.objects.create(name='Citral', category='allergen')
+
+    def run_import(self, text, **kwargs):
+        return import_rules(read_rows(io.StringIO(text), 'csv'), **kwargs)
+
+    def test_import_reports_what_it_did(self):
+        result = self.run_import(self.LIST)
+
+        self.assertEqual(result.created, [('Linalool', '5.00'), ('category allergen', '2.50%')])
+        self.assertEqual(result.unknown, [(4, 'Unknown thing')])
+        self.assertEqual([line for line, _ in result.invalid], [5])
+        self.assertEqual(result.ingredient_ids, {self.linalool.pk, self.citral.pk})
+        rule = ComplianceRule.objects.get(ingredient=self.linalool)
+        self.assertEqual(rule.max_quantity, Decimal('5.00'))
+        self.assertIsNone(rule.max_concentration)
+        self.assertTrue(ComplianceRule.objects.filter(category='allergen', max_concentration=Decimal('2.50')).exists())
+
+    def test_reimport_changes_nothing(self):
+        self.run_import(self.LIST)
+        stamps = dict(ComplianceRule.objects.values_list('pk', 'updated_at'))
+
+        result = self.run_import(self.LIST)
+
+        self.assertEqual(result.written, 0)
+        self.assertEqual(result.unchanged, 2)
+        self.assertEqual(result.ingredient_ids, set())
+        self.assertEqual(dict(ComplianceRule.objects.values_list('pk', 'updated_at')), stamps)
+
+    def test_changed_limit_is_reported(self):
+        self.run_import(self.LIST)
+
+        result = self.run_import('ingredient,max_quantity\nLinalool,6\n')
+
+        self.assertEqual(result.changed, [('Linalool', '5.00', '6.00')])
+        self.assertEqual(ComplianceRule.objects.get(ingredient=self.linalool).max_quantity, Decimal('6.00'))
+
+    def test_dry_run_writes_nothing(self):
+        result = self.run_import(self.LIST, dry_run=True)
+
+        self.assertEqual(len(result.created), 2)
+        self.assertFalse(ComplianceRule.objects.exists())
+
+
+class ViolationTests(TestCase):
+    def setUp(self):
+        user = make_user('rd')
+        self.geraniol = Ingredient.objects.create(name='Geraniol', category='allergen')
+        self.citral = Ingredient.objects.create(name='Citral', category='allergen')
+        self.musk = Ingredient.objects.create(name='Musk')
+        self.water = Ingredient.objects.create(name='Water')
+        ComplianceRule.objects.create(ingredient=self.geraniol, max_quantity=Decimal('25'))
+        ComplianceRule.objects.create(ingredient=self.musk, max_concentration=Decimal('40'))
+        ComplianceRule.objects.create(category='allergen', max_concentration=Decimal('45'))
+        # 30 + 20 allergens in 100: geraniol over its quantity, musk at 50%
+        # over its concentration, allergens at 50% over theirs
+        self.failing = make_formulation(user, 'Failing', [(self.geraniol, 30), (self.citral, 20), (self.musk, 50)])
+        self.passing = make_formulation(user, 'Passing', [(self.citral, 10), (self.water, 90)])
+        bom.ensure_exploded()
+
+    def test_reports_each_broken_limit(self):
+        found = violations([self.failing.pk, self.passing.pk])
+
+        self.assertEqual(list(found), [self.failing.pk])
+        # Without the limit, whose decimal places depend on the database
+        descriptions = {(v.ingredient_id, v.description.split(' (')[0]) for v in found[self.failing.pk]}
+        self.assertEqual(descriptions, {
+            (self.geraniol.pk, 'Quantity exceeds maximum allowed'),
+            (self.musk.pk, 'Concentration 50.00% exceeds maximum allowed'),
+            # Reported once, against the category's largest ingredient
+            (self.geraniol.pk, 'Category allergen concentration 50.00% exceeds maximum allowed'),
+        })
+
+    def test_accords_count_towards_their_parent(self):
+        parent = make_formulation(self.failing.created_by, 'Parent', [(self.water, 50)], [(self.passing, 50)])
+        bom.ensure_exploded()
+
+        self.assertEqual(violations([parent.pk]), {})
+        ComplianceRule.objects.create(ingredient=self.citral, max_quantity=Decimal('4'))
+        found = violations([parent.pk])
+        self.assertEqual([v.ingredient_id for v in found[parent.pk]], [self.citral.pk])
+
+
+class ComplianceTwinTests(TestCase):
+    def setUp(self):
+        self.user = make_user('rd')
+        self.linalool = Ingredient.objects.create(name='Linalool')
+        self.twin = self.make_checked('Twin')
+
+    def make_checked(self, name):
+        formulation = make_formulation(self.user, name, [(self.linalool, 5)])
+        bom.ensure_exploded([formulation.pk])
+        formulation.refresh_composition_hash()
+        formulation.check_compliance()
+        return formulation
+
+    def test_compliant_twin_is_reused(self):
+        copy = self.make_checked('Copy')
+
+        self.assertEqual(copy.compliance_status, 'compliant')
+        self.assertEqual(copy.compliance_checked_at, self.twin.compliance_checked_at)
+
+    def test_rule_added_after_the_twin_was_checked(self):
+        ComplianceRule.objects.create(ingredient=self.linalool, max_quantity=Decimal('1'))
+        # A later save of the twin must not make its old check look current
+        self.twin.status = 'approved'
+        self.twin.save(update_fields=['status', 'updated_at'])
+
+        copy = self.make_checked('Copy')
+
+        self.assertEqual(copy.compliance_status, 'non_compliant')
+        self.assertTrue(ComplianceIssue.objects.filter(formulation=copy, ingredient=self.linalool).exists())
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        self.rd = make_user('rd')
+        self.qa = make_user('qa')
+        self.formulations = [
+            Formulation.objects.create(name=f'F{n}', version='1', created_by=self.rd) for n in range(5)
+        ]
+
+    def url(self, resource):
+        return reverse('dashboard:api_list', args=[resource])
+
+    def test_cursor_pagination_visits_every_row_once(self):
+        self.client.force_login(self.rd)
+        ids, url = [], self.url('formulations') + '?limit=2'
+        while url:
+            data = self.client.get(url).json()
+            self.assertLessEqual(len(data['results']), 2)
+            ids.extend(row['id'] for row in data['results'])
+            url = data['next']
+
+        self.assertEqual(ids, sorted(f.pk for f in self.formulations))
+
+    def test_invalid_cursor(self):
+        self.client.force_login(self.rd)
+        response = self.client.get(self.url('formulations'), {'cursor': '!!'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_permissions(self):
+        self.assertEqual(self.client.get(self.url('formulations')).status_code, 401)
+
+        self.client.force_login(self.qa)
+        self.assertEqual(self.client.get(self.url('ingredients')).status_code, 403)
+        self.assertEqual(self.client.get(self.url('qa-results')).status_code, 200)
+        self.assertEqual(self.client.get(self.url('unknown')).status_code, 404)
+        self.assertEqual(self.client.post(self.url('formulations')).status_code, 405)
+
+
+class BomTests(TestCase):
+    def setUp(self):
+        self.user = make_user('rd')
+        self.linalool = Ingredient.objects.create(name='Linalool')
+        self.citral = Ingredient.objects.create(name='Citral')
+        self.musk = Ingredient.objects.create(name='Musk')
+        # Committed, so each test's writes start a new batch of commit work
+        with self.captureOnCommitCallbacks(execute=True):
+            self.accord = make_formulation(self.user, 'Accord', [(self.linalool, 6), (self.citral, 4)])
+            self.parent = make_formulation(self.user, 'Parent', [(self.musk, 10)], [(self.accord, 5)])
+            self.grandparent = make_formulation(self.user, 'Grandparent', components=[(self.parent, 1)])
+
+    def test_explosion_scales_accords(self):
+        self.assertEqual(bom.explode(self.parent.pk), {
+            self.linalool.pk: Decimal('3'), self.citral.pk: Decimal('2'), self.musk.pk: Decimal('10'),
+        })
+
+    def test_closure_covers_indirect_components(self):
+        pairs = set(FormulationClosure.objects.values_list('ancestor_id', 'descendant_id'))
+        self.assertEqual(pairs, {
+            (self.parent.pk, self.accord.pk),
+            (self.grandparent.pk, self.parent.pk),
+            (self.grandparent.pk, self.accord.pk),
+        })
+
+        FormulationComponent.objects.get(parent=self.grandparent).delete()
+
+        self.assertEqual(list(FormulationClosure.objects.values_list('ancestor_id', 'descendant_id')),
+                         [(self.parent.pk, self.accord.pk)])
+
+    def test_cycles_are_rejected(self):
+        for parent, component in [(self.accord, self.grandparent), (self.accord, self.accord)]:
+            with self.assertRaises(ValidationError):
+                FormulationComponent.objects.create(parent=parent, component=component, quantity=1)
+        self.assertEqual(FormulationComponent.objects.count(), 2)
+
+    def test_accord_change_invalidates_its_users(self):
+        bom.ensure_exploded()
+        row = FormulationIngredient.objects.get(formulation=self.accord, ingredient=self.linalool)
+        row.quantity = Decimal('16')
+        row.save()
+
+        self.assertFalse(Formulation.objects.filter(pk__in=[self.parent.pk, self.grandparent.pk],
+                                                    bom_valid=True).exists())
+        exploded = bom.explode(self.parent.pk)
+        self.assertEqual(exploded[self.linalool.pk], Decimal('4'))
+        self.assertEqual(exploded[self.citral.pk], Decimal('1'))
+
+    def test_rebuilt_and_logged_once_per_transaction(self):
+        logged = CompositionChange.objects.count()
+        with self.captureOnCommitCallbacks(execute=True):
+            for ingredient in (self.linalool, self.citral):
+                FormulationIngredient.objects.create(formulation=self.grandparent, ingredient=ingredient, quantity=1)
+
+        self.assertEqual(CompositionChange.objects.count() - logged, 1)
+        self.assertTrue(Formulation.objects.get(pk=self.grandparent.pk).bom_valid)
+
+
+
+class FormulationFormTests(TestCase):
+    def setUp(self):
+        self.user = make_user('rd')
+        self.client.force_login(self.user)
+        self.url = reverse('dashboard:formulation_create')
+        self.linalool = Ingredient.objects.create(name='Linalool', current_stock=Decimal('100'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.accord = make_formulation(self.user, 'Accord', [(self.linalool, 10)])
+        self.accord.status = 'approved'
+        self.accord.save(update_fields=['status', 'updated_at'])
+
+    def post(self, **rows):
+        return self.client.post(self.url, {'name': 'New', 'version': '1', 'ingredient_ids[]': [''],
+                                           'ingredient_quantities[]': [''], **rows})
+
+    def test_accord_only_formulation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post(**{'component_ids[]': [self.accord.pk], 'component_quantities[]': ['5']})
+
+        formulation = Formulation.objects.get(name='New')
+        self.assertRedirects(response, reverse('dashboard:formulation_detail', args=[formulation.pk]),
+                             fetch_redirect_response=False)
+        self.assertEqual(list(formulation.components.all()), [self.accord])
+
+    def test_empty_composition_is_rejected(self):
+        response = self.post(**{'component_ids[]': [''], 'component_quantities[]': ['']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Formulation.objects.filter(name='New').exists())
+
+    def test_duplicate_is_rejected_with_the_posted_values(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            make_formulation(self.user, 'Original', [(self.linalool, 10)])
+
+        response = self.post(**{'name': 'Copy', 'version': '3', 'ingredient_ids[]': [self.linalool.pk],
+                                'ingredient_quantities[]': ['10']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['duplicate'].name, 'Original')
+        self.assertFalse(Formulation.objects.filter(name='Copy').exists())
+        self.assertEqual((response.context['name'], response.context['version']), ('Copy', '3'))
+        self.assertEqual(response.context['ingredient_rows'], [(str(self.linalool.pk), '10')])
+        self.assertContains(response, f'<option value="{self.linalool.pk}" data-stock="100.00" selected>')
+
+    def test_edit_keeps_signal_maintained_counters(self):
+        limonene = Ingredient.objects.create(name='Limonene', current_stock=Decimal('100'))
+        with self.captureOnCommitCallbacks(execute=True):
+            formulation = make_formulation(self.user, 'Edited', [(self.linalool, 10)])
+        ComplianceIssue.objects.create(formulation=formulation, ingredient=self.linalool, description='Too much')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('dashboard:formulation_edit', args=[formulation.pk]), {
+                'name': 'Edited', 'version': '2',
+                'ingredient_ids[]': [self.linalool.pk, limonene.pk], 'ingredient_quantities[]': ['5', '7'],
+            })
+
+        formulation.refresh_from_db()
+        actual = Formulation.objects.filter(pk=formulation.pk).values(**{
+            f'actual_{name}': expression for name, expression in Formulation.summary_expressions().items()
+        }).get()
+        self.assertEqual(formulation.version, '2')
+        self.assertEqual((formulation.ingredient_count, formulation.total_quantity), (2, Decimal('12')))
+        self.assertEqual(
+            (formulation.ingredient_count, formulation.total_quantity, formulation.open_issue_count),
+            (actual['actual_ingredient_count'], actual['actual_total_quantity'], actual['actual_open_issue_count']),
+        )
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.client.force_login(make_user('rd'))
+        self.url = reverse('dashboard:formulations')
+
+    def test_unchanged_page_is_not_modified(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+
+        repeat = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(repeat.status_code, 304)
+
+    def test_write_changes_the_etag(self):
+        first = self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            freshness.bump('formulation')
+
+        repeat = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(repeat.status_code, 200)
+        self.assertNotEqual(repeat['ETag'], first['ETag'])
+
+    def test_etag_covers_the_query_string(self):
+        first = self.client.get(self.url)
+
+        repeat = self.client.get(self.url + '?page=2', HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(repeat.status_code, 200)
+
+    def test_if_modified_since_alone_is_not_enough(self):
+        self.client.get(self.url)
+
+        repeat = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+
+        self.assertEqual(repeat.status_code, 200)
+        self.assertNotIn('Last-Modified', repeat)
+
+    def test_create_form_changes_with_formulations(self):
+        url = reverse('dashboard:formulation_create')
+        first = self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            freshness.bump('formulation')
+
+        repeat = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(repeat.status_code, 200)
+
+    def test_date_dependent_page_changes_daily(self):
+        self.client.force_login(make_user('manager'))
+        url = reverse('dashboard:production_capacity')
+        first = self.client.get(url)
+
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        with mock.patch('django.utils.timezone.localdate', return_value=tomorrow):
+            repeat = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(repeat.status_code, 200)
+
+
+class ProductionPlanTests(TestCase):
+    def setUp(self):
+        self.client.force_login(make_user('manager'))
+        self.formulation = Formulation.objects.create(name='Base', version='1', created_by=User.objects.get())
+        self.url = reverse('dashboard:production_plan_check')
+
+    def check(self, body):
+        return self.client.post(self.url, body, content_type='application/json')
+
+    def test_non_finite_batch_counts_are_rejected(self):
+        for batches in ('NaN', 'Infinity', '-Infinity'):
+            response = self.check(f'{{"plan": {{"{self.formulation.pk}": {batches}}}}}')
+            self.assertEqual(response.status_code, 400, batches)
+
+    def test_negative_batch_counts_are_rejected(self):
+        self.assertEqual(self.check({'plan': {self.formulation.pk: -1}}).status_code, 400)
+
+
+class ArchiveTests(TestCase):
+    def test_archived_formulation_leaves_the_live_tables(self):
+        user = make_user('rd')
+        linalool = Ingredient.objects.create(name='Linalool')
+        with self.captureOnCommitCallbacks(execute=True):
+            formulation = make_formulation(user, 'Old', [(linalool, 5)])
+        ComplianceIssue.objects.create(formulation=formulation, ingredient=linalool, description='Too much')
+        Formulation.objects.filter(pk=formulation.pk).update(
+            status='rejected', updated_at=timezone.now() - timedelta(days=400)
+        )
+        logged = CompositionChange.objects.count()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            moved = archive.archive_formulations(timezone.now() - timedelta(days=1))
+
+        self.assertEqual(moved, 1)
+        self.assertFalse(Formulation.objects.filter(pk=formulation.pk).exists())
+        self.assertFalse(FormulationIngredient.objects.filter(formulation_id=formulation.pk).exists())
+        self.assertEqual(ArchivedFormulationIngredient.objects.filter(formulation_id=formulation.pk).count(), 1)
+        self.assertEqual(ArchivedComplianceIssue.objects.filter(formulation_id=formulation.pk).count(), 1)
+        self.assertEqual(list(CompositionChange.objects.order_by('pk').values_list('formulation_id', flat=True)[logged:]),
+                         [formulation.pk])
+
+
+class PercentileTests(TestCase):
+    def test_nearest_rank(self):
+        values = list(range(1, 11))
+
+        self.assertEqual(percentile(values, 10), 1)
+        self.assertEqual(percentile(values, 50), 5)
+        self.assertEqual(percentile(values, 95), 10)
+        self.assertEqual(percentile(list(range(1, 21)), 95), 19)
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+
+@override_settings(AUDIT_BUFFER_SIZE=3, AUDIT_FLUSH_INTERVAL=60)
+class AuditTests(TestCase):
+    def setUp(self):
+        audit.flush()
+        self.addCleanup(audit.flush)
+
+    def test_rolled_back_event_is_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    audit.record('test_rollback')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+        self.assertEqual(audit.pending(), 0)
+        self.assertEqual(audit.flush(), 0)
+
+    def test_flushes_when_buffer_is_full(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            audit.record('test_size')
+            audit.record('test_size')
+        self.assertEqual(audit.pending(), 2)
+        self.assertFalse(AuditEvent.objects.filter(action='test_size').exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            audit.record('test_size')
+
+        self.assertEqual(audit.pending(), 0)
+        self.assertEqual(AuditEvent.objects.filter(action='test_size').count(), 3)
+
+    def test_flushes_when_interval_has_passed(self):
+        audit._last_flush -= 61
+        with self.captureOnCommitCallbacks(execute=True):
+            audit.record('test_interval')
+
+        self.assertEqual(audit.pending(), 0)
+        self.assertTrue(AuditEvent.objects.filter(action='test_interval').exists())
+
+    def test_rejected_events_are_bisected_out(self):
+        bulk_create = AuditEvent.objects.bulk_create
+
+        def reject_bad(events, **kwargs):
+            if any(event.action == 'test_bad' for event in events):
+                raise IntegrityError('rejected')
+            return bulk_create(events, **kwargs)
+
+        actions = ['test_good', 'test_bad', 'test_good', 'test_good', 'test_bad']
+        with override_settings(AUDIT_BUFFER_SIZE=100), self.captureOnCommitCallbacks(execute=True):
+            for action in actions:
+                audit.record(action)
+
+        with mock.patch.object(AuditEvent.objects, 'bulk_create', side_effect=reject_bad), \
+                self.assertLogs('dashboard.audit', 'ERROR') as logs:
+            written = audit.flush()
+
+        self.assertEqual(written, 3)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(set(AuditEvent.objects.values_list('action', flat=True)), {'test_good'})
+        self.assertEqual(audit.pending(), 0)
+
+
+class ComplianceSimulateTests(TestCase):
+    def setUp(self):
+        self.client.force_login(make_user('rd'))
+        self.ingredient = Ingredient.objects.create(name='Linalool')
+
+    def simulate(self, body):
+        return self.client.post(reverse('dashboard:compliance_simulate'), body, content_type='application/json')
+
+    def test_valid_request(self):
+        response = self.simulate({'rules': [{'ingredient_id': self.ingredient.pk, 'max_quantity': 5}], 'limit': 0})
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_rejects_negative_or_non_finite_limits(self):
+        for body in [
+            {'rules': [{'ingredient_id': self.ingredient.pk, 'max_quantity': 5}], 'limit': -1},
+            '{"rules": [], "limit": Infinity}',
+            '{"rules": [{"ingredient": "Linalool", "max_quantity": NaN}]}',
+            '{"rules": [{"ingredient": "Linalool", "max_quantity": -Infinity}]}',
+            {'rules': [{'ingredient_id': self.ingredient.pk, 'max_quantity': -1}]},
+        ]:
+            with self.subTest(body=body):
+                self.assertEqual(self.simulate(body).status_code, 400)
+
+
+class IngredientLotAdminTests(TestCase):
+    def test_moving_a_lot_refreshes_both_ingredients(self):
+        self.client.force_login(User.objects.create_superuser('admin', password='password'))
+        linalool = Ingredient.objects.create(name='Linalool')
+        citral = Ingredient.objects.create(name='Citral')
+        lot = lots.receive(linalool, Decimal('10'))
+        now = timezone.localtime()
+
+        response = self.client.post(reverse('admin:dashboard_ingredientlot_change', args=[lot.pk]), {
+            'ingredient': citral.pk, 'lot_number': lot.lot_number, 'quantity': '10',
+            'received_at_0': now.date().isoformat(), 'received_at_1': now.strftime('%H:%M:%S'),
+        })
+
+        self.assertEqual(response.status_code, 302)
+        linalool.refresh_from_db()
+        citral.refresh_from_db()
+        self.assertEqual((linalool.current_stock, citral.current_stock), (Decimal('0'), Decimal('10')))
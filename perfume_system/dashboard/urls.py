@@ -1,10 +1,19 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, metrics, views
+
+# Read-only pages with concurrent queries under ASGI (see async_views.py)
+if settings.ASYNC_VIEWS:
+    from . import async_views as page_views
+else:
+    page_views = views
 
 app_name = 'dashboard'
 
 urlpatterns = [
-    path('dashboard/', views.dashboard_view, name='dashboard'),
+    path('dashboard/', page_views.dashboard_view, name='dashboard'),
+    path('metrics', metrics.metrics_view, name='metrics'),
+    path('dashboard/stream/', views.dashboard_stream_view, name='dashboard_stream'),
 
     # Formulations URLs
     path('formulations/', views.formulations_view, name='formulations'),
@@ -19,19 +28,35 @@ urlpatterns = [
     path('inventory/<int:pk>/edit/', views.inventory_edit_view, name='inventory_edit'),
     path('inventory/<int:pk>/update/', views.inventory_update_view, name='inventory_update'),
     path('inventory-summary/', views.inventory_summary_view, name='inventory_summary'),
+    path('inventory/stock-levels/', views.stock_levels_view, name='stock_levels'),
 
     # Compliance URLs
     path('compliance/', views.compliance_list_view, name='compliance'),
     path('compliance/<int:pk>/fix/', views.compliance_fix_view, name='compliance_fix'),
+    path('compliance/simulate/', views.compliance_simulate_view, name='compliance_simulate'),
+    path('compliance/rules/import/', views.compliance_rules_import_view, name='compliance_rules_import'),
 
     # QA URLs
     path('qa-dashboard/', views.qa_dashboard_view, name='qa_dashboard'),
     path('qa/<int:pk>/approve/', views.qa_approve_view, name='qa_approve'),
     path('qa/<int:pk>/reject/', views.qa_reject_view, name='qa_reject'),
     path('qa/test-result/<int:pk>/', views.qa_test_result_view, name='qa_test_result'),
+    path('qa/bulk-review/', views.qa_bulk_review_view, name='qa_bulk_review'),
     
+    # Production URLs
+    path('production/', views.production_capacity_view, name='production_capacity'),
+    path('production/plan-check/', views.production_plan_check_view, name='production_plan_check'),
+
+    # Audit URLs
+    path('audit/', views.audit_log_view, name='audit_log'),
+
+    # Read-only JSON API
+    path('api/v1/<slug:resource>/', api.resource_list, name='api_list'),
+    path('api/v1/<slug:resource>/<int:pk>/', api.resource_detail, name='api_detail'),
+
     # Reports URL
-    path('reports/', views.reports_view, name='reports'),
+    path('reports/', page_views.reports_view, name='reports'),
     path('reports/download/formulations/', views.download_formulation_report, name='download_formulation_report'),
     path('reports/download/ingredients/', views.download_ingredient_report, name='download_ingredient_report'),
+    path('reports/download/snapshot/<str:table>/', views.download_snapshot, name='download_snapshot'),
 ]
\ No newline at end of file
@@ -1,7 +1,8 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.db import transaction
 from django.db.models import F, Count, Sum
 from accounts.models import Role
 from .models import (
@@ -10,117 +11,133 @@ from .models import (
     ComplianceIssue, 
     FormulationIngredient, 
     ComplianceRule, 
-    QATestResult
+    QATestResult,
+    AuditEvent,
+    ArchivedFormulation,
+    FormulationClosure,
+    FormulationComponent,
 )
 from django.contrib import messages
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
 from decimal import Decimal, InvalidOperation
-import plotly.graph_objects as go
 from django.http import HttpResponse
 import csv
-from datetime import timedelta
+import io
+import json
+import math
+import tempfile
+from itertools import chain
+from datetime import date, timedelta
+from . import bom, lots
+from .freshness import bump, conditional
+from .profiling import render, timer
+from . import audit
+from .signals import notify_dashboard_change
+
+# Roles allowed to bulk-import compliance rules
+RULE_IMPORT_ROLES = ['qa', 'manager']
 
 # Base Dashboard Views
 @login_required
+@conditional('formulation', 'ingredient', 'complianceissue')
 def dashboard_view(request):
     # Check if user has manager role
     user_roles = request.user.roles.all()
     if not user_roles.filter(name='manager').exists():
         return redirect('dashboard:formulations')
-    
-    # Basic Stats
-    total_formulations = Formulation.objects.count()
-    compliance_issues_count = ComplianceIssue.objects.filter(status='open').count()
-    approved_formulations = Formulation.objects.filter(status='approved').count()
-    pending_qa = Formulation.objects.filter(status='pending_qa').count()
-    
-    # Compliance Distribution for Pie Chart
-    compliance_fig = go.Figure(data=[
-        go.Pie(
-            labels=['Compliant', 'Non-Compliant', 'Pending'],
-            values=[
-                Formulation.objects.filter(compliance_status='compliant').count(),
-                Formulation.objects.filter(compliance_status='non_compliant').count(),
-                Formulation.objects.filter(compliance_status='pending').count()
-            ],
-            hole=.3,
-            marker_colors=['#22c55e', '#ef4444', '#f59e0b'],  # Green, Red, Yellow
-            textinfo='percent+label'
-        )
-    ])
-    
-    compliance_fig.update_layout(
-        showlegend=True,
-        margin=dict(t=0, b=0, l=0, r=0),
-        height=300,
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)'
-    )
 
-    # Stock Levels Bar Chart with Thresholds
-    ingredients = Ingredient.objects.all()
-    stock_fig = go.Figure()
-    
-    # Add current stock bars
-    stock_fig.add_trace(go.Bar(
-        name='Current Stock',
-        x=[ing.name for ing in ingredients],
-        y=[float(ing.current_stock) for ing in ingredients],
-        marker_color='#3b82f6'  # Blue
-    ))
-
-    # Add threshold line
-    stock_fig.add_trace(go.Scatter(
-        name='Reorder Threshold',
-        x=[ing.name for ing in ingredients],
-        y=[float(ing.reorder_threshold) for ing in ingredients],
-        mode='lines',
-        line=dict(color='#ef4444', width=2, dash='dash')  # Red dashed line
-    ))
-
-    stock_fig.update_layout(
-        barmode='group',
-        margin=dict(t=0, b=0, l=0, r=0),
-        height=300,
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        yaxis=dict(
-            gridcolor='rgba(0,0,0,0.1)',
-            zerolinecolor='rgba(0,0,0,0.2)'
-        ),
-        showlegend=True
-    )
-    
-    # Additional Stats
-    recent_formulations = Formulation.objects.all()[:5]
-    low_stock_count = Ingredient.objects.filter(current_stock__lte=F('reorder_threshold')).count()
+    results = {name: query() for name, query in dashboard_queries().items()}
+    return render(request, 'dashboard/dashboard.html', {**dashboard_context(results), 'live': live_updates(request)})
+
+def live_updates(request):
+    """
+    Whether the dashboard stream can be served. Under WSGI the stream would
+    hold a worker thread for as long as the page stays open.
+    """
+    return isinstance(request, ASGIRequest)
+
+def dashboard_queries():
+    """
+    The independent queries behind the dashboard, as {name: callable}.
+    async_views.py runs them concurrently; each returns plain values.
+    """
+    from .stock_levels import stock_chart_data
+    low_stock = Ingredient.objects.filter(current_stock__lte=F('reorder_threshold'))
+    return {
+        # Basic Stats
+        'total_formulations': Formulation.objects.count,
+        'compliance_issues_count': ComplianceIssue.objects.filter(status='open').count,
+        'approved_formulations': Formulation.objects.filter(status='approved').count,
+        'pending_qa': Formulation.objects.filter(status='pending_qa').count,
+
+        # Compliance Distribution for Pie Chart
+        'compliant_count': Formulation.objects.filter(compliance_status='compliant').count,
+        'non_compliant_count': Formulation.objects.filter(compliance_status='non_compliant').count,
+        'compliance_pending_count': Formulation.objects.filter(compliance_status='pending').count,
+        'stock_data': stock_chart_data,
 
-    context = {
+        # Additional Stats
+        'recent_formulations': lambda: list(Formulation.objects.all()[:5]),
+        'low_stock_count': low_stock.count,
+        'low_stock_items': lambda: list(low_stock.order_by('current_stock')[:10]),
+        'total_ingredients': Ingredient.objects.count,
+        'open_issues': lambda: list(ComplianceIssue.objects.filter(status='open')[:5]),
+    }
+
+def dashboard_context(results):
+    compliance_counts = [
+        results['compliant_count'],
+        results['non_compliant_count'],
+        results['compliance_pending_count'],
+    ]
+    with timer('chart'):
+        from .charts import dashboard_charts
+        compliance_chart, stock_chart = dashboard_charts(compliance_counts, results['stock_data'])
+
+    return {
         # Main Stats
-        'total_formulations': total_formulations,
-        'compliance_issues_count': compliance_issues_count,
-        'approved_formulations': approved_formulations,
-        'pending_qa': pending_qa,
+        'total_formulations': results['total_formulations'],
+        'compliance_issues_count': results['compliance_issues_count'],
+        'approved_formulations': results['approved_formulations'],
+        'pending_qa': results['pending_qa'],
         
         # Charts
-        'compliance_chart': compliance_fig.to_html(
-            full_html=False,
-            config={'displayModeBar': False}
-        ),
-        'stock_chart': stock_fig.to_html(
-            full_html=False,
-            config={'displayModeBar': False}
-        ),
+        'compliance_chart': compliance_chart,
+        'stock_chart': stock_chart,
+        'stock_others': results['stock_data']['others'],
         
         # Additional Stats
-        'recent_formulations': recent_formulations,
-        'low_stock_count': low_stock_count,
-        'total_ingredients': Ingredient.objects.count(),
-        'open_issues': ComplianceIssue.objects.filter(status='open')[:5],
+        'recent_formulations': results['recent_formulations'],
+        'low_stock_count': results['low_stock_count'],
+        'low_stock_items': results['low_stock_items'],
+        'total_ingredients': results['total_ingredients'],
+        'open_issues': results['open_issues'],
     }
-    
-    return render(request, 'dashboard/dashboard.html', context)
+
+async def dashboard_stream_view(request):
+    """
+    Server-sent events stream of dashboard stat deltas, served only through
+    perfume_system.asgi. Under WSGI it answers 204, which tells EventSource
+    not to reconnect.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+    if not await user.roles.filter(name='manager').aexists():
+        return HttpResponse(status=403)
+    if not live_updates(request):
+        return HttpResponse(status=204)
+
+    from .live import event_stream
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 # Formulation Views
 @login_required
+@conditional('formulation')
 def formulations_view(request):
     user_roles = request.user.roles.all()
     if not user_roles.filter(name__in=['rd', 'qa']).exists():
@@ -132,84 +149,115 @@ def formulations_view(request):
     })
 
 @login_required
+@conditional('formulation', 'ingredient', 'complianceissue')
 def formulation_detail_view(request, pk):
     user_roles = request.user.roles.all()
     if not user_roles.filter(name__in=['rd', 'qa']).exists():
         return redirect('dashboard:dashboard')
     
-    formulation = get_object_or_404(Formulation, pk=pk)
-    compliance_issues = ComplianceIssue.objects.filter(formulation=formulation)
+    from .archive import compliance_issues_for, get_formulation
+    formulation = get_formulation(pk)
+    if formulation is None:
+        raise Http404('No formulation matches the given query.')
+    compliance_issues = compliance_issues_for(formulation)
+
+    similar_formulations = []
+    if not getattr(formulation, 'archived', False):
+        from .similarity import index
+        scores = index.similar_to(formulation.pk)
+        similar = Formulation.objects.in_bulk([pk for pk, _ in scores])
+        similar_formulations = [
+            {'formulation': similar[pk], 'similarity': score}
+            for pk, score in scores if pk in similar
+        ]
+
+    accords, exploded_ingredients = [], []
+    if not getattr(formulation, 'archived', False):
+        accords = formulation.component_links.select_related('component')
+        if accords:
+            exploded = bom.explosions([formulation.pk])[formulation.pk]
+            names = dict(Ingredient.objects.filter(pk__in=exploded).values_list('pk', 'name'))
+            exploded_ingredients = sorted(
+                ({'name': names[pk], 'quantity': quantity} for pk, quantity in exploded.items()),
+                key=lambda row: row['quantity'], reverse=True,
+            )
+
     return render(request, 'dashboard/formulations/detail.html', {
         'formulation': formulation,
         'compliance_issues': compliance_issues,
+        'similar_formulations': similar_formulations,
+        'accords': accords,
+        'exploded_ingredients': exploded_ingredients,
     })
 
 @login_required
+@conditional('formulation', 'ingredient')
 def formulation_create_view(request):
     if not request.user.roles.filter(name='rd').exists():
         return redirect('dashboard:formulations')
     
     if request.method == 'POST':
+        composition_hash = _posted_composition_hash(request)
+        duplicate = Formulation(composition_hash=composition_hash).find_duplicate()
+        if duplicate and not request.POST.get('allow_duplicate'):
+            messages.error(request, f'{duplicate} already has exactly this composition. '
+                                    'Tick "Save even if identical" to create it anyway.')
+            return _render_form(request, duplicate=duplicate)
+
         try:
+            ingredients = _posted_ingredients(request)
+            components = _posted_components(request)
+
+            # Validate at least one ingredient or accord
+            if not ingredients and not components:
+                messages.error(request, 'At least one ingredient or accord is required')
+                return _render_form(request)
+
             # Create formulation
             formulation = Formulation.objects.create(
                 name=request.POST['name'],
-                                version=request.POST['version'],
-                created_by=request.user
+                version=request.POST['version'],
+                created_by=request.user,
+                composition_hash=composition_hash
             )
 
-            # Get ingredients and quantities
-            ingredient_ids = request.POST.getlist('ingredient_ids[]')
-            ingredient_quantities = request.POST.getlist('ingredient_quantities[]')
+            # Process ingredients
+            for id, quantity in ingredients:
+                ingredient = get_object_or_404(Ingredient, pk=id)
 
-            # Validate at least one ingredient
-            if not ingredient_ids or not ingredient_quantities:
-                messages.error(request, 'At least one ingredient is required')
-                formulation.delete()
-                available_ingredients = Ingredient.objects.all()
-                return render(request, 'dashboard/formulations/form.html', {
-                    'available_ingredients': available_ingredients
-                })
-
-            # Process ingredients and update stock
-            for id, quantity in zip(ingredient_ids, ingredient_quantities):
-                if id and quantity:
-                    ingredient = get_object_or_404(Ingredient, pk=id)
-                    quantity_decimal = Decimal(str(quantity))
-
-                    # Check stock
-                    if quantity_decimal > ingredient.current_stock:
-                        messages.error(request, f'Not enough stock for {ingredient.name}. Available: {ingredient.current_stock}')
-                        formulation.delete()
-                        return redirect('dashboard:formulations')
-
-                    # Create ingredient relationship
-                    FormulationIngredient.objects.create(
-                        formulation=formulation,
-                        ingredient=ingredient,
-                        quantity=quantity_decimal
-                    )
+                # Create ingredient relationship
+                FormulationIngredient.objects.create(
+                    formulation=formulation,
+                    ingredient=ingredient,
+                    quantity=Decimal(str(quantity))
+                )
 
-                    # Update inventory stock
-                    ingredient.current_stock -= quantity_decimal
-                    ingredient.save()
+            _add_components(formulation, components)
+
+            # Deduct the whole exploded composition from stock, first
+            # expiry first out across lots; raises if anything is short
+            lots.allocate(bom.usage(formulation.pk), formulation, request.user)
 
             # Check compliance
             formulation.check_compliance()
 
+            audit.record('formulation_created', formulation, request.user,
+                         compliance_status=formulation.compliance_status)
             messages.success(request, 'Formulation created successfully!')
             return redirect('dashboard:formulation_detail', pk=formulation.pk)
+        except ValidationError as e:
+            messages.error(request, ' '.join(e.messages))
+            if 'formulation' in locals():
+                formulation.delete()
         except Exception as e:
             messages.error(request, f'Error creating formulation: {str(e)}')
             if 'formulation' in locals():
                 formulation.delete()
 
-    available_ingredients = Ingredient.objects.all()
-    return render(request, 'dashboard/formulations/form.html', {
-        'available_ingredients': available_ingredients
-    })
+    return _render_form(request)
 
 @login_required
+@conditional('formulation', 'ingredient')
 def formulation_edit_view(request, pk):
     if not request.user.roles.filter(name='rd').exists():
         return redirect('dashboard:formulations')
@@ -217,80 +265,153 @@ def formulation_edit_view(request, pk):
     formulation = get_object_or_404(Formulation, pk=pk)
     
     if request.method == 'POST':
+        composition_hash = _posted_composition_hash(request)
+        duplicate = formulation.find_duplicate(composition_hash)
+        if duplicate and not request.POST.get('allow_duplicate'):
+            messages.error(request, f'{duplicate} already has exactly this composition. '
+                                    'Tick "Save even if identical" to save it anyway.')
+            return _render_form(request, formulation, duplicate=duplicate)
+
         try:
-            # Store old ingredients and quantities to restore stock if needed
-            old_ingredients = {fi.ingredient: fi.quantity for fi in formulation.formulation_ingredients.all()}
-            
-            formulation.name = request.POST['name']
-            formulation.version = request.POST['version']
-            formulation.save()
-            
-            # First restore old stock
-            for ingredient, quantity in old_ingredients.items():
-                ingredient.current_stock += quantity
-                ingredient.save()
-            
-            # Delete existing ingredients
-            formulation.formulation_ingredients.all().delete()
-            
-            # Add new ingredients and update stock
-            ingredient_ids = request.POST.getlist('ingredient_ids[]')
-            ingredient_quantities = request.POST.getlist('ingredient_quantities[]')
-            
-            for id, quantity in zip(ingredient_ids, ingredient_quantities):
-                if id and quantity:
-                    try:
-                        ingredient = get_object_or_404(Ingredient, pk=id)
-                        quantity_decimal = Decimal(str(quantity))
-                        
-                        # Check if quantity is within stock limits
-                        if quantity_decimal > ingredient.current_stock:
-                            # Restore previous state
-                            for ing, qty in old_ingredients.items():
-                                ing.current_stock -= qty
-                                ing.save()
-                            
-                            messages.error(request, f'Not enough stock for {ingredient.name}. Available: {ingredient.current_stock}')
-                            return render(request, 'dashboard/formulations/form.html', {
-                                'formulation': formulation,
-                                'available_ingredients': Ingredient.objects.all()
-                            })
-                        
-                        # Create formulation ingredient and update stock
-                        FormulationIngredient.objects.create(
-                            formulation=formulation,
-                            ingredient=ingredient,
-                            quantity=quantity_decimal
-                        )
-                        
-                        # Update the ingredient stock
-                        ingredient.current_stock -= quantity_decimal
-                        ingredient.save()
-                        
-                    except Exception as e:
-                        # Restore previous state on error
-                        for ing, qty in old_ingredients.items():
-                            ing.current_stock -= qty
-                            ing.save()
-                        raise e
+            components = _posted_components(request)
+        except (ValueError, InvalidOperation):
+            messages.error(request, 'Accord quantities must be numbers.')
+            return _render_form(request, formulation)
+        ingredients = _posted_ingredients(request)
+        if not ingredients and not components:
+            messages.error(request, 'At least one ingredient or accord is required')
+            return _render_form(request, formulation)
+        cyclic = _cyclic_component(formulation, components)
+        if cyclic:
+            messages.error(request, f'{cyclic} already contains this formulation and cannot be used as its accord.')
+            return _render_form(request, formulation)
+
+        try:
+            with transaction.atomic():
+                # Stock used by the composition being replaced
+                old_usage = bom.usage(formulation.pk)
+
+                formulation.name = request.POST['name']
+                formulation.version = request.POST['version']
+                formulation.composition_hash = composition_hash
+                # Only the edited columns: the counters are kept by signals
+                # and compliance by check_compliance(), so a full save would
+                # write back whatever this instance read before them
+                formulation.save(update_fields=['name', 'version', 'composition_hash', 'updated_at'])
+
+                # First return the old stock to the lots it came from
+                lots.release(formulation, request.user, expected=old_usage)
+
+                # Delete existing ingredients and accords
+                formulation.formulation_ingredients.all().delete()
+                formulation.component_links.all().delete()
+
+                # Add new ingredients
+                for id, quantity in ingredients:
+                    FormulationIngredient.objects.create(
+                        formulation=formulation,
+                        ingredient=get_object_or_404(Ingredient, pk=id),
+                        quantity=Decimal(str(quantity))
+                    )
+
+                _add_components(formulation, components)
+
+                # Then deduct the new composition; a shortage rolls the whole
+                # edit back, returned stock included
+                lots.allocate(bom.usage(formulation.pk), formulation, request.user)
             
             # Re-check compliance after editing ingredients
-            if formulation.check_compliance():
+            compliant = formulation.check_compliance()
+            audit.record('formulation_updated', formulation, request.user,
+                         compliance_status=formulation.compliance_status)
+            if compliant:
                 messages.success(request, 'Formulation updated and is compliant.')
             else:
                 messages.warning(request, 'Formulation updated but has compliance issues. Please review.')
             
             return redirect('dashboard:formulation_detail', pk=formulation.pk)
             
+        except ValidationError as e:
+            formulation.refresh_from_db()
+            messages.error(request, ' '.join(e.messages))
         except Exception as e:
             messages.error(request, f'Error updating formulation: {str(e)}')
     
-    available_ingredients = Ingredient.objects.all()
+    return _render_form(request, formulation)
+
+def _render_form(request, formulation=None, **context):
+    # Approved formulations can be used as accords, plus any already used here
+    accords = Formulation.objects.filter(status='approved')
+    if formulation is not None:
+        accords = (accords | Formulation.objects.filter(parent_links__parent=formulation)).exclude(pk=formulation.pk)
+    if request.method == 'POST':
+        # A rejected submission comes back with what was entered
+        name, version = request.POST.get('name', ''), request.POST.get('version', '')
+        ingredient_rows = _posted_rows(request, 'ingredient_ids[]', 'ingredient_quantities[]')
+        accord_rows = _posted_rows(request, 'component_ids[]', 'component_quantities[]')
+    else:
+        name = formulation.name if formulation else ''
+        version = formulation.version if formulation else '1.0'
+        ingredient_rows = accord_rows = []
     return render(request, 'dashboard/formulations/form.html', {
         'formulation': formulation,
-        'available_ingredients': available_ingredients
+        'name': name,
+        'version': version,
+        # At least one row each to fill in
+        'ingredient_rows': ingredient_rows or [('', '')],
+        'accord_rows': accord_rows or [('', '')],
+        'available_ingredients': Ingredient.objects.all(),
+        'available_accords': accords.distinct().order_by('name', 'version'),
+        **context,
     })
 
+def _posted_rows(request, ids_field, quantities_field):
+    """[(id, quantity)] as posted, for every row with either filled in."""
+    return [
+        (id, quantity)
+        for id, quantity in zip(request.POST.getlist(ids_field), request.POST.getlist(quantities_field))
+        if id or quantity
+    ]
+
+def _posted_ingredients(request):
+    """[(ingredient id, quantity)] from the filled-in ingredient rows of a create/edit form."""
+    return [
+        (id, quantity)
+        for id, quantity in zip(request.POST.getlist('ingredient_ids[]'),
+                                request.POST.getlist('ingredient_quantities[]'))
+        if id and quantity
+    ]
+
+def _posted_components(request):
+    """[(accord id, quantity)] from the accord rows of a create/edit form."""
+    return [
+        (int(id), Decimal(str(quantity)))
+        for id, quantity in zip(request.POST.getlist('component_ids[]'),
+                                request.POST.getlist('component_quantities[]'))
+        if id and quantity
+    ]
+
+def _cyclic_component(formulation, components):
+    """The first posted accord that is, or contains, the formulation itself."""
+    ids = [id for id, _ in components]
+    if formulation.pk in ids:
+        return formulation
+    link = FormulationClosure.objects.filter(ancestor_id__in=ids, descendant_id=formulation.pk).first()
+    return link and Formulation.objects.get(pk=link.ancestor_id)
+
+def _add_components(formulation, components):
+    """Link the accords; their stock is allocated with the rest of the formulation."""
+    for component_id, quantity in components:
+        FormulationComponent.objects.create(parent=formulation, component_id=component_id, quantity=quantity)
+
+def _posted_composition_hash(request):
+    """composition_fingerprint() of the ingredient and accord rows in a create/edit form."""
+    try:
+        return bom.posted_fingerprint(_posted_ingredients(request), _posted_components(request))
+    except (ValueError, InvalidOperation):
+        # Malformed rows are reported by the normal save path
+        return ''
+
 @login_required
 def formulation_submit_qa(request, pk):
     if not request.user.roles.filter(name='rd').exists():
@@ -299,12 +420,14 @@ def formulation_submit_qa(request, pk):
 
     formulation = get_object_or_404(Formulation, pk=pk)
     formulation.status = 'pending_qa'
-    formulation.save()
+    formulation.save(update_fields=['status', 'updated_at'])
+    audit.record('formulation_submitted_qa', formulation, request.user)
     messages.success(request, "Formulation submitted for QA approval.")
     return redirect('dashboard:formulation_detail', pk=pk)
 
 # Inventory Views
 @login_required
+@conditional('ingredient')
 def inventory_list_view(request):
     if not request.user.roles.filter(name__in=['rd', 'manager']).exists():
         return redirect('dashboard:dashboard')
@@ -321,11 +444,19 @@ def inventory_create_view(request):
     
     if request.method == 'POST':
         try:
-            ingredient = Ingredient.objects.create(
-                name=request.POST['name'],
-                current_stock=Decimal(request.POST['current_stock']),
-                reorder_threshold=Decimal(request.POST['reorder_threshold'])
-            )
+            opening_stock = Decimal(request.POST['current_stock'])
+            with transaction.atomic():
+                ingredient = Ingredient.objects.create(
+                    name=request.POST['name'],
+                    reorder_threshold=Decimal(request.POST['reorder_threshold']),
+                    category=request.POST.get('category', '').strip()
+                )
+                # Initial stock becomes the ingredient's first lot
+                if opening_stock > 0:
+                    lots.receive(ingredient, opening_stock, lot_number='opening', user=request.user)
+            audit.record('ingredient_created', ingredient, request.user,
+                         current_stock=ingredient.current_stock,
+                         reorder_threshold=ingredient.reorder_threshold)
             messages.success(request, 'Ingredient added successfully.')
             return redirect('dashboard:inventory')
         except Exception as e:
@@ -334,6 +465,7 @@ def inventory_create_view(request):
     return render(request, 'dashboard/inventory/form.html')
 
 @login_required
+@conditional('ingredient')
 def inventory_edit_view(request, pk):
     if not request.user.roles.filter(name='rd').exists():
         return redirect('dashboard:inventory')
@@ -342,10 +474,23 @@ def inventory_edit_view(request, pk):
     
     if request.method == 'POST':
         try:
+            old_stock, old_threshold = ingredient.current_stock, ingredient.reorder_threshold
+            old_category = ingredient.category
             ingredient.name = request.POST['name']
-            ingredient.current_stock = Decimal(request.POST['current_stock'])
             ingredient.reorder_threshold = Decimal(request.POST['reorder_threshold'])
-            ingredient.save()
+            ingredient.category = request.POST.get('category', '').strip()
+            with transaction.atomic():
+                ingredient.save(update_fields=['name', 'reorder_threshold', 'category', 'updated_at'])
+                new_stock = Decimal(request.POST['current_stock'])
+                if new_stock != old_stock:
+                    lots.adjust(ingredient, new_stock, request.user)
+                if ingredient.category != old_category:
+                    # Other category rules now apply to formulations using it
+                    from .rule_import import recheck
+                    recheck([ingredient.pk])
+            audit.record('ingredient_updated', ingredient, request.user,
+                         old_stock=old_stock, new_stock=ingredient.current_stock,
+                         old_threshold=old_threshold, new_threshold=ingredient.reorder_threshold)
             messages.success(request, 'Ingredient updated successfully.')
             return redirect('dashboard:inventory')
         except Exception as e:
@@ -356,6 +501,7 @@ def inventory_edit_view(request, pk):
     })
 
 @login_required
+@conditional('ingredient', daily=True)
 def inventory_update_view(request, pk):
     if not request.user.roles.filter(name='rd').exists():
         return redirect('dashboard:inventory')
@@ -364,43 +510,71 @@ def inventory_update_view(request, pk):
     
     if request.method == 'POST':
         try:
-            new_stock = Decimal(request.POST['current_stock'])
-            ingredient.current_stock = new_stock
-            ingredient.save()
-            messages.success(request, f'Stock updated for {ingredient.name}')
+            if request.POST.get('action') == 'receive':
+                expires_at = request.POST.get('expires_at')
+                lot = lots.receive(
+                    ingredient,
+                    Decimal(request.POST['quantity']),
+                    expires_at=date.fromisoformat(expires_at) if expires_at else None,
+                    lot_number=request.POST.get('lot_number', '').strip(),
+                    user=request.user,
+                )
+                messages.success(request, f'Received {lot.quantity} of {ingredient.name}')
+            else:
+                # A stock count; the difference is added as a lot or taken FEFO
+                lots.adjust(ingredient, Decimal(request.POST['current_stock']), request.user)
+                messages.success(request, f'Stock updated for {ingredient.name}')
             return redirect('dashboard:inventory')
+        except ValidationError as e:
+            messages.error(request, ' '.join(e.messages))
         except Exception as e:
             messages.error(request, f'Error updating stock: {str(e)}')
     
     return render(request, 'dashboard/inventory/update_stock.html', {
-        'ingredient': ingredient
+        'ingredient': ingredient,
+        'lots': ingredient.lots.filter(quantity__gt=0).order_by(
+            F('expires_at').asc(nulls_last=True), 'received_at'
+        ),
+        'today': timezone.localdate(),
     })
 
 @login_required
+@conditional('ingredient', 'forecast', daily=True)
 def inventory_summary_view(request):
     if not request.user.roles.filter(name='manager').exists():
         return redirect('dashboard:dashboard')
     
     ingredients = Ingredient.objects.all().order_by('name')
     low_stock_ingredients = [i for i in ingredients if i.status == 'low_stock']
+
+    # Depletion forecasts are precomputed by the forecast_depletion command
+    from .forecasting import get_forecasts
+    forecast_data = get_forecasts()
+    if forecast_data:
+        for ingredient in ingredients:
+            ingredient.forecast = forecast_data['forecasts'].get(ingredient.pk)
     
     return render(request, 'dashboard/inventory-summary/inventory-summary.html', {
         'ingredients': ingredients,
-        'low_stock_ingredients': low_stock_ingredients
+        'low_stock_ingredients': low_stock_ingredients,
+        'forecast_computed_at': forecast_data['computed_at'] if forecast_data else None,
     })
 
 # Compliance Views
 @login_required
+@conditional('complianceissue', 'formulation', 'ingredient')
 def compliance_list_view(request):
     if not request.user.roles.filter(name__in=['rd', 'qa']).exists():
         return redirect('dashboard:dashboard')
     
     compliance_issues = ComplianceIssue.objects.all().order_by('-created_at')
     return render(request, 'dashboard/compliance/list.html', {
-        'compliance_issues': compliance_issues
+        'compliance_issues': compliance_issues,
+        'can_import_rules': request.user.roles.filter(name__in=RULE_IMPORT_ROLES).exists(),
     })
 
 @login_required
+@conditional('complianceissue', 'formulation', 'ingredient')
 def compliance_fix_view(request, pk):
     if not request.user.roles.filter(name='rd').exists():
         return redirect('dashboard:compliance')
@@ -410,11 +584,15 @@ def compliance_fix_view(request, pk):
     if request.method == 'POST':
         try:
             action = request.POST.get('action')
+            old_status = issue.status
             if action == 'mark_in_progress':
                 issue.status = 'in_progress'
             elif action == 'mark_resolved':
                 issue.status = 'resolved'
             issue.save()
+            audit.record('compliance_issue_status', issue, request.user,
+                         old_status=old_status, new_status=issue.status,
+                         formulation_id=issue.formulation_id)
             
             messages.success(request, f'Compliance issue status updated to {issue.get_status_display()}')
             return redirect('dashboard:compliance')
@@ -425,16 +603,155 @@ def compliance_fix_view(request, pk):
         'issue': issue
     })
 
+@login_required
+def compliance_simulate_view(request):
+    """
+    What-if check of proposed compliance limits across every formulation.
+    Expects a JSON body: {"rules": [{"ingredient_id": 1, "max_quantity": 5}, ...]}
+    (ingredients may be given by "ingredient" name instead); writes nothing.
+    """
+    if not request.user.roles.filter(name__in=['rd', 'qa']).exists():
+        return JsonResponse({'error': 'Not authorized'}, status=403)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST a JSON body of proposed rules'}, status=405)
+
+    try:
+        payload = json.loads(request.body)
+        rules = payload['rules']
+        names = {r['ingredient'] for r in rules if 'ingredient_id' not in r}
+        ids_by_name = dict(Ingredient.objects.filter(name__in=names).values_list('name', 'pk'))
+        missing = names - set(ids_by_name)
+        if missing:
+            return JsonResponse({'error': f"Unknown ingredient(s): {', '.join(sorted(missing))}"}, status=400)
+        proposed = {
+            int(r['ingredient_id']) if 'ingredient_id' in r else ids_by_name[r['ingredient']]: Decimal(str(r['max_quantity']))
+            for r in rules
+        }
+        limit = int(payload.get('limit', 100))
+        if limit < 0:
+            raise ValueError('limit must not be negative')
+        if not all(value.is_finite() and value >= 0 for value in proposed.values()):
+            raise ValueError('max_quantity must be a finite, non-negative number')
+        unknown = set(proposed) - set(Ingredient.objects.filter(pk__in=proposed).values_list('pk', flat=True))
+        if unknown:
+            return JsonResponse({'error': f"Unknown ingredient id(s): {', '.join(map(str, sorted(unknown)))}"},
+                                status=400)
+    except (ValueError, KeyError, TypeError, InvalidOperation, OverflowError) as e:
+        return JsonResponse({'error': f'Invalid request: {e}'}, status=400)
+
+    from .simulation import simulate_rules
+    return JsonResponse(simulate_rules(proposed, limit=limit))
+
+@login_required
+def compliance_rules_import_view(request):
+    """Upload a regulatory limit list (CSV or JSON) and show what it changed."""
+    if not request.user.roles.filter(name__in=RULE_IMPORT_ROLES).exists():
+        messages.error(request, "You are not authorized to import compliance rules.")
+        return redirect('dashboard:dashboard')
+
+    from . import rule_import
+    context = {'formats': rule_import.FORMATS}
+    if request.method == 'POST':
+        upload = request.FILES.get('rules_file')
+        if upload is None:
+            messages.error(request, 'Choose a CSV or JSON file to import.')
+            return render(request, 'dashboard/compliance/import.html', context)
+
+        dry_run = bool(request.POST.get('dry_run'))
+        fmt = request.POST.get('format') or rule_import.format_for(upload.name)
+        try:
+            stream = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+            result = rule_import.import_rules(rule_import.read_rows(stream, fmt),
+                                              dry_run=dry_run, user=request.user)
+        except (ValueError, UnicodeDecodeError) as e:
+            messages.error(request, f'Could not read {upload.name}: {e}')
+            return render(request, 'dashboard/compliance/import.html', context)
+
+        context['result'] = result
+        if request.POST.get('recheck') and result.ingredient_ids:
+            if dry_run:
+                context['affected'] = rule_import.affected_formulations(result.ingredient_ids).count()
+            else:
+                context['rechecked'], context['non_compliant'] = rule_import.recheck(result.ingredient_ids)
+        if not dry_run:
+            messages.success(request, f'Imported {upload.name}: {result.written} rule(s) written.')
+
+    return render(request, 'dashboard/compliance/import.html', context)
+
 # QA View
 @login_required
+@conditional('formulation', 'qatestresult')
 def qa_dashboard_view(request):
     if not request.user.roles.filter(name='qa').exists():
         messages.error(request, "You are not authorized to access the QA Dashboard.")
         return redirect('dashboard:dashboard')
 
-    formulations = Formulation.objects.filter(status='pending_qa')
+    formulations = Formulation.objects.filter(status='pending_qa').select_related('created_by')
     return render(request, 'dashboard/qa/dashboard.html', {'formulations': formulations})
 
+@login_required
+def qa_bulk_review_view(request):
+    """
+    Approve or reject many pending formulations at once: one bulk insert of
+    QA results and one UPDATE of formulation status, in a single transaction.
+    """
+    if not request.user.roles.filter(name='qa').exists():
+        messages.error(request, "You are not authorized to review formulations.")
+        return redirect('dashboard:dashboard')
+    if request.method != 'POST':
+        return redirect('dashboard:qa_dashboard')
+
+    action = request.POST.get('action')
+    if action not in ('approve', 'reject'):
+        messages.error(request, 'Choose approve or reject.')
+        return redirect('dashboard:qa_dashboard')
+    status = 'approved' if action == 'approve' else 'rejected'
+
+    pending = Formulation.objects.filter(status='pending_qa')
+    scope = request.POST.get('scope', 'selected')
+    if scope == 'selected':
+        # Ids that are not numbers cannot match a formulation; they count as skipped
+        selected_ids = [pk for pk in request.POST.getlist('formulation_ids') if pk.isdigit()]
+        if not selected_ids:
+            messages.error(request, 'No formulations selected.')
+            return redirect('dashboard:qa_dashboard')
+        targets = pending.filter(pk__in=selected_ids)
+    elif scope == 'compliant':
+        targets = pending.filter(compliance_status='compliant')
+    else:
+        targets = pending
+
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(targets.select_for_update().values_list('pk', flat=True))
+        QATestResult.objects.bulk_create([
+            QATestResult(
+                formulation_id=pk,
+                stability_test=request.POST.get('stability_test'),
+                performance_test=request.POST.get('performance_test'),
+                comments=request.POST.get('comments'),
+                tested_by=request.user,
+                tested_at=now,
+                status=status,
+            )
+            for pk in ids
+        ], batch_size=500)
+        updated = Formulation.objects.filter(pk__in=ids).update(status=status, updated_at=now)
+        # update() and bulk_create() send no post_save signals
+        notify_dashboard_change()
+        bump('formulation', 'qatestresult')
+
+    for pk in ids:
+        audit.record(f'formulation_{status}', actor=request.user,
+                     object_type='formulation', object_id=pk, bulk=True)
+
+    skipped = len(request.POST.getlist('formulation_ids')) - updated if scope == 'selected' else 0
+    summary = f'{updated} formulation(s) {status}.'
+    if skipped > 0:
+        summary += f' {skipped} skipped because they are no longer pending QA.'
+    messages.success(request, summary)
+    return redirect('dashboard:qa_dashboard')
+
 @login_required
 def qa_approve_view(request, pk):
     if not request.user.roles.filter(name='qa').exists():
@@ -443,7 +760,8 @@ def qa_approve_view(request, pk):
 
     formulation = get_object_or_404(Formulation, pk=pk)
     formulation.status = 'approved'
-    formulation.save()
+    formulation.save(update_fields=['status', 'updated_at'])
+    audit.record('formulation_approved', formulation, request.user)
     messages.success(request, "Formulation approved successfully.")
     return redirect('dashboard:qa_dashboard')
 
@@ -456,11 +774,13 @@ def qa_reject_view(request, pk):
 
     formulation = get_object_or_404(Formulation, pk=pk)
     formulation.status = 'rejected'
-    formulation.save()
+    formulation.save(update_fields=['status', 'updated_at'])
+    audit.record('formulation_rejected', formulation, request.user)
     messages.success(request, "Formulation rejected successfully.")
     return redirect('dashboard:qa_dashboard')
 
 @login_required
+@conditional('formulation', 'qatestresult')
 def qa_test_result_view(request, pk):
     if not request.user.roles.filter(name='qa').exists():
         return redirect('dashboard:dashboard')
@@ -469,19 +789,17 @@ def qa_test_result_view(request, pk):
     
     if request.method == 'POST':
         try:
-            # Create QA test result
+            # Create QA test result; saving it also updates the formulation status
             test_result = QATestResult.objects.create(
                 formulation=formulation,
                 stability_test=request.POST.get('stability_test'),
                 performance_test=request.POST.get('performance_test'),
                 comments=request.POST.get('comments'),
                 tested_by=request.user,
-                status=request.POST.get('action')  # 'approve' or 'reject'
+                status='approved' if request.POST.get('action') == 'approve' else 'rejected'
             )
-            
-            # Update formulation status
-            formulation.status = 'approved' if request.POST.get('action') == 'approve' else 'rejected'
-            formulation.save()
+            audit.record(f'formulation_{formulation.status}', formulation, request.user,
+                         qa_result_id=test_result.pk)
             
             # Show success message
             action_text = 'approved' if request.POST.get('action') == 'approve' else 'rejected'
@@ -506,94 +824,145 @@ def qa_test_result_view(request, pk):
 
 # Reports View
 @login_required
+@conditional('formulation', 'ingredient')
 def reports_view(request):
     if not request.user.roles.filter(name='manager').exists():
         return redirect('dashboard:dashboard')
 
-    # Formulation Status Counts
-    draft_count = Formulation.objects.filter(status='draft').count()
-    pending_count = Formulation.objects.filter(status='pending_qa').count()
-    approved_count = Formulation.objects.filter(status='approved').count()
-    rejected_count = Formulation.objects.filter(status='rejected').count()
+    include_archived = request.GET.get('include_archived') == '1'
+    results = {name: query() for name, query in report_queries(include_archived).items()}
+    return render(request, 'dashboard/reports.html', reports_context(results, include_archived))
+
+def report_queries(include_archived):
+    """The independent queries behind the reports page, as {name: callable}."""
+    from . import archive
 
     # Formulation Trend Chart (last 6 months)
     end_date = timezone.now()
     start_date = end_date - timedelta(days=180)
-    
-    # Get all formulations in date range
-    formulations = (
-        Formulation.objects
-        .filter(created_at__range=(start_date, end_date))
-        .values('created_at__year', 'created_at__month')
-        .annotate(count=Count('id'))
-        .order_by('created_at__year', 'created_at__month')
-    )
+
+    return {
+        # Formulation Status Counts
+        'status_counts': lambda: archive.status_counts(include_archived),
+        'monthly': lambda: archive.monthly_counts(start_date, end_date, include_archived),
+        # Ingredient Usage Chart
+        'ingredient_usage': lambda: archive.ingredient_usage(10, include_archived),
+        'total_ingredients': Ingredient.objects.count,
+        'low_stock_count': Ingredient.objects.filter(current_stock__lte=F('reorder_threshold')).count,
+        'recent_formulations': lambda: list(Formulation.objects.all().select_related('created_by')[:10]),
+    }
+
+def reports_context(results, include_archived):
+    status_counts = results['status_counts']
 
     # Process the dates for the chart
-    months = []
-    counts = []
-    for f in formulations:
-        month_date = f"{f['created_at__year']}-{f['created_at__month']:02d}"
-        months.append(month_date)
-        counts.append(f['count'])
-
-    # Create Trend Chart
-    trend_fig = go.Figure()
-    trend_fig.add_trace(go.Scatter(
-        x=months,
-        y=counts,
-        mode='lines+markers',
-        name='Formulations',
-        line=dict(color='#8b5cf6', width=3),
-        marker=dict(size=8)
-    ))
-    
-    trend_fig.update_layout(
-        margin=dict(t=0, b=0, l=0, r=0),
-        height=250,
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        yaxis=dict(gridcolor='rgba(0,0,0,0.1)'),
-        showlegend=False
-    )
+    monthly = results['monthly']
+    months = [f"{year}-{month:02d}" for year, month in monthly]
+    counts = list(monthly.values())
 
-    # Ingredient Usage Chart
-    top_ingredients = (
-        FormulationIngredient.objects
-        .values('ingredient__name')
-        .annotate(total_usage=Sum('quantity'))
-        .order_by('-total_usage')[:10]
-    )
+    top_ingredients = [
+        {'ingredient__name': name, 'total_usage': total}
+        for name, total in results['ingredient_usage']
+    ]
 
-    usage_fig = go.Figure()
-    usage_fig.add_trace(go.Bar(
-        x=[i['ingredient__name'] for i in top_ingredients],
-        y=[float(i['total_usage']) for i in top_ingredients],
-        marker_color='#3b82f6'
-    ))
-    
-    usage_fig.update_layout(
-        margin=dict(t=0, b=0, l=0, r=0),
-        height=250,
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        yaxis=dict(gridcolor='rgba(0,0,0,0.1)'),
-        showlegend=False
-    )
+    with timer('chart'):
+        from .charts import reports_charts
+        trend_chart, usage_chart = reports_charts(months, counts, top_ingredients)
+    from .snapshot import TABLES as snapshot_tables
 
-    context = {
-        'draft_count': draft_count,
-        'pending_count': pending_count,
-        'approved_count': approved_count,
-        'rejected_count': rejected_count,
-        'formulation_trend_chart': trend_fig.to_html(full_html=False, config={'displayModeBar': False}),
-        'ingredient_usage_chart': usage_fig.to_html(full_html=False, config={'displayModeBar': False}),
-        'total_ingredients': Ingredient.objects.count(),
-        'low_stock_count': Ingredient.objects.filter(current_stock__lte=F('reorder_threshold')).count(),
-        'recent_formulations': Formulation.objects.all().select_related('created_by')[:10],
+    return {
+        'draft_count': status_counts.get('draft', 0),
+        'pending_count': status_counts.get('pending_qa', 0),
+        'approved_count': status_counts.get('approved', 0),
+        'rejected_count': status_counts.get('rejected', 0),
+        'include_archived': include_archived,
+        'formulation_trend_chart': trend_chart,
+        'ingredient_usage_chart': usage_chart,
+        'total_ingredients': results['total_ingredients'],
+        'low_stock_count': results['low_stock_count'],
+        'recent_formulations': results['recent_formulations'],
+        'snapshot_tables': list(snapshot_tables),
     }
-    
-    return render(request, 'dashboard/reports.html', context)
+
+@login_required
+@conditional('ingredient')
+def stock_levels_view(request):
+    """Drill-down through the stock chart, one page of ingredients at a time."""
+    if not request.user.roles.filter(name='manager').exists():
+        return redirect('dashboard:dashboard')
+
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+
+    from .stock_levels import stock_chart_data
+    data = stock_chart_data(page)
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse(data)
+
+    with timer('chart'):
+        from .charts import stock_chart
+        chart = stock_chart(data, height=400)
+
+    return render(request, 'dashboard/inventory/stock_levels.html', {
+        'stock_chart': chart,
+        **data,
+    })
+
+@login_required
+@conditional('formulation', 'ingredient', daily=True)
+def production_capacity_view(request):
+    """Max producible batches and limiting ingredient for every approved formulation."""
+    if not request.user.roles.filter(name='manager').exists():
+        return redirect('dashboard:dashboard')
+
+    from .production import capacity_rows
+    rows = capacity_rows()
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'formulations': rows})
+
+    return render(request, 'dashboard/production/capacity.html', {
+        'capacity_rows': rows,
+    })
+
+@login_required
+def production_plan_check_view(request):
+    """
+    Check whether a production mix can be made from current stock.
+    Expects a JSON body: {"plan": {"<formulation_id>": <batches>, ...}}
+    """
+    if not request.user.roles.filter(name='manager').exists():
+        return JsonResponse({'error': 'Not authorized'}, status=403)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST a JSON body with a production plan'}, status=405)
+
+    try:
+        plan = {int(pk): float(batches) for pk, batches in json.loads(request.body)['plan'].items()}
+        # NaN compares false with everything, so it would pass a < 0 test
+        if not all(math.isfinite(batches) for batches in plan.values()):
+            raise ValueError('batch counts must be finite numbers')
+        if any(batches < 0 for batches in plan.values()):
+            raise ValueError('batch counts must not be negative')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return JsonResponse({'error': f'Invalid request: {e}'}, status=400)
+
+    unknown = set(plan) - set(Formulation.objects.filter(pk__in=plan).values_list('pk', flat=True))
+    if unknown:
+        return JsonResponse({'error': f"Unknown formulation(s): {', '.join(map(str, sorted(unknown)))}"}, status=400)
+
+    from .production import check_plan
+    feasible, shortages = check_plan(plan)
+    names = dict(Ingredient.objects.filter(pk__in=shortages).values_list('pk', 'name'))
+    return JsonResponse({
+        'feasible': feasible,
+        'shortages': [
+            {'ingredient_id': pk, 'ingredient': names.get(pk), **values}
+            for pk, values in shortages.items()
+        ],
+    })
 
 @login_required
 def download_formulation_report(request):
@@ -607,6 +976,8 @@ def download_formulation_report(request):
     writer.writerow(['Name', 'Version', 'Status', 'Compliance Status', 'Created By', 'Created At'])
     
     formulations = Formulation.objects.all().select_related('created_by')
+    if request.GET.get('include_archived') == '1':
+        formulations = chain(formulations, ArchivedFormulation.objects.all().select_related('created_by'))
     for formulation in formulations:
         writer.writerow([
             formulation.name,
@@ -645,6 +1016,71 @@ def download_ingredient_report(request):
     
     return response
 
+@login_required
+def download_snapshot(request, table):
+    """One snapshot table as Parquet or .npz (see snapshot.py), built on request."""
+    if not request.user.roles.filter(name='manager').exists():
+        return redirect('dashboard:dashboard')
+
+    from . import snapshot
+    if table not in snapshot.TABLES:
+        raise Http404('Unknown snapshot table')
+    fmt = request.GET.get('format') or snapshot.default_format()
+    if fmt not in snapshot.FORMATS or (fmt == 'parquet' and snapshot.default_format() != 'parquet'):
+        return JsonResponse({'error': f'Unsupported format {fmt!r}'}, status=400)
+
+    # Spooled to an anonymous temporary file; FileResponse streams and closes it
+    output = tempfile.TemporaryFile()
+    snapshot.export(table, output, fmt)
+    output.seek(0)
+    return FileResponse(output, as_attachment=True, filename=snapshot.filename(table, fmt),
+                        content_type='application/octet-stream')
+
+# Audit Log View
+AUDIT_PAGE_SIZE = 50
+
+@login_required
+def audit_log_view(request):
+    if not request.user.roles.filter(name='manager').exists():
+        return redirect('dashboard:dashboard')
+
+    events = AuditEvent.objects.select_related('actor')
+    filters = {
+        'action': request.GET.get('action', ''),
+        'object_type': request.GET.get('object_type', ''),
+        'object_id': request.GET.get('object_id', ''),
+        'actor': request.GET.get('actor', ''),
+    }
+    if filters['action']:
+        events = events.filter(action=filters['action'])
+    if filters['object_type']:
+        events = events.filter(object_type=filters['object_type'])
+        if filters['object_id']:
+            events = events.filter(object_id=filters['object_id'])
+    if filters['actor']:
+        events = events.filter(actor__username=filters['actor'])
+
+    # Fetch one extra row instead of counting the whole (large) table
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    offset = (page - 1) * AUDIT_PAGE_SIZE
+    page_events = list(events[offset:offset + AUDIT_PAGE_SIZE + 1])
+    has_next = len(page_events) > AUDIT_PAGE_SIZE
+
+    query = request.GET.copy()
+    query.pop('page', None)
+
+    return render(request, 'dashboard/audit/list.html', {
+        'events': page_events[:AUDIT_PAGE_SIZE],
+        'filters': filters,
+        'page': page,
+        'has_previous': page > 1,
+        'has_next': has_next,
+        'query_string': query.urlencode(),
+    })
+
 # Error Handler
 def handler403(request, exception):
     return render(request, 'dashboard/403.html', status=403)
\ No newline at end of file
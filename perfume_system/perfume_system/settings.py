@@ -1,6 +1,6 @@
 from pathlib import Path
 import os
-from decouple import config
+from decouple import Csv, config
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -22,7 +22,6 @@ INSTALLED_APPS = [
     # Third party apps
     'allauth',
     'allauth.account',
-    'allauth.socialaccount',
     'rolepermissions',
     
     # Local apps
@@ -31,6 +30,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'dashboard.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -39,6 +39,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',  # Add this line
+    'dashboard.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'perfume_system.urls'
@@ -68,6 +69,17 @@ DATABASES = {
     }
 }
 
+# Shared across worker processes so freshness stamps (see freshness.py) set
+# by one process are seen by all. Only data that is safe to lose lives here:
+# a culled stamp just invalidates ETags. Forecasts and the composition
+# change log are kept in the database.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('CACHE_LOCATION', default=str(BASE_DIR / 'cache')),
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -104,8 +116,9 @@ AUTHENTICATION_BACKENDS = [
 ]
 
 SITE_ID = 1
-LOGIN_REDIRECT_URL = '/dashboard/'
+LOGIN_REDIRECT_URL = '/'  # This will use your home_redirect view
 LOGOUT_REDIRECT_URL = '/'
+ACCOUNT_LOGOUT_REDIRECT_URL = '/accounts/login/'
 ACCOUNT_EMAIL_VERIFICATION = 'none'
 
 # Role permissions settings
@@ -113,21 +126,46 @@ ROLEPERMISSIONS_MODULE = 'accounts.roles'
 
 ROLEPERMISSIONS_REGISTER_ADMIN = True
 
-INSTALLED_APPS = [
-    'django.contrib.admin',
-    'django.contrib.auth',
-    'django.contrib.contenttypes',
-    'django.contrib.sessions',
-    'django.contrib.messages',
-    'django.contrib.staticfiles',
-    'django.contrib.sites',
-    'allauth',
-    'allauth.account',
-    'allauth.socialaccount',
-    'accounts',
-    'rolepermissions',
-    'dashboard',
-]
-
-LOGIN_REDIRECT_URL = '/'  # This will use your home_redirect view
-ACCOUNT_LOGOUT_REDIRECT_URL = '/accounts/login/'
\ No newline at end of file
+# Request profiling: Server-Timing headers plus cProfile dumps for a sampled
+# fraction of requests, or on demand for staff sending the trigger header
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=False, cast=bool)
+PROFILING_SAMPLE_RATE = config('PROFILING_SAMPLE_RATE', default=0.0, cast=float)
+PROFILING_TRIGGER_HEADER = config('PROFILING_TRIGGER_HEADER', default='X-Profile')
+PROFILING_DUMP_DIR = config('PROFILING_DUMP_DIR', default=str(BASE_DIR / 'profiles'))
+
+# Audit events are buffered in-process and bulk-inserted when the buffer
+# fills, the interval elapses, or a request finishes
+AUDIT_BUFFER_SIZE = config('AUDIT_BUFFER_SIZE', default=100, cast=int)
+AUDIT_FLUSH_INTERVAL = config('AUDIT_FLUSH_INTERVAL', default=5.0, cast=float)
+
+# Ingredients per page of the dashboard stock chart; the rest are bucketed
+STOCK_CHART_TOP = config('STOCK_CHART_TOP', default=15, cast=int)
+
+# Rejected/superseded formulations and resolved compliance issues untouched
+# for this long are moved to the archive tables by the archive_history command
+ARCHIVE_AFTER_DAYS = config('ARCHIVE_AFTER_DAYS', default=365, cast=int)
+ARCHIVE_BATCH_SIZE = config('ARCHIVE_BATCH_SIZE', default=500, cast=int)
+
+# Prometheus metrics at /metrics, without login. When METRICS_TOKEN is set,
+# scrapers must send "Authorization: Bearer <token>". Otherwise only clients
+# in METRICS_ALLOWED_NETWORKS may scrape, judged by REMOTE_ADDR. Behind a
+# reverse proxy on the same host every request comes from 127.0.0.1, so
+# either set METRICS_TOKEN or do not proxy /metrics. Set
+# METRICS_MULTIPROC_DIR to a directory shared by all gunicorn workers
+# (emptied at start-up) to aggregate across them.
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+METRICS_ALLOWED_NETWORKS = config('METRICS_ALLOWED_NETWORKS', default='127.0.0.1/32,::1/128', cast=Csv())
+METRICS_MULTIPROC_DIR = config('METRICS_MULTIPROC_DIR', default='')
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=5.0, cast=float)
+
+# Async dashboard/reports views with concurrent queries; set by asgi.py.
+# ASYNC_QUERY_WORKERS bounds the extra database connections they open.
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)
+ASYNC_QUERY_WORKERS = config('ASYNC_QUERY_WORKERS', default=8, cast=int)
+
+# Columnar analytics snapshots written by the export_snapshot command
+SNAPSHOT_DIR = config('SNAPSHOT_DIR', default=str(BASE_DIR / 'snapshots'))
+
+# Cold-start budget enforced by the startup_report command
+STARTUP_BUDGET_SECONDS = config('STARTUP_BUDGET_SECONDS', default=2.0, cast=float)
\ No newline at end of file